@@ -0,0 +1,656 @@
+"""
+Офлайн-бенчмарк бота расходов.
+
+Запускает настоящие обработчики из expense_bot.py против локальной заглушки
+Telegram Bot API: апдейты подаются напрямую в process_update,
+а все вызовы sendMessage и прочих методов записываются заглушкой.
+
+Примеры:
+    python bench_bot.py generate --db data/bench.db --users 10000 --rows 10000000
+    python bench_bot.py run --db data/bench.db --sessions 2000 --concurrency 8 --out bench_result.json
+    python bench_bot.py compare old.json new.json
+    python bench_bot.py catchup --db data/bench.db --backlog 5000 --duplicates 0.2
+"""
+import argparse
+import itertools
+import json
+import logging
+import os
+import random
+import resource
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+BENCH_TOKEN = '123456:BENCH'
+
+# Описания для генератора: (категория, варианты описаний)
+SAMPLE_DESCRIPTIONS = {
+    'Еда': ['обед', 'продукты', 'кофе', 'ужин в кафе', 'пятёрочка'],
+    'Транспорт': ['такси домой', 'метро', 'бензин', 'автобус', 'каршеринг'],
+    'Развлечения': ['кино', 'концерт', 'боулинг', 'игры'],
+    'Подписки': ['музыка', 'облако', 'кинотеатр онлайн'],
+    'Здоровье': ['аптека', 'стоматолог', 'анализы'],
+    'Жильё': ['аренда', 'коммуналка', 'интернет'],
+    'Образование': ['курсы', 'книги'],
+    'Другое': ['подарок', 'Без описания'],
+}
+
+# Сценарии: последовательности текстов сообщений от одного пользователя
+SCENARIOS = {
+    'spend': lambda rnd: ['/spend', f"🏷️ {rnd.choice(list(SAMPLE_DESCRIPTIONS))}",
+                          str(rnd.randint(50, 5000)), rnd.choice(['обед', 'такси домой', 'Пропустить'])],
+    'stats': lambda rnd: ['/stats'],
+    'stats_category': lambda rnd: [f"/stats {rnd.choice(list(SAMPLE_DESCRIPTIONS))}"],
+    'today': lambda rnd: ['/today'],
+    'list': lambda rnd: ['/list'],
+}
+
+
+# ===== ЗАГЛУШКА TELEGRAM API =====
+
+class FakeTelegramAPI:
+    """Локальный HTTP-сервер, отвечающий как Bot API и записывающий вызовы"""
+
+    def __init__(self, record_calls=False):
+        self.record_calls = record_calls
+        self.calls = []
+        self.counts = Counter()
+        self._lock = threading.Lock()
+        self._message_ids = itertools.count(1)
+        # Очередь для getUpdates: апдейты ниже переданного offset считаются подтверждёнными
+        self.pending = []
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def api_url(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}/bot{{0}}/{{1}}"
+
+    def _make_handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Иначе заголовки и тело уходят разными пакетами и ловят задержку Nagle/delayed ACK
+            disable_nagle_algorithm = True
+
+            def _handle(self):
+                url = urlparse(self.path)
+                method = url.path.rsplit('/', 1)[-1]
+                params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+                length = int(self.headers.get('Content-Length') or 0)
+                if length:
+                    body = self.rfile.read(length)
+                    if self.headers.get('Content-Type', '').startswith('application/x-www-form-urlencoded'):
+                        params.update({k: v[-1] for k, v in parse_qs(body.decode()).items()})
+                payload = json.dumps({'ok': True, 'result': api.record(method, params)}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = _handle
+            do_POST = _handle
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def record(self, method, params):
+        """Записать вызов и сформировать правдоподобный ответ"""
+        with self._lock:
+            self.counts[method] += 1
+            if self.record_calls:
+                self.calls.append({'method': method, 'params': params})
+        if method.startswith('send') or method.startswith('edit'):
+            chat_id = int(params.get('chat_id', 0) or 0)
+            return {
+                'message_id': next(self._message_ids),
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'text': params.get('text', ''),
+            }
+        if method == 'getUpdates':
+            offset = int(params.get('offset') or 0)
+            with self._lock:
+                self.pending = [u for u in self.pending if u['update_id'] >= offset]
+                return self.pending[:int(params.get('limit') or 100)]
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+        return True
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+# ===== ГЕНЕРАТОР ДАННЫХ =====
+
+def generate_data(db_path, users, rows, days=365, batch_size=50000, seed=42, shards=1):
+    """Заполнить БД (все шарды) синтетическими пользователями и расходами"""
+    eb = load_bot_module(db_path, shards)
+    eb.init_db()
+
+    rnd = random.Random(seed)
+    conns = {}
+    for shard in eb.SHARDS:
+        conn = sqlite3.connect(shard.path)
+        conn.execute('PRAGMA journal_mode = OFF')
+        conn.execute('PRAGMA synchronous = OFF')
+        conns[shard.index] = conn
+
+    for uid in range(1, users + 1):
+        cursor = conns[eb.shard_index(uid)].cursor()
+        cursor.execute('''
+            INSERT OR IGNORE INTO users (user_id, username, first_name, timezone)
+            VALUES (?, ?, ?, ?)
+        ''', (uid, f"user{uid}", f"User{uid}", rnd.choice(list(eb.TIMEZONES))))
+        cursor.executemany('''
+            INSERT OR IGNORE INTO ledger_categories (ledger_id, category, usage_count)
+            VALUES (?, ?, 0)
+        ''', ((uid, category) for category in eb.DEFAULT_CATEGORIES))
+    for conn in conns.values():
+        conn.commit()
+
+    categories = list(SAMPLE_DESCRIPTIONS)
+    now = datetime.utcnow()
+    span = days * 86400
+    started = time.perf_counter()
+    inserted = 0
+    while inserted < rows:
+        batches = defaultdict(list)
+        for _ in range(min(batch_size, rows - inserted)):
+            uid = rnd.randint(1, users)
+            category = rnd.choice(categories)
+            ts = now - timedelta(seconds=rnd.randrange(span))
+            batches[eb.shard_index(uid)].append((
+                uid,
+                uid,
+                round(rnd.lognormvariate(6, 1), 2),
+                category,
+                rnd.choice(SAMPLE_DESCRIPTIONS[category]),
+                ts.strftime('%Y-%m-%d %H:%M:%S'),
+            ))
+        for index, batch in batches.items():
+            conns[index].executemany('''
+                INSERT INTO expenses (ledger_id, user_id, amount, category, description, timestamp)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', batch)
+            conns[index].commit()
+            inserted += len(batch)
+        print(f"  {inserted}/{rows} расходов", file=sys.stderr, end='\r')
+
+    for conn in conns.values():
+        conn.close()
+    print(f"\n✅ Сгенерировано {users} пользователей и {rows} расходов за {time.perf_counter() - started:.1f}с",
+          file=sys.stderr)
+
+
+# ===== ПРОГОН СЦЕНАРИЕВ =====
+
+def load_bot_module(db_path, shards=1, backend='sqlite'):
+    """Импортировать expense_bot с тестовым токеном и указанной БД"""
+    os.environ.setdefault('TELEGRAM_TOKEN', BENCH_TOKEN)
+    os.makedirs('logs', exist_ok=True)
+    import expense_bot
+    expense_bot.DB_PATH = db_path
+    expense_bot.SHARD_COUNT = shards
+    expense_bot.STORAGE_BACKEND = backend
+    expense_bot.logger.setLevel(logging.WARNING)
+    return expense_bot
+
+
+def update_json(update_id, user_id, text):
+    """JSON апдейта с текстовым сообщением от пользователя"""
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f"User{user_id}", 'username': f"user{user_id}"},
+            'text': text,
+        },
+    }
+
+
+def make_update(update_id, user_id, text):
+    """Собрать Update с текстовым сообщением от пользователя"""
+    import telebot
+    return telebot.types.Update.de_json(update_json(update_id, user_id, text))
+
+
+def first_update_id():
+    """Начало диапазона update_id: отметки обработанных апдейтов переживают прогон, ID не должны повторяться"""
+    return int(time.time() * 1000)
+
+
+def percentile(sorted_values, p):
+    """Перцентиль по отсортированному списку (ближайший ранг)"""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(p / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies):
+    """Сводка по латентностям в миллисекундах"""
+    values = sorted(latencies)
+    return {
+        'count': len(values),
+        'p50_ms': percentile(values, 50) * 1000,
+        'p95_ms': percentile(values, 95) * 1000,
+        'p99_ms': percentile(values, 99) * 1000,
+        'max_ms': (values[-1] if values else 0) * 1000,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except Exception:
+        return None
+
+
+def run_benchmark(db_path, sessions, concurrency, users, scenarios, weights, seed=1, record_calls=None, shards=1,
+                  backend='sqlite'):
+    """Воспроизвести сценарии с заданной параллельностью и вернуть отчёт"""
+    import telebot
+
+    api = FakeTelegramAPI(record_calls=bool(record_calls))
+    api.start()
+    telebot.apihelper.API_URL = api.api_url
+
+    eb = load_bot_module(db_path, shards, backend)
+    eb.init_db()
+    if backend == 'memory':
+        # Хранилище в памяти наполняем из сгенерированных файлов
+        eb.storage.load_from_sqlite([p for p in map(eb.shard_path, range(shards)) if os.path.exists(p)])
+    eb.bot.threaded = False
+
+    rnd = random.Random(seed)
+    plan = [(rnd.randint(1, users), rnd.choices(scenarios, weights)[0], rnd.random()) for _ in range(sessions)]
+    update_ids = itertools.count(first_update_id())
+    user_locks = defaultdict(threading.Lock)
+    latencies = defaultdict(list)
+    errors = Counter()
+    results_lock = threading.Lock()
+
+    def play(user_id, scenario, session_seed):
+        texts = SCENARIOS[scenario](random.Random(session_seed))
+        local = []
+        # Сообщения одного пользователя должны идти по порядку — состояние диалога общее
+        with user_locks[user_id]:
+            for text in texts:
+                update = make_update(next(update_ids), user_id, text)
+                started = time.perf_counter()
+                try:
+                    eb.process_update(update)
+                except Exception as e:
+                    with results_lock:
+                        errors[type(e).__name__] += 1
+                local.append(time.perf_counter() - started)
+        with results_lock:
+            latencies[scenario].extend(local)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for future in [pool.submit(play, *item) for item in plan]:
+            future.result()
+    elapsed = time.perf_counter() - started
+    api.stop()
+
+    if record_calls:
+        with open(record_calls, 'w', encoding='utf-8') as f:
+            json.dump(api.calls, f, ensure_ascii=False)
+
+    all_latencies = [value for values in latencies.values() for value in values]
+    return {
+        'revision': git_revision(),
+        'timestamp': datetime.utcnow().isoformat(),
+        'db': db_path,
+        'shards': shards,
+        'backend': backend,
+        'sessions': sessions,
+        'concurrency': concurrency,
+        'elapsed_s': elapsed,
+        'updates': len(all_latencies),
+        'throughput_ups': len(all_latencies) / elapsed if elapsed else 0,
+        'latency': summarize(all_latencies),
+        'scenarios': {name: summarize(values) for name, values in sorted(latencies.items())},
+        'api_calls': dict(api.counts),
+        'errors': dict(errors),
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+# ===== СОВМЕСТИМОСТЬ ХРАНИЛИЩ =====
+
+def conformance_script(seed=7, users=12, ops=3000):
+    """Детерминированная последовательность операций над Storage и вызовов для сверки"""
+    rnd = random.Random(seed)
+    categories = ['Еда', 'Транспорт', 'Кафе', 'Coffee', 'Дом']
+    words = ['обед', 'такси', 'Latte', 'latte', 'метро', 'хлеб', '']
+    ids = defaultdict(list)
+    script = []
+    # У каждого личный бюджет (ID = user_id), у первых четырёх — ещё и общие
+    ledgers = {user_id: [user_id] for user_id in range(1, users + 1)}
+    for user_id in range(1, users + 1):
+        script.append(('save_user', (user_id, f"user{user_id}", f"User{user_id}", 'UTC+3')))
+        # Пересекающиеся наборы: названия категорий уникальны только внутри бюджета
+        script.append(('add_categories', (user_id, rnd.sample(categories, 3))))
+    for ledger_id, members in {-1: [1, 2, 3], -2: [3, 4]}.items():
+        owner = members[0]
+        script.append(('create_ledger', (ledger_id, f"Бюджет{-ledger_id}", owner, f"User{owner}", 'code')))
+        script.append(('create_ledger', (ledger_id, 'Дубль', members[-1], 'X', 'other')))
+        script.append(('add_categories', (ledger_id, rnd.sample(categories, 3))))
+        for member in members[1:]:
+            script.append(('add_ledger_member', (ledger_id, member, f"User{member}")))
+        for member in members:
+            ledgers[member].append(ledger_id)
+            script.append(('set_active_ledger', (member, ledger_id)))
+        script.append(('get_ledger', (ledger_id,)))
+    for _ in range(ops):
+        user_id = rnd.randint(1, users)
+        ledger_id = rnd.choice(ledgers[user_id])
+        op = rnd.choices(['add', 'edit', 'delete', 'read', 'tz', 'switch'], [50, 15, 10, 20, 5, 3])[0]
+        if op == 'add':
+            script.append(('add_expense', (ledger_id, user_id, rnd.randint(1, 5000) / 4, rnd.choice(categories),
+                                           rnd.choice(words))))
+            ids[ledger_id].append(len(script))
+        elif op in ('edit', 'delete') and ids:
+            # Иногда трогаем расход чужого бюджета — оба бэкенда должны его не заметить
+            owner = ledger_id if rnd.random() < 0.9 else rnd.choice(list(ids))
+            if not ids[owner]:
+                continue
+            ref = rnd.choice(ids[owner])
+            if op == 'edit':
+                script.append(('edit_expense', (ledger_id, ref, rnd.choice([None, rnd.randint(1, 900)]),
+                                                rnd.choice([None] + categories), rnd.choice([None] + words))))
+            else:
+                # Половину удалений отменяем, как кнопкой «Вернуть»
+                undo = rnd.random() < 0.5
+                if undo:
+                    script.append(('get_expense', (ledger_id, ref)))
+                script.append(('delete_expense', (ledger_id, ref)))
+                if undo:
+                    script.append(('restore_expense', (ledger_id, ref)))
+        elif op == 'tz':
+            script.append(('update_user_timezone', (user_id, rnd.choice(['UTC', 'UTC+5']))))
+        elif op == 'switch':
+            script.append(('set_active_ledger', (user_id, ledger_id)))
+            script.append(('get_active_ledger', (user_id,)))
+        else:
+            script.append(('get_user_timezone', (user_id,)))
+            script.append(('get_categories', (ledger_id,)))
+            script.append(('get_totals', (ledger_id,)))
+            script.append(('get_category_totals', (ledger_id, rnd.choice(categories))))
+            script.append(('search_expenses', (ledger_id, rnd.choice(['lat', 'ЛАТ', 'еда', 'о']), 10 ** 6)))
+            script.append(('get_expenses_between', (ledger_id, '0000-01-01', '9999-12-31', rnd.choice([None, 'Кафе']))))
+            script.append(('member_totals', (ledger_id, '0000-01-01', '9999-12-31')))
+            script.append(('get_expenses', (ledger_id, 10 ** 6, 0)))
+    script.append(('remove_ledger_member', (-1, 2)))
+    for user_id in range(1, users + 1):
+        script.append(('get_active_ledger', (user_id,)))
+        script.append(('get_user_ledgers', (user_id,)))
+    for ledger_id in sorted({ledger for user_ledgers in ledgers.values() for ledger in user_ledgers}):
+        script.append(('get_ledger_members', (ledger_id,)))
+        script.append(('get_totals', (ledger_id,)))
+        script.append(('get_expenses', (ledger_id, 10 ** 6, 0)))
+    script.append(('get_global_stats', ()))
+    # Журнал: все изменения по порядку, затем сжатие до последней записи каждого расхода
+    script.append(('get_changes', ([], 10 ** 6)))
+    script.append(('compact_changes', ()))
+    script.append(('get_changes', ([], 10 ** 6)))
+    return script
+
+
+def normalize_result(method, result):
+    """Привести результат к сравнимому виду: без времени записи, округлённые суммы, порядок равных не важен"""
+    def num(value):
+        return round(value, 6) if isinstance(value, float) else value
+
+    if method in ('get_expenses', 'search_expenses', 'get_expenses_between'):
+        return sorted((row[0], num(row[1]), row[2], row[3], row[5]) for row in result)
+    if method == 'get_expense':
+        return result and (result[0], num(result[1]), result[2], result[3], result[5])
+    if method == 'get_totals':
+        total, categories = result
+        return num(total), sorted((c, num(s), n) for c, s, n in categories)
+    if method == 'get_category_totals':
+        return tuple(num(v) for v in result)
+    if method == 'member_totals':
+        return sorted((user_id, num(s), n) for user_id, s, n in result)
+    if method in ('get_ledger_members', 'get_user_ledgers'):
+        # Порядок вступления зависит от времени записи, состав — нет
+        return sorted(result)
+    if method == 'get_changes':
+        # seq у шардов свои: сверяем историю каждого расхода по порядку
+        history = defaultdict(list)
+        for change in result:
+            history[change[2]].append((change[1], change[3], change[4], num(change[5]), change[6], change[7]))
+        return sorted(history.items())
+    if method == 'get_global_stats':
+        merged = result[0]
+        return merged['users'], merged['ledgers'], merged['expenses'], num(merged['total'])
+    return result
+
+
+def run_conformance(seed=7, users=12, ops=3000, shards=1):
+    """Прогнать один сценарий на SQLite и в памяти и сверить все ответы"""
+    import tempfile
+
+    script = conformance_script(seed, users, ops)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for backend in ('sqlite', 'memory'):
+            eb = load_bot_module(os.path.join(tmp, 'conformance.db'), shards, backend)
+            eb.init_db()
+            storage = eb.storage
+            produced = []
+            # ID расходов у бэкендов разные: сверяем по номеру операции, которая его создала
+            ids, back, saved = {}, {}, {}
+            for step, (method, args) in enumerate(script, 1):
+                if method in ('edit_expense', 'delete_expense', 'get_expense'):
+                    args = (args[0], ids[args[1]]) + tuple(args[2:])
+                if method == 'restore_expense':
+                    if saved.get(args[1]) is None:
+                        produced.append(None)
+                        continue
+                    args = (args[0], saved[args[1]])
+                result = getattr(storage, method)(*args)
+                if method == 'get_expense':
+                    saved[back[args[1]]] = result
+                    result = result and (back[result[0]],) + tuple(result[1:])
+                if method == 'add_expense':
+                    ids[step], back[result] = result, step
+                    result = None
+                if method in ('get_expenses', 'search_expenses', 'get_expenses_between'):
+                    result = [(back[row[0]],) + tuple(row[1:]) for row in result]
+                if method == 'get_changes':
+                    result = [row[:2] + (back[row[2]],) + tuple(row[3:]) for row in sorted(result)]
+                produced.append(normalize_result(method, result))
+            results[backend] = produced
+            for shard in eb.SHARDS:
+                shard.close()
+            eb.SHARDS = []
+
+    mismatches = [(step, method, a, b) for step, ((method, _), a, b)
+                  in enumerate(zip(script, results['sqlite'], results['memory']), 1) if a != b]
+    for step, method, a, b in mismatches[:10]:
+        print(f"❌ шаг {step} {method}:\n  sqlite: {a}\n  memory: {b}")
+    print(f"{'❌' if mismatches else '✅'} {len(script)} операций, расхождений: {len(mismatches)}")
+    return not mismatches
+
+
+# ===== ДОГОНЯЮЩАЯ ОБРАБОТКА =====
+
+def run_catchup(db_path, backlog, users, duplicates, seed=1, shards=1, backend='sqlite', workers=8):
+    """Разобрать очередь из backlog апдейтов через run_polling после «перезапуска».
+    
+    Доля duplicates очереди уже была обработана до падения: её повторная доставка не должна ничего менять.
+    """
+    import telebot
+
+    api = FakeTelegramAPI()
+    api.start()
+    telebot.apihelper.API_URL = api.api_url
+
+    eb = load_bot_module(db_path, shards, backend)
+    eb.init_db()
+    eb.UPDATE_WORKERS = workers
+    if backend == 'memory':
+        eb.storage.load_from_sqlite([p for p in map(eb.shard_path, range(shards)) if os.path.exists(p)])
+
+    # Очередь из полных сессий /spend: каждая добавляет ровно один расход
+    rnd = random.Random(seed)
+    queue_ = []
+    update_ids = itertools.count(first_update_id())
+    while len(queue_) < backlog:
+        user_id = rnd.randint(1, users)
+        queue_.extend(update_json(next(update_ids), user_id, text) for text in SCENARIOS['spend'](rnd))
+    sessions = len(queue_) // 4
+
+    # «До падения»: первые сессии обработаны, но смещение в Telegram не подтверждено
+    done = int(sessions * duplicates) * 4
+    for item in queue_[:done]:
+        eb.process_update(telebot.types.Update.de_json(item))
+    eb._recent_updates.clear()
+    eb.user_state.clear()
+    before = eb.get_global_stats()[0]['expenses']
+
+    api.pending = list(queue_)
+    started = time.perf_counter()
+    processed = eb.run_polling(until_caught_up=True)
+    elapsed = time.perf_counter() - started
+    added = eb.get_global_stats()[0]['expenses'] - before
+
+    return {
+        'revision': git_revision(),
+        'backend': backend,
+        'shards': shards,
+        'backlog': len(queue_),
+        'redelivered': done,
+        'elapsed_s': elapsed,
+        'throughput_ups': len(queue_) / elapsed if elapsed else 0,
+        'get_updates_calls': api.counts['getUpdates'],
+        'expenses_added': added,
+        'expenses_expected': sessions - done // 4,
+        'fetched': processed,
+    }
+
+
+def compare_results(old_path, new_path):
+    """Напечатать разницу между двумя отчётами"""
+    with open(old_path, encoding='utf-8') as f:
+        old = json.load(f)
+    with open(new_path, encoding='utf-8') as f:
+        new = json.load(f)
+
+    def line(name, a, b):
+        delta = (b - a) / a * 100 if a else 0
+        print(f"{name:<28} {a:>12.2f} {b:>12.2f} {delta:>+8.1f}%")
+
+    print(f"{'':<28} {old.get('revision') or 'old':>12} {new.get('revision') or 'new':>12}")
+    line('throughput_ups', old['throughput_ups'], new['throughput_ups'])
+    line('peak_rss_mb', old['peak_rss_mb'], new['peak_rss_mb'])
+    for key in ('p50_ms', 'p95_ms', 'p99_ms'):
+        line(f"all.{key}", old['latency'][key], new['latency'][key])
+    for scenario in sorted(set(old['scenarios']) & set(new['scenarios'])):
+        for key in ('p50_ms', 'p99_ms'):
+            line(f"{scenario}.{key}", old['scenarios'][scenario][key], new['scenarios'][scenario][key])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Офлайн-бенчмарк expense_bot')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    gen = sub.add_parser('generate', help='сгенерировать синтетическую БД')
+    gen.add_argument('--db', default='data/bench.db')
+    gen.add_argument('--users', type=int, default=10000)
+    gen.add_argument('--rows', type=int, default=10000000)
+    gen.add_argument('--days', type=int, default=365)
+    gen.add_argument('--seed', type=int, default=42)
+    gen.add_argument('--shards', type=int, default=1)
+
+    run = sub.add_parser('run', help='прогнать сценарии')
+    run.add_argument('--db', default='data/bench.db')
+    run.add_argument('--users', type=int, default=10000, help='диапазон user_id для сессий')
+    run.add_argument('--sessions', type=int, default=1000)
+    run.add_argument('--concurrency', type=int, default=4)
+    run.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                     help='сценарий (можно несколько); по умолчанию все')
+    run.add_argument('--weights', help='веса сценариев через запятую')
+    run.add_argument('--seed', type=int, default=1)
+    run.add_argument('--shards', type=int, default=1)
+    run.add_argument('--backend', choices=['sqlite', 'memory'], default='sqlite')
+    run.add_argument('--record-calls', help='сохранить все вызовы API в JSON-файл')
+    run.add_argument('--out', default='bench_result.json')
+
+    cmp_ = sub.add_parser('compare', help='сравнить два отчёта')
+    cmp_.add_argument('old')
+    cmp_.add_argument('new')
+
+    catchup = sub.add_parser('catchup', help='разобрать накопившуюся очередь после перезапуска')
+    catchup.add_argument('--db', default='data/bench.db')
+    catchup.add_argument('--backlog', type=int, default=5000)
+    catchup.add_argument('--users', type=int, default=10000)
+    catchup.add_argument('--duplicates', type=float, default=0.2, help='доля очереди, обработанная до падения')
+    catchup.add_argument('--seed', type=int, default=1)
+    catchup.add_argument('--shards', type=int, default=1)
+    catchup.add_argument('--backend', choices=['sqlite', 'memory'], default='sqlite')
+    catchup.add_argument('--workers', type=int, default=8)
+
+    conf = sub.add_parser('conformance', help='сверить бэкенды хранилища на одном сценарии')
+    conf.add_argument('--seed', type=int, default=7)
+    conf.add_argument('--users', type=int, default=12)
+    conf.add_argument('--ops', type=int, default=3000)
+    conf.add_argument('--shards', type=int, default=1)
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'generate':
+        os.makedirs(os.path.dirname(args.db) or '.', exist_ok=True)
+        generate_data(args.db, args.users, args.rows, days=args.days, seed=args.seed, shards=args.shards)
+    elif args.command == 'run':
+        scenarios = args.scenario or sorted(SCENARIOS)
+        weights = [float(w) for w in args.weights.split(',')] if args.weights else [1] * len(scenarios)
+        if len(weights) != len(scenarios):
+            parser.error('число весов должно совпадать с числом сценариев')
+        report = run_benchmark(args.db, args.sessions, args.concurrency, args.users, scenarios, weights,
+                               seed=args.seed, record_calls=args.record_calls, shards=args.shards,
+                               backend=args.backend)
+        with open(args.out, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    elif args.command == 'catchup':
+        report = run_catchup(args.db, args.backlog, args.users, args.duplicates, seed=args.seed,
+                             shards=args.shards, backend=args.backend, workers=args.workers)
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        if report['expenses_added'] != report['expenses_expected']:
+            sys.exit(1)
+    elif args.command == 'conformance':
+        sys.exit(0 if run_conformance(args.seed, args.users, args.ops, args.shards) else 1)
+    else:
+        compare_results(args.old, args.new)
+
+
+if __name__ == '__main__':
+    main()
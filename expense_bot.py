@@ -1,11 +1,33 @@
 import telebot
 import os
+import io
+import sys
+import json
+import time
 import logging
+import threading
+import functools
+import abc
+import cProfile
+import marshal
+import gzip
+import shutil
+import tempfile
+import queue
+import zlib
+import bisect
+import re
+import secrets
+import resource
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import pstats
 from datetime import datetime, timedelta
 import sqlite3
 from dotenv import load_dotenv
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 import pytz
+import numpy as np
 
 # Загружаем переменные окружения
 load_dotenv()
@@ -21,13 +43,23 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Отдельный лог для медленных обработчиков
+slow_logger = logging.getLogger('slow_handlers')
+slow_logger.addHandler(logging.FileHandler('logs/slow_handlers.log'))
+slow_logger.propagate = False
+
 # Инициализация бота
 TOKEN = os.getenv('TELEGRAM_TOKEN')
 if not TOKEN:
     logger.error("❌ TELEGRAM_TOKEN не установлен!")
     exit(1)
 
-bot = telebot.TeleBot(TOKEN)
+# Обработчики выполняются в нашем пуле (process_update), чтобы записи и отметка апдейта шли одной транзакцией
+bot = telebot.TeleBot(TOKEN, threaded=False)
+
+# Администраторы (через запятую) и порог медленного обработчика
+ADMIN_IDS = {int(x) for x in os.getenv('ADMIN_IDS', '').replace(' ', '').split(',') if x}
+SLOW_HANDLER_MS = float(os.getenv('SLOW_HANDLER_MS', '1000'))
 
 # Стандартные категории
 DEFAULT_CATEGORIES = ['Еда', 'Транспорт', 'Развлечения', 'Подписки', 'Здоровье', 'Жильё', 'Образование', 'Другое']
@@ -52,22 +84,179 @@ TIMEZONES = {
 # ===== БД =====
 DB_PATH = 'data/expenses.db'
 
-def init_db():
-    """Инициализация БД"""
-    os.makedirs('data', exist_ok=True)
-    conn = sqlite3.connect(DB_PATH)
+# Шардирование: бюджеты (с расходами) и пользователи раскладываются по DB_SHARDS файлам (1 — один файл DB_PATH)
+SHARD_COUNT = int(os.getenv('DB_SHARDS', '1'))
+SHARD_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '4'))
+# ID расходов каждого шарда начинаются с index << SHARD_ID_BITS, чтобы не пересекаться
+SHARD_ID_BITS = 40
+
+# Архив: расходы старше ARCHIVE_AFTER_DAYS переезжают в годовые файлы
+ARCHIVE_DIR = 'data/archive'
+ARCHIVE_AFTER_DAYS = int(os.getenv('ARCHIVE_AFTER_DAYS', '365'))
+ARCHIVE_BATCH_SIZE = int(os.getenv('ARCHIVE_BATCH_SIZE', '5000'))
+
+# Отметка апдейта, которая ждёт первой записи обработчика в этом потоке (см. update_transaction)
+_first_write = threading.local()
+
+@contextmanager
+def defer_update_mark():
+    """Записи блока идут без отметки апдейта: она ляжет в следующую запись обработчика (или в пакет после него).
+    
+    Для повторяемых записей перед основной — пользователь, категории, участник бюджета: если процесс упадёт
+    между ними, апдейт обработается заново целиком, а не останется применённым наполовину.
+    """
+    mark = getattr(_first_write, 'mark', None)
+    _first_write.mark = None
+    try:
+        yield
+    finally:
+        _first_write.mark = mark
+
+class Shard:
+    """Файл БД шарда: пул соединений для чтения и одно соединение-писатель"""
+
+    def __init__(self, index, path, pool_size=SHARD_POOL_SIZE):
+        self.index = index
+        self.path = path
+        self.pool_size = pool_size
+        self._pool = queue.LifoQueue()
+        self._writer = None
+        self._write_lock = threading.RLock()
+        self._write_depth = 0
+        self._write_owner = None
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        # В WAL коммит — дописывание в журнал без fsync: читатели пула не ждут писателя
+        conn.execute('PRAGMA synchronous = NORMAL')
+        return conn
+
+    @contextmanager
+    def read(self):
+        """Соединение из пула для чтения (внутри своей транзакции записи — писатель, чтобы видеть свои изменения)"""
+        if self._write_depth and self._write_owner == threading.get_ident():
+            yield self._writer
+            return
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            conn = self._connect()
+        try:
+            yield conn
+        finally:
+            conn.rollback()
+            if self._pool.qsize() < self.pool_size:
+                self._pool.put(conn)
+            else:
+                conn.close()
+
+    @contextmanager
+    def write(self):
+        """Соединение-писатель; запись в шард сериализуется, вложенные вызовы — одна транзакция.
+        
+        Первая запись потока внутри update_transaction заодно пишет отметку апдейта:
+        изменение и отметка фиксируются вместе, а не в конце обработчика.
+        """
+        # Внутри записи в шард в другой шард не пишем (бюджет и пользователь — отдельными записями),
+        # поэтому поток держит не больше одного писателя и встречных ожиданий нет
+        with self._write_lock:
+            if self._writer is None:
+                self._writer = self._connect()
+            self._write_depth += 1
+            self._write_owner = threading.get_ident()
+            mark = None
+            try:
+                if self._write_depth == 1:
+                    mark = getattr(_first_write, 'mark', None)
+                    if mark is not None:
+                        _first_write.mark = None
+                        mark(self._writer)
+                yield self._writer
+                if self._write_depth == 1:
+                    self._writer.commit()
+            except BaseException:
+                if self._write_depth == 1:
+                    self._writer.rollback()
+                    # Отметка откатилась вместе с записью — её возьмёт следующая запись обработчика
+                    if mark is not None:
+                        _first_write.mark = mark
+                raise
+            finally:
+                self._write_depth -= 1
+                if not self._write_depth:
+                    self._write_owner = None
+
+    @contextmanager
+    def exclusive(self):
+        """Не пускать писателей бота в шард на время блока (обслуживание через своё соединение)"""
+        with self._write_lock:
+            yield
+
+    def close(self):
+        with self._write_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+        while not self._pool.empty():
+            self._pool.get_nowait().close()
+
+SHARDS = []
+
+def shard_path(index):
+    """Путь к файлу шарда; нулевой шард — это DB_PATH"""
+    if index == 0:
+        return DB_PATH
+    base, ext = os.path.splitext(DB_PATH)
+    return f"{base}_shard{index}{ext}"
+
+def shard_index(key, count=None):
+    """Стабильный номер шарда для пользователя или бюджета (личный бюджет — там же, где пользователь)"""
+    return zlib.crc32(str(key).encode()) % (count or SHARD_COUNT)
+
+def shard_for(key):
+    """Шард пользователя или бюджета"""
+    return SHARDS[shard_index(key, len(SHARDS))]
+
+def fan_out(func):
+    """Выполнить func(shard) на всех шардах параллельно, вернуть список результатов"""
+    if len(SHARDS) == 1:
+        return [func(SHARDS[0])]
+    with ThreadPoolExecutor(max_workers=len(SHARDS)) as pool:
+        return list(pool.map(func, SHARDS))
+
+def expense_id_range(index):
+    """Диапазон [low, high) ID расходов, которые выдаёт шард index"""
+    return index << SHARD_ID_BITS, (index + 1) << SHARD_ID_BITS
+
+def _columns(cursor, table, schema='main'):
+    """Имена колонок таблицы"""
+    return {row[1] for row in cursor.execute(f'PRAGMA {schema}.table_info({table})').fetchall()}
+
+def _init_shard_schema(conn, index):
+    """Создать таблицы и индексы в файле шарда (и довести старую схему до текущей)"""
     cursor = conn.cursor()
     
+    # Инкрементальный VACUUM нужен, чтобы архивация возвращала место. В пустом файле режим
+    # включается сразу; существующий файл переводится командой vacuum (полный VACUUM долгий)
+    cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    # WAL: читатели не блокируются коммитами писателя (режим хранится в самом файле)
+    cursor.execute('PRAGMA journal_mode = WAL')
+    
+    # ledger_id — активный бюджет пользователя (NULL — личный)
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS users (
             user_id INTEGER PRIMARY KEY,
             username TEXT,
             first_name TEXT,
             timezone TEXT DEFAULT 'UTC+3',
-            first_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            first_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            ledger_id INTEGER
         )
     ''')
+    if 'ledger_id' not in _columns(cursor, 'users'):
+        cursor.execute('ALTER TABLE users ADD COLUMN ledger_id INTEGER')
     
+    # Расход принадлежит бюджету (ledger_id), user_id — кто из участников его добавил
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS expenses (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -76,301 +265,1453 @@ def init_db():
             category TEXT,
             description TEXT,
             timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            ledger_id INTEGER,
             FOREIGN KEY(user_id) REFERENCES users(user_id)
         )
     ''')
-    
+    if 'ledger_id' not in _columns(cursor, 'expenses'):
+        # До общих бюджетов у каждого был только личный: его ID совпадает с user_id
+        logger.info(f"🧳 Переношу расходы в личные бюджеты в {conn_path(conn)}")
+        cursor.execute('ALTER TABLE expenses ADD COLUMN ledger_id INTEGER')
+        cursor.execute('UPDATE expenses SET ledger_id = user_id')
+    # Все выборки и сводки идут по бюджету: один диапазон индекса на бюджет, сколько бы в нём ни было участников
+    cursor.execute('DROP INDEX IF EXISTS idx_expenses_user_time')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_expenses_ledger_time ON expenses(ledger_id, timestamp)')
+    # Выборки по времени без бюджета: архивация старых расходов и аналитика за последние дни
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_expenses_time ON expenses(timestamp)')
+
+    # Журнал изменений расходов для выгрузки: пишется в той же транзакции, что и сам расход.
+    # op = 'upsert' — строка целиком после изменения, 'delete' — надгробие (только ID)
+    new_changes = not cursor.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'expense_changes'").fetchone()
     cursor.execute('''
-        CREATE TABLE IF NOT EXISTS user_categories (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
+        CREATE TABLE IF NOT EXISTS expense_changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            op TEXT,
+            expense_id INTEGER,
+            ledger_id INTEGER,
             user_id INTEGER,
-            category TEXT UNIQUE,
+            amount REAL,
+            category TEXT,
+            description TEXT,
+            timestamp TIMESTAMP,
+            changed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    # Для сжатия: последняя запись по каждому расходу
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_expense_changes_expense ON expense_changes(expense_id, seq)')
+
+    # Категории бюджета: у разных бюджетов могут быть одинаковые названия
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS ledger_categories (
+            ledger_id INTEGER,
+            category TEXT,
             usage_count INTEGER DEFAULT 0,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY(user_id) REFERENCES users(user_id)
+            PRIMARY KEY (ledger_id, category)
         )
     ''')
+    if cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'user_categories'").fetchone():
+        # В старой таблице category была UNIQUE на весь файл; переносим в личные бюджеты
+        cursor.execute('''
+            INSERT OR IGNORE INTO ledger_categories (ledger_id, category, usage_count, created_at)
+            SELECT user_id, category, usage_count, created_at FROM user_categories ORDER BY id
+        ''')
+        cursor.execute('DROP TABLE user_categories')
     
-    conn.commit()
-    conn.close()
-    logger.info("✅ БД инициализирована")
+    # Общие бюджеты и их участники (личный бюджет — неявный, его ID равен user_id).
+    # Строки бюджета лежат в его шарде рядом с расходами
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS ledgers (
+            ledger_id INTEGER PRIMARY KEY,
+            name TEXT,
+            owner_id INTEGER,
+            invite_code TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS ledger_members (
+            ledger_id INTEGER,
+            user_id INTEGER,
+            name TEXT,
+            role TEXT DEFAULT 'member',
+            joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (ledger_id, user_id)
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_ledger_members_user ON ledger_members(user_id)')
+    
+    # Сводки по заархивированным расходам (только они, горячие считаются по expenses)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS expense_rollups (
+            ledger_id INTEGER,
+            year TEXT,
+            month TEXT,
+            category TEXT,
+            total REAL DEFAULT 0,
+            count INTEGER DEFAULT 0,
+            PRIMARY KEY (ledger_id, year, month, category)
+        )
+    ''')
+    
+    cursor.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+    
+    # Обработанные апдейты Telegram: отметка пишется в той же транзакции, что и изменения обработчика
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS processed_updates (
+            update_id INTEGER PRIMARY KEY,
+            user_id INTEGER,
+            processed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    # Результаты ночной аналитики: одна строка на бюджет и на (бюджет, категория)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_insights (
+            ledger_id INTEGER PRIMARY KEY,
+            as_of TEXT,
+            month TEXT,
+            month_spent REAL,
+            projected REAL,
+            mean_7d REAL,
+            mean_30d REAL,
+            day_total REAL,
+            day_z REAL
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS category_baselines (
+            ledger_id INTEGER,
+            category TEXT,
+            median REAL,
+            mad REAL,
+            count INTEGER,
+            PRIMARY KEY (ledger_id, category)
+        )
+    ''')
+    for table in ('expense_rollups', 'user_insights', 'category_baselines'):
+        if 'user_id' in _columns(cursor, table):
+            cursor.execute(f'ALTER TABLE {table} RENAME COLUMN user_id TO ledger_id')
+    
+    # Диапазон ID шарда: ID уникальны между шардами и сохраняются при перебалансировке.
+    # Счётчик ID расходов свой (meta.expense_seq), а не AUTOINCREMENT: после перебалансировки в таблице
+    # лежат строки с ID из диапазонов других шардов, и SQLite продолжил бы с самого большого из них
+    low, high = expense_id_range(index)
+    cursor.execute('''
+        INSERT INTO meta (key, value)
+        SELECT 'expense_seq', MAX(?, COALESCE((SELECT MAX(id) FROM expenses WHERE id >= ? AND id < ?), 0),
+                                     COALESCE((SELECT seq FROM sqlite_sequence
+                                               WHERE name = 'expenses' AND seq >= ? AND seq < ?), 0))
+        WHERE true
+        -- meta.value — TEXT, а текст в SQLite больше любого числа: сравниваем как числа
+        ON CONFLICT(key) DO UPDATE SET value = MAX(CAST(value AS INTEGER), CAST(excluded.value AS INTEGER))
+    ''', (low, low, high, low, high))
+    # Номера журнала изменений — в таком же диапазоне, поэтому по номеру видно, из какого он шарда.
+    # AUTOINCREMENT расходов тоже начинаем с диапазона — для вставок мимо счётчика (генератор данных)
+    if index:
+        for table in ('expenses', 'expense_changes'):
+            cursor.execute('''
+                INSERT INTO sqlite_sequence (name, seq)
+                SELECT ?, ? WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = ?)
+            ''', (table, low, table))
 
-def save_user(user_id, username, first_name, timezone='UTC+3'):
-    """Сохранить пользователя"""
-    try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
+    if new_changes:
+        # Журнал начинается со снимка горячих расходов: новый потребитель читает его с нуля
+        logger.info(f"📜 Заполняю журнал изменений текущими расходами в {conn_path(conn)}")
         cursor.execute('''
-            INSERT OR IGNORE INTO users (user_id, username, first_name, timezone)
-            VALUES (?, ?, ?, ?)
-        ''', (user_id, username, first_name, timezone))
-        conn.commit()
-        conn.close()
-    except Exception as e:
-        logger.error(f"❌ Ошибка сохранения пользователя: {e}")
+            INSERT INTO expense_changes (op, expense_id, ledger_id, user_id, amount, category, description, timestamp)
+            SELECT 'upsert', id, ledger_id, user_id, amount, category, description, timestamp FROM expenses ORDER BY id
+        ''')
 
-def get_user_timezone(user_id):
-    """Получить тайм-зону пользователя"""
+    conn.commit()
+    
+    cursor.execute('PRAGMA auto_vacuum')
+    if cursor.fetchone()[0] != 2:
+        logger.warning(f"⚠️ В {conn_path(conn)} нет auto_vacuum = INCREMENTAL: архивация не вернёт место на диске. "
+                       f"Останови бота и запусти: python expense_bot.py vacuum")
+
+def conn_path(conn):
+    """Путь к основному файлу соединения"""
+    return conn.execute('PRAGMA database_list').fetchone()[2]
+
+def _stored_shard_count():
+    """Число шардов, на которые сейчас разложены данные"""
+    conn = sqlite3.connect(shard_path(0))
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute('SELECT timezone FROM users WHERE user_id = ?', (user_id,))
-        result = cursor.fetchone()
+        row = conn.execute("SELECT value FROM meta WHERE key = 'shard_count'").fetchone()
+        return int(row[0]) if row else None
+    except sqlite3.OperationalError:
+        return None
+    finally:
         conn.close()
-        return result[0] if result else 'UTC+3'
-    except Exception as e:
-        logger.error(f"❌ Ошибка получения тайм-зоны: {e}")
-        return 'UTC+3'
 
-def update_user_timezone(user_id, timezone):
-    """Обновить тайм-зону пользователя"""
-    try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute('UPDATE users SET timezone = ? WHERE user_id = ?', (timezone, user_id))
-        conn.commit()
+def init_db():
+    """Инициализация БД"""
+    global SHARDS, storage
+    
+    if STORAGE_BACKEND == 'memory':
+        storage = MemoryStorage()
+        logger.info("✅ Хранилище в памяти инициализировано")
+        return
+    
+    os.makedirs(os.path.dirname(DB_PATH) or '.', exist_ok=True)
+    
+    stored = _stored_shard_count()
+    if stored is not None and stored != SHARD_COUNT:
+        logger.error(f"❌ DB_SHARDS={SHARD_COUNT}, а данные разложены на {stored} шардов. "
+                     f"Запусти: python expense_bot.py reshard {SHARD_COUNT}")
+        exit(1)
+    
+    for shard in SHARDS:
+        shard.close()
+    SHARDS = [Shard(i, shard_path(i)) for i in range(SHARD_COUNT)]
+    
+    for shard in SHARDS:
+        conn = sqlite3.connect(shard.path)
+        _init_shard_schema(conn, shard.index)
         conn.close()
-        return True
-    except Exception as e:
-        logger.error(f"❌ Ошибка обновления тайм-зоны: {e}")
-        return False
+    _migrate_archives()
+    _backfill_archived_changes()
+    
+    conn = sqlite3.connect(shard_path(0))
+    conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('shard_count', ?)", (str(SHARD_COUNT),))
+    conn.commit()
+    conn.close()
+    storage = SQLiteStorage()
+    logger.info(f"✅ БД инициализирована (шардов: {SHARD_COUNT})")
 
-def get_user_local_time(user_id):
-    """Получить текущее время пользователя"""
-    tz_str = get_user_timezone(user_id)
-    tz_name = TIMEZONES.get(tz_str, 'UTC')
-    tz = pytz.timezone(tz_name)
-    return datetime.now(tz)
+# ===== ХРАНИЛИЩЕ =====
+# Бэкенд хранилища: sqlite (шарды на диске) или memory (для тестов и бенчмарков)
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'sqlite')
 
-def initialize_user_categories(user_id):
-    """Инициализировать категории для нового пользователя"""
-    try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        for category in DEFAULT_CATEGORIES:
-            cursor.execute('''
-                INSERT OR IGNORE INTO user_categories (user_id, category, usage_count)
-                VALUES (?, ?, 0)
-            ''', (user_id, category))
-        
-        conn.commit()
-        conn.close()
-    except Exception as e:
-        logger.error(f"❌ Ошибка инициализации категорий: {e}")
+class DuplicateUpdate(BaseException):
+    """Апдейт уже обработан (например, другим экземпляром бота).
+    
+    Наследует BaseException: вспомогательные функции ловят Exception, а повтор должен прервать обработчик.
+    """
 
-def get_user_categories_sorted(user_id):
-    """Получить отсортированные категории пользователя"""
-    try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT category, usage_count
-            FROM user_categories
-            WHERE user_id = ?
-            ORDER BY usage_count DESC, category ASC
-        ''', (user_id,))
-        
-        categories = [row[0] for row in cursor.fetchall()]
-        conn.close()
-        return categories
-    except Exception as e:
-        logger.error(f"❌ Ошибка получения категорий: {e}")
-        return DEFAULT_CATEGORIES
+class Storage(abc.ABC):
+    """Интерфейс хранилища: пользователи, бюджеты, категории, расходы и агрегаты.
+    
+    Расходы и категории принадлежат бюджету (ledger_id): личному (его ID равен user_id) или общему
+    (отрицательный ID). Строки расходов — кортежи (id, amount, category, description, timestamp, user_id),
+    где user_id — участник, добавивший расход; timestamp хранится строкой 'YYYY-MM-DD HH:MM:SS' в UTC.
+    Категории приходят уже нормализованными. Методы абстрактные: неполный бэкенд не создастся вовсе,
+    а не упадёт посреди обработки запроса.
+    """
 
-def get_top_categories(user_id, limit=5):
-    """Получить топ категорий по использованию"""
-    categories = get_user_categories_sorted(user_id)
-    return categories[:limit]
+    @abc.abstractmethod
+    def save_user(self, user_id, username, first_name, timezone):
+        raise NotImplementedError
 
-def get_common_categories(user_id):
-    """Получить оставшиеся категории (не в топ-5)"""
-    categories = get_user_categories_sorted(user_id)
-    return categories[5:] if len(categories) > 5 else []
+    @abc.abstractmethod
+    def get_user_timezone(self, user_id):
+        """Тайм-зона или None, если пользователя нет"""
+        raise NotImplementedError
 
-def add_category(user_id, category):
-    """Добавить новую категорию"""
-    try:
-        category = category.lower().capitalize()
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT OR IGNORE INTO user_categories (user_id, category, usage_count)
-            VALUES (?, ?, 0)
-        ''', (user_id, category))
-        
-        conn.commit()
-        conn.close()
-        return True
-    except Exception as e:
-        logger.error(f"❌ Ошибка добавления категории: {e}")
-        return False
+    @abc.abstractmethod
+    def update_user_timezone(self, user_id, timezone):
+        raise NotImplementedError
 
-def increment_category_usage(user_id, category):
-    """Увеличить счётчик использования категории"""
-    try:
-        category = category.lower().capitalize()
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            UPDATE user_categories
-            SET usage_count = usage_count + 1
-            WHERE user_id = ? AND category = ?
-        ''', (user_id, category))
-        
-        conn.commit()
-        conn.close()
-    except Exception as e:
-        logger.error(f"❌ Ошибка обновления счётчика: {e}")
+    @abc.abstractmethod
+    def get_active_ledger(self, user_id):
+        """Бюджет, с которым сейчас работает пользователь (по умолчанию — личный)"""
+        raise NotImplementedError
 
-def add_expense(user_id, amount, category, description):
-    """Добавить расход"""
-    try:
-        category = category.lower().capitalize()
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT INTO expenses (user_id, amount, category, description)
-            VALUES (?, ?, ?, ?)
-        ''', (user_id, amount, category, description))
-        
-        conn.commit()
-        expense_id = cursor.lastrowid
-        conn.close()
-        
-        increment_category_usage(user_id, category)
-        return expense_id
-    except Exception as e:
-        logger.error(f"❌ Ошибка добавления расхода: {e}")
-        return None
+    @abc.abstractmethod
+    def set_active_ledger(self, user_id, ledger_id):
+        raise NotImplementedError
 
-def edit_expense(expense_id, amount=None, category=None, description=None):
-    """Редактировать расход"""
-    try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        if amount is not None:
-            cursor.execute('UPDATE expenses SET amount = ? WHERE id = ?', (amount, expense_id))
-        if category is not None:
-            category = category.lower().capitalize()
-            cursor.execute('UPDATE expenses SET category = ? WHERE id = ?', (category, expense_id))
-        if description is not None:
-            cursor.execute('UPDATE expenses SET description = ? WHERE id = ?', (description, expense_id))
-        
-        conn.commit()
-        conn.close()
-        return True
-    except Exception as e:
-        logger.error(f"❌ Ошибка редактирования расхода: {e}")
-        return False
+    @abc.abstractmethod
+    def create_ledger(self, ledger_id, name, owner_id, owner_name, invite_code):
+        """Создать общий бюджет с владельцем-участником; False, если ID уже занят"""
+        raise NotImplementedError
 
-def delete_expense(expense_id):
-    """Удалить расход"""
-    try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute('DELETE FROM expenses WHERE id = ?', (expense_id,))
-        conn.commit()
-        conn.close()
-        return True
-    except Exception as e:
-        logger.error(f"❌ Ошибка удаления расхода: {e}")
-        return False
+    @abc.abstractmethod
+    def get_ledger(self, ledger_id):
+        """(name, owner_id, invite_code) общего бюджета или None"""
+        raise NotImplementedError
 
-def get_expense(expense_id, user_id):
-    """Получить расход по ID"""
-    try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT id, amount, category, description, timestamp
-            FROM expenses
-            WHERE id = ? AND user_id = ?
-        ''', (expense_id, user_id))
-        
-        result = cursor.fetchone()
-        conn.close()
-        return result
-    except Exception as e:
-        logger.error(f"❌ Ошибка получения расхода: {e}")
-        return None
+    @abc.abstractmethod
+    def add_ledger_member(self, ledger_id, user_id, name, role='member'):
+        raise NotImplementedError
 
-def get_all_expenses(user_id, limit=20):
-    """Получить расходы пользователя (новые сверху, максимум limit)"""
-    try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT id, amount, category, description, timestamp
-            FROM expenses
-            WHERE user_id = ?
-            ORDER BY timestamp DESC
-            LIMIT ?
-        ''', (user_id, limit))
-        
-        expenses = cursor.fetchall()
-        conn.close()
-        return expenses
-    except Exception as e:
-        logger.error(f"❌ Ошибка получения расходов: {e}")
-        return []
+    @abc.abstractmethod
+    def remove_ledger_member(self, ledger_id, user_id):
+        raise NotImplementedError
 
-def get_today_expenses(user_id):
-    """Получить расходы за день (по времени пользователя)"""
-    try:
-        tz_str = get_user_timezone(user_id)
-        tz_name = TIMEZONES.get(tz_str, 'UTC')
-        tz = pytz.timezone(tz_name)
-        
-        now = datetime.now(tz)
-        today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
-        today_end = now.replace(hour=23, minute=59, second=59, microsecond=999999)
-        
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT id, amount, category, description, timestamp
-            FROM expenses
-            WHERE user_id = ? AND timestamp BETWEEN ? AND ?
-            ORDER BY timestamp DESC
-        ''', (user_id, today_start.isoformat(), today_end.isoformat()))
-        
-        expenses = cursor.fetchall()
-        conn.close()
-        return expenses
-    except Exception as e:
-        logger.error(f"❌ Ошибка получения расходов за день: {e}")
-        return []
+    @abc.abstractmethod
+    def get_ledger_members(self, ledger_id):
+        """[(user_id, имя, роль)] в порядке вступления"""
+        raise NotImplementedError
 
-def get_today_expenses_by_category(user_id, category):
-    """Получить расходы за день по категории"""
-    try:
-        category = category.lower().capitalize()
-        tz_str = get_user_timezone(user_id)
-        tz_name = TIMEZONES.get(tz_str, 'UTC')
-        tz = pytz.timezone(tz_name)
+    @abc.abstractmethod
+    def get_user_ledgers(self, user_id):
+        """Общие бюджеты пользователя [(ledger_id, название, роль)] в порядке вступления"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def add_categories(self, ledger_id, categories):
+        """Добавить категории, существующие пропустить"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_categories(self, ledger_id):
+        """Категории по убыванию usage_count, затем по алфавиту"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def increment_category_usage(self, ledger_id, category):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def add_expense(self, ledger_id, user_id, amount, category, description):
+        """Добавить расход и увеличить счётчик категории, вернуть ID"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def edit_expense(self, ledger_id, expense_id, amount=None, category=None, description=None):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def delete_expense(self, ledger_id, expense_id):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def restore_expense(self, ledger_id, expense):
+        """Вернуть удалённый расход (строку из get_expense) с прежними ID, автором и временем"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_changes(self, cursor, limit):
+        """Записи журнала изменений после курсора, по возрастанию seq (не больше limit на шард).
         
-        now = datetime.now(tz)
-        today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
-        today_end = now.replace(hour=23, minute=59, second=59, microsecond=999999)
+        Записи — (seq, op, expense_id, ledger_id, user_id, amount, category, description, timestamp, changed_at),
+        у надгробий (op = 'delete') поля расхода пустые. Курсор — последние прочитанные seq (по одному на шард,
+        шард — seq >> SHARD_ID_BITS); шарда нет в курсоре — читаем его с начала.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def compact_changes(self):
+        """Оставить в журнале только последнюю запись каждого расхода, вернуть число удалённых"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_expense(self, ledger_id, expense_id):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_expenses(self, ledger_id, limit, offset=0):
+        """Расходы бюджета, новые сверху"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def search_expenses(self, ledger_id, query, limit):
+        """Расходы, где query входит в описание или категорию (LIKE), новые сверху"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_expenses_between(self, ledger_id, start, end, category=None):
+        """Расходы с start <= timestamp <= end (сравнение строк, как в SQLite), новые сверху"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def sum_between(self, ledger_id, start, end):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def member_totals(self, ledger_id, start, end):
+        """[(user_id, сумма, количество)] за период по убыванию суммы"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_totals(self, ledger_id):
+        """(сумма всех расходов, [(категория, сумма, количество)] по убыванию суммы)"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_category_totals(self, ledger_id, category):
+        """(сумма, количество) по категории"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_global_stats(self):
+        """(сводка, [сводка по шардам]) по всем пользователям"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def processed_updates(self, update_ids):
+        """Какие из update_id уже обработаны"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def update_transaction(self, user_id, update_id):
+        """Контекст обработки апдейта: отметка update_id фиксируется вместе с первой записью обработчика
+        (вне defer_update_mark). Сетевые вызовы обработчика транзакцию не держат.
         
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT id, amount, category, description, timestamp
-            FROM expenses
-            WHERE user_id = ? AND category = ? AND timestamp BETWEEN ? AND ?
-            ORDER BY timestamp DESC
-        ''', (user_id, category, today_start.isoformat(), today_end.isoformat()))
+        Если обработчик ничего не записал, отметка ждёт flush_update_marks. Если апдейт уже отмечен
+        другим процессом, первая запись бросит DuplicateUpdate.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def flush_update_marks(self):
+        """Записать отложенные отметки апдейтов без записей (одна транзакция на шард); вернуть их число"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def prune_processed_updates(self, before):
+        """Удалить отметки старше before"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def load_update_offset(self):
+        """Последний update_id, до которого включительно всё обработано, или None"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def save_update_offset(self, update_id):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def analytics_partitions(self):
+        """Части данных, которые аналитика считает по очереди"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def load_analytics_rows(self, partition, since):
+        """Дневные суммы [(ledger_id, день (date.toordinal), сумма)] и покупки [(ledger_id, категория, сумма)] с since"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def save_analytics(self, partition, insights, baselines):
+        """Заменить результаты аналитики части: строки user_insights и category_baselines"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_insight(self, ledger_id):
+        """(as_of, month, month_spent, projected, mean_7d, mean_30d, day_total, day_z) или None"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_category_baseline(self, ledger_id, category):
+        """(медиана, MAD, количество) покупок в категории или None"""
+        raise NotImplementedError
+
+class SQLiteStorage(Storage):
+    """Хранилище в SQLite-шардах: пользователь — в шарде своего ID, бюджет со всеми данными — в шарде своего"""
+
+    def __init__(self):
+        self._pending_marks = []   # (user_id, update_id) апдейтов, обработчик которых ничего не записал
+        self._pending_lock = threading.Lock()
+
+    def save_user(self, user_id, username, first_name, timezone):
+        with shard_for(user_id).write() as conn:
+            conn.execute('''
+                INSERT OR IGNORE INTO users (user_id, username, first_name, timezone)
+                VALUES (?, ?, ?, ?)
+            ''', (user_id, username, first_name, timezone))
+
+    def get_user_timezone(self, user_id):
+        with shard_for(user_id).read() as conn:
+            result = conn.execute('SELECT timezone FROM users WHERE user_id = ?', (user_id,)).fetchone()
+        return result[0] if result else None
+
+    def update_user_timezone(self, user_id, timezone):
+        with shard_for(user_id).write() as conn:
+            conn.execute('UPDATE users SET timezone = ? WHERE user_id = ?', (timezone, user_id))
+
+    def get_active_ledger(self, user_id):
+        with shard_for(user_id).read() as conn:
+            result = conn.execute('SELECT ledger_id FROM users WHERE user_id = ?', (user_id,)).fetchone()
+        return result[0] if result and result[0] is not None else user_id
+
+    def set_active_ledger(self, user_id, ledger_id):
+        with shard_for(user_id).write() as conn:
+            conn.execute('UPDATE users SET ledger_id = ? WHERE user_id = ?',
+                         (None if ledger_id == user_id else ledger_id, user_id))
+
+    def create_ledger(self, ledger_id, name, owner_id, owner_name, invite_code):
+        with shard_for(ledger_id).write() as conn:
+            try:
+                conn.execute('INSERT INTO ledgers (ledger_id, name, owner_id, invite_code) VALUES (?, ?, ?, ?)',
+                             (ledger_id, name, owner_id, invite_code))
+            except sqlite3.IntegrityError:
+                return False
+            self.add_ledger_member(ledger_id, owner_id, owner_name, 'owner')
+            return True
+
+    def get_ledger(self, ledger_id):
+        with shard_for(ledger_id).read() as conn:
+            return conn.execute('SELECT name, owner_id, invite_code FROM ledgers WHERE ledger_id = ?',
+                                (ledger_id,)).fetchone()
+
+    def add_ledger_member(self, ledger_id, user_id, name, role='member'):
+        with shard_for(ledger_id).write() as conn:
+            conn.execute('INSERT OR IGNORE INTO ledger_members (ledger_id, user_id, name, role) VALUES (?, ?, ?, ?)',
+                         (ledger_id, user_id, name, role))
+
+    def remove_ledger_member(self, ledger_id, user_id):
+        with shard_for(ledger_id).write() as conn:
+            conn.execute('DELETE FROM ledger_members WHERE ledger_id = ? AND user_id = ?', (ledger_id, user_id))
+
+    def get_ledger_members(self, ledger_id):
+        with shard_for(ledger_id).read() as conn:
+            return conn.execute('''
+                SELECT user_id, name, role FROM ledger_members
+                WHERE ledger_id = ?
+                ORDER BY joined_at, user_id
+            ''', (ledger_id,)).fetchall()
+
+    def get_user_ledgers(self, user_id):
+        # Бюджеты пользователя разбросаны по шардам; команда редкая, поэтому просто опрашиваем все
+        def shard_ledgers(shard):
+            with shard.read() as conn:
+                return conn.execute('''
+                    SELECT m.joined_at, l.ledger_id, l.name, m.role
+                    FROM ledger_members m JOIN ledgers l ON l.ledger_id = m.ledger_id
+                    WHERE m.user_id = ?
+                ''', (user_id,)).fetchall()
+        rows = sorted(row for rows in fan_out(shard_ledgers) for row in rows)
+        return [row[1:] for row in rows]
+
+    def add_categories(self, ledger_id, categories):
+        with shard_for(ledger_id).write() as conn:
+            conn.executemany('''
+                INSERT OR IGNORE INTO ledger_categories (ledger_id, category, usage_count)
+                VALUES (?, ?, 0)
+            ''', [(ledger_id, category) for category in categories])
+
+    def get_categories(self, ledger_id):
+        with shard_for(ledger_id).read() as conn:
+            cursor = conn.execute('''
+                SELECT category, usage_count
+                FROM ledger_categories
+                WHERE ledger_id = ?
+                ORDER BY usage_count DESC, category ASC
+            ''', (ledger_id,))
+            return [row[0] for row in cursor.fetchall()]
+
+    def increment_category_usage(self, ledger_id, category):
+        with shard_for(ledger_id).write() as conn:
+            conn.execute('''
+                UPDATE ledger_categories
+                SET usage_count = usage_count + 1
+                WHERE ledger_id = ? AND category = ?
+            ''', (ledger_id, category))
+
+    @staticmethod
+    def _log_change(conn, ledger_id, expense_id):
+        """Записать в журнал текущую строку расхода (в транзакции изменения)"""
+        conn.execute('''
+            INSERT INTO expense_changes (op, expense_id, ledger_id, user_id, amount, category, description, timestamp)
+            SELECT 'upsert', id, ledger_id, user_id, amount, category, description, timestamp
+            FROM expenses WHERE id = ? AND ledger_id = ?
+        ''', (expense_id, ledger_id))
+
+    def add_expense(self, ledger_id, user_id, amount, category, description):
+        shard = shard_for(ledger_id)
+        low, high = expense_id_range(shard.index)
+        with shard.write() as conn:
+            # Следующий ID своего диапазона. Строки, вставленные мимо счётчика (генератор данных), учитываем
+            # по MAX(id) и по sqlite_sequence — он помнит и ID, уже уехавшие в архив
+            expense_id = conn.execute('''
+                UPDATE meta
+                SET value = MAX(CAST(value AS INTEGER),
+                                COALESCE((SELECT MAX(id) FROM expenses WHERE id >= ? AND id < ?), 0),
+                                COALESCE((SELECT seq FROM sqlite_sequence
+                                          WHERE name = 'expenses' AND seq >= ? AND seq < ?), 0)) + 1
+                WHERE key = 'expense_seq'
+                RETURNING CAST(value AS INTEGER)
+            ''', (low, high, low, high)).fetchone()[0]
+            conn.execute('''
+                INSERT INTO expenses (id, ledger_id, user_id, amount, category, description)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (expense_id, ledger_id, user_id, amount, category, description))
+            self._log_change(conn, ledger_id, expense_id)
+            self.increment_category_usage(ledger_id, category)
+            return expense_id
+
+    def edit_expense(self, ledger_id, expense_id, amount=None, category=None, description=None):
+        if amount is None and category is None and description is None:
+            return
+        with shard_for(ledger_id).write() as conn:
+            if amount is not None:
+                conn.execute('UPDATE expenses SET amount = ? WHERE id = ? AND ledger_id = ?', (amount, expense_id, ledger_id))
+            if category is not None:
+                conn.execute('UPDATE expenses SET category = ? WHERE id = ? AND ledger_id = ?', (category, expense_id, ledger_id))
+            if description is not None:
+                conn.execute('UPDATE expenses SET description = ? WHERE id = ? AND ledger_id = ?', (description, expense_id, ledger_id))
+            self._log_change(conn, ledger_id, expense_id)
+
+    def delete_expense(self, ledger_id, expense_id):
+        with shard_for(ledger_id).write() as conn:
+            if conn.execute('DELETE FROM expenses WHERE id = ? AND ledger_id = ?', (expense_id, ledger_id)).rowcount:
+                conn.execute("INSERT INTO expense_changes (op, expense_id, ledger_id) VALUES ('delete', ?, ?)",
+                             (expense_id, ledger_id))
+
+    def restore_expense(self, ledger_id, expense):
+        expense_id, amount, category, description, timestamp, user_id = expense
+        with shard_for(ledger_id).write() as conn:
+            if conn.execute('''
+                INSERT OR IGNORE INTO expenses (id, ledger_id, user_id, amount, category, description, timestamp)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (expense_id, ledger_id, user_id, amount, category, description, timestamp)).rowcount:
+                self._log_change(conn, ledger_id, expense_id)
+
+    def get_changes(self, cursor, limit):
+        after = {seq >> SHARD_ID_BITS: seq for seq in cursor}
+        def shard_changes(shard):
+            seq = after.get(shard.index, shard.index << SHARD_ID_BITS)
+            with shard.read() as conn:
+                return conn.execute('''
+                    SELECT seq, op, expense_id, ledger_id, user_id, amount, category, description, timestamp, changed_at
+                    FROM expense_changes WHERE seq > ? ORDER BY seq LIMIT ?
+                ''', (seq, limit)).fetchall()
+        return [row for rows in fan_out(shard_changes) for row in rows]
+
+    def compact_changes(self, batch_size=5000):
+        def compact(shard):
+            removed = 0
+            last = 0
+            # Заменённые более поздними записи удаляем окнами по seq, чтобы не держать писателя бота
+            while True:
+                with shard.write() as conn:
+                    window = conn.execute(
+                        'SELECT MAX(seq) FROM (SELECT seq FROM expense_changes WHERE seq > ? ORDER BY seq LIMIT ?)',
+                        (last, batch_size)).fetchone()[0]
+                    if window is None:
+                        break
+                    removed += conn.execute('''
+                        DELETE FROM expense_changes
+                        WHERE seq > ? AND seq <= ?
+                          AND seq < (SELECT MAX(seq) FROM expense_changes AS newer
+                                     WHERE newer.expense_id = expense_changes.expense_id)
+                    ''', (last, window)).rowcount
+                last = window
+            return removed
+        return sum(fan_out(compact))
+
+    def get_expense(self, ledger_id, expense_id):
+        with shard_for(ledger_id).read() as conn:
+            return conn.execute('''
+                SELECT id, amount, category, description, timestamp, user_id
+                FROM expenses
+                WHERE id = ? AND ledger_id = ?
+            ''', (expense_id, ledger_id)).fetchone()
+
+    def get_expenses(self, ledger_id, limit, offset=0):
+        with shard_for(ledger_id).read() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT id, amount, category, description, timestamp, user_id
+                FROM expenses
+                WHERE ledger_id = ?
+                ORDER BY timestamp DESC
+                LIMIT ? OFFSET ?
+            ''', (ledger_id, limit, offset))
+            expenses = cursor.fetchall()
+            
+            # Горячих не хватило — дочитываем из архива
+            if len(expenses) < limit:
+                cursor.execute('SELECT COUNT(*) FROM expenses WHERE ledger_id = ?', (ledger_id,))
+                cold_offset = max(0, offset - cursor.fetchone()[0])
+                expenses += _read_archive(conn, ledger_id, limit - len(expenses), cold_offset)
+            return expenses
+
+    def search_expenses(self, ledger_id, query, limit):
+        pattern = f"%{query}%"
+        with shard_for(ledger_id).read() as conn:
+            expenses = conn.execute('''
+                SELECT id, amount, category, description, timestamp, user_id
+                FROM expenses
+                WHERE ledger_id = ? AND (description LIKE ? OR category LIKE ?)
+                ORDER BY timestamp DESC
+                LIMIT ?
+            ''', (ledger_id, pattern, pattern, limit)).fetchall()
+            if len(expenses) < limit:
+                expenses += _read_archive(conn, ledger_id, limit - len(expenses), 0,
+                                          'AND (description LIKE ? OR category LIKE ?)', (pattern, pattern))
+            return expenses
+
+    def get_expenses_between(self, ledger_id, start, end, category=None):
+        with shard_for(ledger_id).read() as conn:
+            if category is None:
+                cursor = conn.execute('''
+                    SELECT id, amount, category, description, timestamp, user_id
+                    FROM expenses
+                    WHERE ledger_id = ? AND timestamp BETWEEN ? AND ?
+                    ORDER BY timestamp DESC
+                ''', (ledger_id, start, end))
+            else:
+                cursor = conn.execute('''
+                    SELECT id, amount, category, description, timestamp, user_id
+                    FROM expenses
+                    WHERE ledger_id = ? AND category = ? AND timestamp BETWEEN ? AND ?
+                    ORDER BY timestamp DESC
+                ''', (ledger_id, category, start, end))
+            return cursor.fetchall()
+
+    def sum_between(self, ledger_id, start, end):
+        with shard_for(ledger_id).read() as conn:
+            result = conn.execute('''
+                SELECT SUM(amount) FROM expenses
+                WHERE ledger_id = ? AND timestamp BETWEEN ? AND ?
+            ''', (ledger_id, start, end)).fetchone()
+        return result[0] or 0
+
+    def member_totals(self, ledger_id, start, end):
+        with shard_for(ledger_id).read() as conn:
+            return conn.execute('''
+                SELECT user_id, SUM(amount) AS sum_amount, COUNT(*)
+                FROM expenses
+                WHERE ledger_id = ? AND timestamp BETWEEN ? AND ?
+                GROUP BY user_id
+                ORDER BY sum_amount DESC
+            ''', (ledger_id, start, end)).fetchall()
+
+    def get_totals(self, ledger_id):
+        with shard_for(ledger_id).read() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT (SELECT COALESCE(SUM(amount), 0) FROM expenses WHERE ledger_id = ?)
+                     + (SELECT COALESCE(SUM(total), 0) FROM expense_rollups WHERE ledger_id = ?)
+            ''', (ledger_id, ledger_id))
+            total = cursor.fetchone()[0] or 0
+            
+            # Горячие расходы + сводки по архиву
+            cursor.execute('''
+                SELECT category, SUM(sum_amount) as sum_amount, SUM(count) as count
+                FROM (
+                    SELECT category, SUM(amount) as sum_amount, COUNT(*) as count
+                    FROM expenses WHERE ledger_id = ? GROUP BY category
+                    UNION ALL
+                    SELECT category, SUM(total), SUM(count)
+                    FROM expense_rollups WHERE ledger_id = ? GROUP BY category
+                )
+                GROUP BY category
+                ORDER BY sum_amount DESC
+            ''', (ledger_id, ledger_id))
+            return total, cursor.fetchall()
+
+    def get_category_totals(self, ledger_id, category):
+        with shard_for(ledger_id).read() as conn:
+            result = conn.execute('''
+                SELECT SUM(sum_amount), SUM(count)
+                FROM (
+                    SELECT SUM(amount) as sum_amount, COUNT(*) as count
+                    FROM expenses WHERE ledger_id = ? AND category = ?
+                    UNION ALL
+                    SELECT SUM(total), SUM(count)
+                    FROM expense_rollups WHERE ledger_id = ? AND category = ?
+                )
+            ''', (ledger_id, category, ledger_id, category)).fetchone()
+        return result[0] or 0, result[1] or 0
+
+    def get_global_stats(self):
+        def shard_stats(shard):
+            with shard.read() as conn:
+                cursor = conn.cursor()
+                cursor.execute('SELECT COUNT(*) FROM users')
+                users = cursor.fetchone()[0]
+                cursor.execute('SELECT COUNT(*) FROM ledgers')
+                ledgers = cursor.fetchone()[0]
+                cursor.execute('SELECT COUNT(*), COALESCE(SUM(amount), 0) FROM expenses')
+                count, total = cursor.fetchone()
+                cursor.execute('SELECT COALESCE(SUM(count), 0), COALESCE(SUM(total), 0) FROM expense_rollups')
+                archived_count, archived_total = cursor.fetchone()
+            return {
+                'shard': shard.index,
+                'users': users,
+                'ledgers': ledgers,
+                'expenses': count,
+                'archived': archived_count,
+                'total': total + archived_total,
+                'size_mb': os.path.getsize(shard.path) / 1024 / 1024,
+            }
         
-        expenses = cursor.fetchall()
-        conn.close()
-        return expenses
+        per_shard = fan_out(shard_stats)
+        merged = {key: sum(s[key] for s in per_shard)
+                  for key in ('users', 'ledgers', 'expenses', 'archived', 'total', 'size_mb')}
+        return merged, per_shard
+
+    def processed_updates(self, update_ids):
+        # Отметка лежит в шарде бюджета, активного на момент обработки, — спрашиваем все шарды разом
+        marks = ','.join('?' * len(update_ids))
+        def shard_processed(shard):
+            with shard.read() as conn:
+                return conn.execute(f'SELECT update_id FROM processed_updates WHERE update_id IN ({marks})',
+                                    list(update_ids)).fetchall()
+        return {row[0] for rows in fan_out(shard_processed) for row in rows}
+
+    @contextmanager
+    def update_transaction(self, user_id, update_id):
+        def mark(conn):
+            try:
+                conn.execute('INSERT INTO processed_updates (update_id, user_id) VALUES (?, ?)', (update_id, user_id))
+            except sqlite3.IntegrityError:
+                raise DuplicateUpdate(update_id)
+        # Отметка ляжет в шард первой записи; processed_updates опрашивает все шарды
+        _first_write.mark = mark
+        try:
+            yield
+            if _first_write.mark is not None:
+                # Только чтение (или повторяемые записи): отдельная транзакция на апдейт тормозила бы
+                # читателей, поэтому отметки пишутся пакетом
+                with self._pending_lock:
+                    self._pending_marks.append((user_id, update_id))
+        finally:
+            _first_write.mark = None
+
+    def flush_update_marks(self):
+        with self._pending_lock:
+            pending, self._pending_marks = self._pending_marks, []
+        by_shard = defaultdict(list)
+        for user_id, update_id in pending:
+            by_shard[shard_for(user_id)].append((update_id, user_id))
+        for shard, rows in by_shard.items():
+            try:
+                with shard.write() as conn:
+                    conn.executemany('INSERT OR IGNORE INTO processed_updates (update_id, user_id) VALUES (?, ?)',
+                                     rows)
+            except Exception:
+                # Не записанные отметки попробуем записать со следующим пакетом
+                with self._pending_lock:
+                    self._pending_marks.extend((user_id, update_id) for update_id, user_id in rows)
+                raise
+        return len(pending)
+
+    def prune_processed_updates(self, before):
+        def prune(shard):
+            with shard.write() as conn:
+                return conn.execute('DELETE FROM processed_updates WHERE processed_at < ?', (before,)).rowcount
+        return sum(fan_out(prune))
+
+    def load_update_offset(self):
+        with SHARDS[0].read() as conn:
+            row = conn.execute("SELECT value FROM meta WHERE key = 'update_offset'").fetchone()
+        return int(row[0]) if row else None
+
+    def save_update_offset(self, update_id):
+        with SHARDS[0].write() as conn:
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('update_offset', ?)", (str(update_id),))
+
+    def analytics_partitions(self):
+        return SHARDS
+
+    def load_analytics_rows(self, shard, since):
+        with shard.read() as conn:
+            # julianday(date) - 1721424.5 — тот же номер дня, что date.toordinal()
+            daily = conn.execute('''
+                SELECT ledger_id, CAST(julianday(date(timestamp)) - 1721424.5 AS INTEGER) AS day, SUM(amount)
+                FROM expenses
+                WHERE timestamp >= ?
+                GROUP BY ledger_id, day
+            ''', (since,)).fetchall()
+            purchases = conn.execute(
+                'SELECT ledger_id, category, amount FROM expenses WHERE timestamp >= ?', (since,)).fetchall()
+        return daily, purchases
+
+    def save_analytics(self, shard, insights, baselines):
+        with shard.write() as conn:
+            conn.execute('DELETE FROM user_insights')
+            conn.execute('DELETE FROM category_baselines')
+            conn.executemany('INSERT INTO user_insights VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', insights)
+            conn.executemany('INSERT INTO category_baselines VALUES (?, ?, ?, ?, ?)', baselines)
+
+    def get_insight(self, ledger_id):
+        with shard_for(ledger_id).read() as conn:
+            return conn.execute('''
+                SELECT as_of, month, month_spent, projected, mean_7d, mean_30d, day_total, day_z
+                FROM user_insights WHERE ledger_id = ?
+            ''', (ledger_id,)).fetchone()
+
+    def get_category_baseline(self, ledger_id, category):
+        with shard_for(ledger_id).read() as conn:
+            return conn.execute(
+                'SELECT median, mad, count FROM category_baselines WHERE ledger_id = ? AND category = ?',
+                (ledger_id, category)).fetchone()
+
+# Таблица для LIKE: SQLite без ICU игнорирует регистр только у ASCII
+_ASCII_LOWER = str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ', 'abcdefghijklmnopqrstuvwxyz')
+
+class MemoryStorage(Storage):
+    """Хранилище в памяти с той же семантикой, что у SQLiteStorage.
+    
+    На бюджет — отсортированный по (timestamp, id) список ключей расходов
+    и агрегаты по категориям, которые обновляются при каждой записи.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._users = {}
+        self._ledgers = {}             # ledger_id -> (name, owner_id, invite_code)
+        self._members = {}             # ledger_id -> {user_id: (joined_at, name, role)}
+        self._categories = {}          # ledger_id -> {category: usage_count}
+        self._expenses = {}            # id -> [id, ledger_id, amount, category, description, timestamp, user_id]
+        self._by_ledger = defaultdict(list)                              # ledger_id -> [(timestamp, id)]
+        self._totals = defaultdict(lambda: defaultdict(lambda: [0, 0]))  # ledger_id -> category -> [сумма, кол-во]
+        self._next_id = 1
+        self._insights = {}
+        self._baselines = {}
+        self._processed = {}           # update_id -> время отметки
+        self._update_offset = None
+        self._changes = []             # журнал изменений: строки как у get_changes, по возрастанию seq
+        self._change_seq = 0
+
+    @staticmethod
+    def _now():
+        return datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+
+    @staticmethod
+    def _row(expense):
+        return tuple(expense[:1]) + tuple(expense[2:])
+
+    def _log_change(self, ledger_id, expense_id):
+        """Записать в журнал текущую строку расхода или надгробие, если его больше нет"""
+        self._change_seq += 1
+        expense = self._expenses.get(expense_id)
+        if expense is None:
+            change = (self._change_seq, 'delete', expense_id, ledger_id, None, None, None, None, None)
+        else:
+            change = (self._change_seq, 'upsert', expense_id, ledger_id, expense[6]) + tuple(expense[2:6])
+        self._changes.append(change + (self._now(),))
+
+    def _add_to_totals(self, expense, sign):
+        totals = self._totals[expense[1]][expense[3]]
+        totals[0] += sign * expense[2]
+        totals[1] += sign
+        if not totals[1]:
+            del self._totals[expense[1]][expense[3]]
+
+    def save_user(self, user_id, username, first_name, timezone):
+        with self._lock:
+            if user_id not in self._users:
+                self._users[user_id] = {
+                    'username': username,
+                    'first_name': first_name,
+                    'timezone': timezone,
+                    'first_seen': self._now(),
+                    'ledger_id': None,
+                }
+
+    def get_user_timezone(self, user_id):
+        user = self._users.get(user_id)
+        return user['timezone'] if user else None
+
+    def update_user_timezone(self, user_id, timezone):
+        with self._lock:
+            if user_id in self._users:
+                self._users[user_id]['timezone'] = timezone
+
+    def get_active_ledger(self, user_id):
+        user = self._users.get(user_id)
+        return user['ledger_id'] if user and user['ledger_id'] is not None else user_id
+
+    def set_active_ledger(self, user_id, ledger_id):
+        with self._lock:
+            if user_id in self._users:
+                self._users[user_id]['ledger_id'] = None if ledger_id == user_id else ledger_id
+
+    def create_ledger(self, ledger_id, name, owner_id, owner_name, invite_code):
+        with self._lock:
+            if ledger_id in self._ledgers:
+                return False
+            self._ledgers[ledger_id] = (name, owner_id, invite_code)
+            self.add_ledger_member(ledger_id, owner_id, owner_name, 'owner')
+            return True
+
+    def get_ledger(self, ledger_id):
+        return self._ledgers.get(ledger_id)
+
+    def add_ledger_member(self, ledger_id, user_id, name, role='member'):
+        with self._lock:
+            self._members.setdefault(ledger_id, {}).setdefault(user_id, (self._now(), name, role))
+
+    def remove_ledger_member(self, ledger_id, user_id):
+        with self._lock:
+            self._members.get(ledger_id, {}).pop(user_id, None)
+
+    def get_ledger_members(self, ledger_id):
+        with self._lock:
+            members = sorted((joined_at, user_id, name, role)
+                             for user_id, (joined_at, name, role) in self._members.get(ledger_id, {}).items())
+        return [member[1:] for member in members]
+
+    def get_user_ledgers(self, user_id):
+        with self._lock:
+            rows = sorted((members[user_id][0], ledger_id, self._ledgers[ledger_id][0], members[user_id][2])
+                          for ledger_id, members in self._members.items()
+                          if user_id in members and ledger_id in self._ledgers)
+        return [row[1:] for row in rows]
+
+    def add_categories(self, ledger_id, categories):
+        with self._lock:
+            existing = self._categories.setdefault(ledger_id, {})
+            for category in categories:
+                existing.setdefault(category, 0)
+
+    def get_categories(self, ledger_id):
+        categories = self._categories.get(ledger_id, {})
+        return sorted(categories, key=lambda c: (-categories[c], c))
+
+    def increment_category_usage(self, ledger_id, category):
+        with self._lock:
+            categories = self._categories.get(ledger_id)
+            if categories is not None and category in categories:
+                categories[category] += 1
+
+    def add_expense(self, ledger_id, user_id, amount, category, description):
+        with self._lock:
+            expense_id = self._next_id
+            self._next_id += 1
+            timestamp = self._now()
+            expense = [expense_id, ledger_id, amount, category, description, timestamp, user_id]
+            self._expenses[expense_id] = expense
+            bisect.insort(self._by_ledger[ledger_id], (timestamp, expense_id))
+            self._add_to_totals(expense, 1)
+            self._log_change(ledger_id, expense_id)
+            self.increment_category_usage(ledger_id, category)
+            return expense_id
+
+    def _load(self, expense):
+        """Добавить готовую строку расхода (импорт из SQLite)"""
+        self._expenses[expense[0]] = expense
+        self._by_ledger[expense[1]].append((expense[5], expense[0]))
+        self._add_to_totals(expense, 1)
+        self._next_id = max(self._next_id, expense[0] + 1)
+
+    def load_from_sqlite(self, paths):
+        """Загрузить пользователей, бюджеты, категории и горячие расходы из файлов SQLite"""
+        with self._lock:
+            for path in paths:
+                conn = sqlite3.connect(path)
+                for user_id, username, first_name, timezone, ledger_id in conn.execute(
+                        'SELECT user_id, username, first_name, timezone, ledger_id FROM users'):
+                    self.save_user(user_id, username, first_name, timezone)
+                    self._users[user_id]['ledger_id'] = ledger_id
+                for ledger_id, name, owner_id, invite_code in conn.execute(
+                        'SELECT ledger_id, name, owner_id, invite_code FROM ledgers'):
+                    self._ledgers[ledger_id] = (name, owner_id, invite_code)
+                for ledger_id, user_id, name, role, joined_at in conn.execute(
+                        'SELECT ledger_id, user_id, name, role, joined_at FROM ledger_members'):
+                    self._members.setdefault(ledger_id, {})[user_id] = (joined_at, name, role)
+                for ledger_id, category, usage_count in conn.execute(
+                        'SELECT ledger_id, category, usage_count FROM ledger_categories'):
+                    self._categories.setdefault(ledger_id, {})[category] = usage_count
+                for row in conn.execute(
+                        'SELECT id, ledger_id, amount, category, description, timestamp, user_id FROM expenses'):
+                    self._load(list(row))
+                conn.close()
+            for keys in self._by_ledger.values():
+                keys.sort()
+
+    def _own(self, ledger_id, expense_id):
+        expense = self._expenses.get(expense_id)
+        return expense if expense is not None and expense[1] == ledger_id else None
+
+    def edit_expense(self, ledger_id, expense_id, amount=None, category=None, description=None):
+        with self._lock:
+            expense = self._own(ledger_id, expense_id)
+            if expense is None:
+                return
+            self._add_to_totals(expense, -1)
+            if amount is not None:
+                expense[2] = amount
+            if category is not None:
+                expense[3] = category
+            if description is not None:
+                expense[4] = description
+            self._add_to_totals(expense, 1)
+            if amount is not None or category is not None or description is not None:
+                self._log_change(ledger_id, expense_id)
+
+    def delete_expense(self, ledger_id, expense_id):
+        with self._lock:
+            expense = self._own(ledger_id, expense_id)
+            if expense is None:
+                return
+            self._add_to_totals(expense, -1)
+            keys = self._by_ledger[ledger_id]
+            del keys[bisect.bisect_left(keys, (expense[5], expense_id))]
+            del self._expenses[expense_id]
+            self._log_change(ledger_id, expense_id)
+
+    def restore_expense(self, ledger_id, expense):
+        with self._lock:
+            if expense[0] in self._expenses:
+                return
+            restored = [expense[0], ledger_id] + list(expense[1:])
+            self._expenses[expense[0]] = restored
+            bisect.insort(self._by_ledger[ledger_id], (restored[5], restored[0]))
+            self._add_to_totals(restored, 1)
+            self._log_change(ledger_id, restored[0])
+
+    def get_changes(self, cursor, limit):
+        # Шард один — нулевой
+        after = max([seq for seq in cursor if not seq >> SHARD_ID_BITS], default=0)
+        with self._lock:
+            start = bisect.bisect_right(self._changes, after, key=lambda change: change[0])
+            return self._changes[start:start + limit]
+
+    def compact_changes(self):
+        with self._lock:
+            latest = {change[2]: change[0] for change in self._changes}
+            kept = [change for change in self._changes if latest[change[2]] == change[0]]
+            removed = len(self._changes) - len(kept)
+            self._changes = kept
+        return removed
+
+    def get_expense(self, ledger_id, expense_id):
+        expense = self._own(ledger_id, expense_id)
+        return self._row(expense) if expense else None
+
+    def _newest_first(self, ledger_id):
+        with self._lock:
+            keys = list(self._by_ledger.get(ledger_id, ()))
+        for _, expense_id in reversed(keys):
+            expense = self._expenses.get(expense_id)
+            if expense is not None:
+                yield expense
+
+    def get_expenses(self, ledger_id, limit, offset=0):
+        with self._lock:
+            keys = self._by_ledger.get(ledger_id, [])
+            end = max(0, len(keys) - offset)
+            chosen = keys[max(0, end - limit):end]
+            return [self._row(self._expenses[expense_id]) for _, expense_id in reversed(chosen)]
+
+    def search_expenses(self, ledger_id, query, limit):
+        needle = query.translate(_ASCII_LOWER)
+        found = []
+        for expense in self._newest_first(ledger_id):
+            if needle in (expense[4] or '').translate(_ASCII_LOWER) or needle in (expense[3] or '').translate(_ASCII_LOWER):
+                found.append(self._row(expense))
+                if len(found) >= limit:
+                    break
+        return found
+
+    def get_expenses_between(self, ledger_id, start, end, category=None):
+        with self._lock:
+            keys = self._by_ledger.get(ledger_id, [])
+            # Ключи (timestamp, id): всё с timestamp в [start, end] лежит между этими границами
+            lo = bisect.bisect_left(keys, (start,))
+            hi = bisect.bisect_right(keys, (end, float('inf')))
+            rows = [self._expenses[expense_id] for _, expense_id in reversed(keys[lo:hi])]
+        return [self._row(e) for e in rows if category is None or e[3] == category]
+
+    def sum_between(self, ledger_id, start, end):
+        return sum(row[1] for row in self.get_expenses_between(ledger_id, start, end))
+
+    def member_totals(self, ledger_id, start, end):
+        totals = defaultdict(lambda: [0, 0])
+        for row in self.get_expenses_between(ledger_id, start, end):
+            totals[row[5]][0] += row[1]
+            totals[row[5]][1] += 1
+        return sorted(((user_id, s, n) for user_id, (s, n) in totals.items()), key=lambda x: -x[1])
+
+    def get_totals(self, ledger_id):
+        with self._lock:
+            totals = self._totals.get(ledger_id, {})
+            categories = sorted(((c, t[0], t[1]) for c, t in totals.items()), key=lambda x: -x[1])
+        return sum(c[1] for c in categories), categories
+
+    def get_category_totals(self, ledger_id, category):
+        with self._lock:
+            total, count = self._totals.get(ledger_id, {}).get(category, (0, 0))
+        return total, count
+
+    def get_global_stats(self):
+        with self._lock:
+            stats = {
+                'shard': 0,
+                'users': len(self._users),
+                'ledgers': len(self._ledgers),
+                'expenses': len(self._expenses),
+                'archived': 0,
+                'total': sum(e[2] for e in self._expenses.values()),
+                'size_mb': 0,
+            }
+        return dict(stats), [stats]
+
+    def processed_updates(self, update_ids):
+        return {update_id for update_id in update_ids if update_id in self._processed}
+
+    @contextmanager
+    def update_transaction(self, user_id, update_id):
+        # Транзакций нет, записи сразу видны: отмечаем до обработчика
+        with self._lock:
+            if update_id in self._processed:
+                raise DuplicateUpdate(update_id)
+            self._processed[update_id] = self._now()
+        yield
+
+    def flush_update_marks(self):
+        return 0
+
+    def prune_processed_updates(self, before):
+        with self._lock:
+            old = [update_id for update_id, at in self._processed.items() if at < before]
+            for update_id in old:
+                del self._processed[update_id]
+        return len(old)
+
+    def load_update_offset(self):
+        return self._update_offset
+
+    def save_update_offset(self, update_id):
+        self._update_offset = update_id
+
+    def analytics_partitions(self):
+        return [None]
+
+    def load_analytics_rows(self, partition, since):
+        daily = defaultdict(float)
+        purchases = []
+        with self._lock:
+            for _, ledger_id, amount, category, _, timestamp, _ in self._expenses.values():
+                if timestamp >= since:
+                    daily[ledger_id, datetime.strptime(timestamp[:10], '%Y-%m-%d').toordinal()] += amount
+                    purchases.append((ledger_id, category, amount))
+        return [(ledger_id, day, total) for (ledger_id, day), total in daily.items()], purchases
+
+    def save_analytics(self, partition, insights, baselines):
+        with self._lock:
+            self._insights = {row[0]: tuple(row[1:]) for row in insights}
+            self._baselines = {(row[0], row[1]): tuple(row[2:]) for row in baselines}
+
+    def get_insight(self, ledger_id):
+        return self._insights.get(ledger_id)
+
+    def get_category_baseline(self, ledger_id, category):
+        return self._baselines.get((ledger_id, category))
+
+storage = None
+
+# ===== ДОСТУП К ДАННЫМ =====
+
+# Уже сохранённые пользователи: save_user для них ничего не пишет и не берёт блокировку писателя
+_saved_users = set()
+SAVED_USERS_CACHE = int(os.getenv('SAVED_USERS_CACHE', '100000'))
+
+def save_user(user_id, username, first_name, timezone='UTC+3'):
+    """Сохранить пользователя"""
+    if user_id in _saved_users:
+        return
+    try:
+        # Чтение дешевле записи: запись внутри обработчика держит транзакцию апдейта до его конца
+        if storage.get_user_timezone(user_id) is None:
+            with defer_update_mark():
+                storage.save_user(user_id, username, first_name, timezone)
+        if len(_saved_users) >= SAVED_USERS_CACHE:
+            _saved_users.clear()
+        _saved_users.add(user_id)
+    except Exception as e:
+        logger.error(f"❌ Ошибка сохранения пользователя: {e}")
+
+# Активный бюджет пользователя: ID кладём в кэш, чтобы не читать users на каждый апдейт
+_active_ledgers = {}
+
+def active_ledger(user_id):
+    """Бюджет, с которым сейчас работает пользователь (личный — с ID, равным user_id)"""
+    ledger_id = _active_ledgers.get(user_id)
+    if ledger_id is not None:
+        return ledger_id
+    try:
+        ledger_id = storage.get_active_ledger(user_id)
+    except Exception as e:
+        logger.error(f"❌ Ошибка получения бюджета: {e}")
+        return user_id
+    if len(_active_ledgers) >= SAVED_USERS_CACHE:
+        _active_ledgers.clear()
+    _active_ledgers[user_id] = ledger_id
+    return ledger_id
+
+def get_user_timezone(user_id):
+    """Получить тайм-зону пользователя"""
+    try:
+        return storage.get_user_timezone(user_id) or 'UTC+3'
+    except Exception as e:
+        logger.error(f"❌ Ошибка получения тайм-зоны: {e}")
+        return 'UTC+3'
+
+def update_user_timezone(user_id, timezone):
+    """Обновить тайм-зону пользователя"""
+    try:
+        with defer_update_mark():
+            storage.update_user_timezone(user_id, timezone)
+        aggregates.forget(active_ledger(user_id))
+        return True
+    except Exception as e:
+        logger.error(f"❌ Ошибка обновления тайм-зоны: {e}")
+        return False
+
+def get_user_local_time(user_id):
+    """Получить текущее время пользователя"""
+    tz_str = get_user_timezone(user_id)
+    tz_name = TIMEZONES.get(tz_str, 'UTC')
+    tz = pytz.timezone(tz_name)
+    return datetime.now(tz)
+
+def initialize_user_categories(user_id):
+    """Инициализировать категории личного бюджета нового пользователя"""
+    try:
+        with defer_update_mark():
+            storage.add_categories(user_id, DEFAULT_CATEGORIES)
+        aggregates.forget(user_id)
+    except Exception as e:
+        logger.error(f"❌ Ошибка инициализации категорий: {e}")
+
+def get_user_categories_sorted(user_id):
+    """Получить отсортированные категории бюджета пользователя"""
+    try:
+        return storage.get_categories(active_ledger(user_id))
+    except Exception as e:
+        logger.error(f"❌ Ошибка получения категорий: {e}")
+        return DEFAULT_CATEGORIES
+
+def get_top_categories(user_id, limit=5):
+    """Получить топ категорий по использованию"""
+    categories = get_user_categories_sorted(user_id)
+    return categories[:limit]
+
+def get_common_categories(user_id):
+    """Получить оставшиеся категории (не в топ-5)"""
+    categories = get_user_categories_sorted(user_id)
+    return categories[5:] if len(categories) > 5 else []
+
+def add_category(user_id, category):
+    """Добавить новую категорию"""
+    try:
+        ledger_id = active_ledger(user_id)
+        with defer_update_mark():
+            storage.add_categories(ledger_id, [category.lower().capitalize()])
+        aggregates.forget(ledger_id)
+        return True
+    except Exception as e:
+        logger.error(f"❌ Ошибка добавления категории: {e}")
+        return False
+
+def increment_category_usage(user_id, category):
+    """Увеличить счётчик использования категории"""
+    try:
+        storage.increment_category_usage(active_ledger(user_id), category.lower().capitalize())
+    except Exception as e:
+        logger.error(f"❌ Ошибка обновления счётчика: {e}")
+
+def add_expense(user_id, amount, category, description):
+    """Добавить расход в бюджет пользователя"""
+    try:
+        category = category.lower().capitalize()
+        ledger_id = active_ledger(user_id)
+        version = aggregates.touch(ledger_id)
+        expense_id = storage.add_expense(ledger_id, user_id, amount, category, description)
+        suggester.learn(ledger_id, description, category)
+        aggregates.add(ledger_id, amount, category, version)
+        return expense_id
+    except Exception as e:
+        logger.error(f"❌ Ошибка добавления расхода: {e}")
+        return None
+
+def edit_expense(user_id, expense_id, amount=None, category=None, description=None, ledger_id=None):
+    """Редактировать расход (по умолчанию — в активном бюджете пользователя)"""
+    try:
+        if category is not None:
+            category = category.lower().capitalize()
+        if ledger_id is None:
+            ledger_id = active_ledger(user_id)
+        storage.edit_expense(ledger_id, expense_id, amount, category, description)
+        if category is not None or description is not None:
+            suggester.forget(ledger_id)
+        aggregates.forget(ledger_id)
+        return True
+    except Exception as e:
+        logger.error(f"❌ Ошибка редактирования расхода: {e}")
+        return False
+
+def delete_expense(user_id, expense_id):
+    """Удалить расход"""
+    try:
+        ledger_id = active_ledger(user_id)
+        storage.delete_expense(ledger_id, expense_id)
+        suggester.forget(ledger_id)
+        aggregates.forget(ledger_id)
+        return True
+    except Exception as e:
+        logger.error(f"❌ Ошибка удаления расхода: {e}")
+        return False
+
+def restore_expense(user_id, expense, ledger_id=None):
+    """Вернуть удалённый расход (по умолчанию — в активный бюджет пользователя)"""
+    try:
+        if ledger_id is None:
+            ledger_id = active_ledger(user_id)
+        storage.restore_expense(ledger_id, expense)
+        suggester.forget(ledger_id)
+        aggregates.forget(ledger_id)
+        return True
+    except Exception as e:
+        logger.error(f"❌ Ошибка восстановления расхода: {e}")
+        return False
+
+def get_expense(expense_id, user_id, ledger_id=None):
+    """Получить расход по ID (только из бюджета пользователя, по умолчанию — активного)"""
+    try:
+        return storage.get_expense(active_ledger(user_id) if ledger_id is None else ledger_id, expense_id)
+    except Exception as e:
+        logger.error(f"❌ Ошибка получения расхода: {e}")
+        return None
+
+def get_all_expenses(user_id, limit=20, offset=0):
+    """Получить расходы бюджета пользователя (новые сверху, максимум limit, начиная с offset)"""
+    try:
+        return storage.get_expenses(active_ledger(user_id), limit, offset)
+    except Exception as e:
+        logger.error(f"❌ Ошибка получения расходов: {e}")
+        return []
+
+def search_expenses(user_id, query, limit=20):
+    """Найти расходы по описанию или категории (новые сверху)"""
+    try:
+        return storage.search_expenses(active_ledger(user_id), query, limit)
+    except Exception as e:
+        logger.error(f"❌ Ошибка поиска расходов: {e}")
+        return []
+
+def _storage_bounds(start, end):
+    """Локальные границы -> строки в формате хранения (UTC, 'YYYY-MM-DD HH:MM:SS')"""
+    return (start.astimezone(pytz.utc).strftime('%Y-%m-%d %H:%M:%S'),
+            end.astimezone(pytz.utc).strftime('%Y-%m-%d %H:%M:%S'))
+
+def _today_bounds(user_id, now=None):
+    """Начало и конец текущего дня пользователя"""
+    now = now or get_user_local_time(user_id)
+    today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    today_end = now.replace(hour=23, minute=59, second=59, microsecond=999999)
+    return _storage_bounds(today_start, today_end)
+
+def _month_bounds(user_id, now=None):
+    """Начало месяца и конец текущего дня пользователя"""
+    now = now or get_user_local_time(user_id)
+    month_start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    month_end = now.replace(hour=23, minute=59, second=59, microsecond=999999)
+    return _storage_bounds(month_start, month_end)
+
+def get_today_expenses(user_id):
+    """Получить расходы за день (по времени пользователя)"""
+    try:
+        return storage.get_expenses_between(active_ledger(user_id), *_today_bounds(user_id))
+    except Exception as e:
+        logger.error(f"❌ Ошибка получения расходов за день: {e}")
+        return []
+
+def get_today_expenses_by_category(user_id, category):
+    """Получить расходы за день по категории"""
+    try:
+        category = category.lower().capitalize()
+        return storage.get_expenses_between(active_ledger(user_id), *_today_bounds(user_id), category=category)
     except Exception as e:
         logger.error(f"❌ Ошибка получения расходов: {e}")
         return []
@@ -378,24 +1719,7 @@ def get_today_expenses_by_category(user_id, category):
 def get_month_expenses(user_id):
     """Получить расходы за месяц"""
     try:
-        tz_str = get_user_timezone(user_id)
-        tz_name = TIMEZONES.get(tz_str, 'UTC')
-        tz = pytz.timezone(tz_name)
-        
-        now = datetime.now(tz)
-        month_start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-        month_end = now.replace(hour=23, minute=59, second=59, microsecond=999999)
-        
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT SUM(amount) FROM expenses
-            WHERE user_id = ? AND timestamp BETWEEN ? AND ?
-        ''', (user_id, month_start.isoformat(), month_end.isoformat()))
-        
-        result = cursor.fetchone()
-        conn.close()
-        return result[0] if result[0] else 0
+        return storage.sum_between(active_ledger(user_id), *_month_bounds(user_id))
     except Exception as e:
         logger.error(f"❌ Ошибка получения месячных расходов: {e}")
         return 0
@@ -403,53 +1727,1298 @@ def get_month_expenses(user_id):
 def get_stats(user_id):
     """Получить общую статистику"""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        cursor.execute('SELECT SUM(amount) FROM expenses WHERE user_id = ?', (user_id,))
-        total = cursor.fetchone()[0] or 0
-        
         month_total = get_month_expenses(user_id)
+        total, categories = storage.get_totals(active_ledger(user_id))
+        return total, month_total, categories
+    except Exception as e:
+        logger.error(f"❌ Ошибка получения статистики: {e}")
+        return 0, 0, []
+
+def get_stats_by_category(user_id, category):
+    """Получить статистику по категории"""
+    try:
+        total, count = storage.get_category_totals(active_ledger(user_id), category.lower().capitalize())
+        return {
+            'total': total,
+            'count': count,
+            'avg': total / count if count else 0
+        }
+    except Exception as e:
+        logger.error(f"❌ Ошибка получения статистики: {e}")
+        return {'total': 0, 'count': 0, 'avg': 0}
+
+def get_month_member_totals(user_id):
+    """Траты участников бюджета за месяц: [(user_id, сумма, количество)]"""
+    try:
+        return storage.member_totals(active_ledger(user_id), *_month_bounds(user_id))
+    except Exception as e:
+        logger.error(f"❌ Ошибка получения трат участников: {e}")
+        return []
+
+def get_global_stats():
+    """Сводка по всем шардам (параллельно) для админов"""
+    try:
+        return storage.get_global_stats()
+    except Exception as e:
+        logger.error(f"❌ Ошибка получения общей статистики: {e}")
+        return None, []
+
+# Таблицы, которые переезжают при перебалансировке, и ключ шардирования их строк:
+# данные бюджета живут в шарде бюджета, строки пользователя — в шарде пользователя
+SHARDED_TABLES = {
+    'users': 'user_id',
+    'processed_updates': 'user_id',
+    'expenses': 'ledger_id',
+    'expense_changes': 'ledger_id',
+    'ledger_categories': 'ledger_id',
+    'ledgers': 'ledger_id',
+    'ledger_members': 'ledger_id',
+    'expense_rollups': 'ledger_id',
+    'user_insights': 'ledger_id',
+    'category_baselines': 'ledger_id',
+}
+
+def _reseed_expense_ids(file_count, new_count):
+    """Выставить счётчики ID расходов после перебалансировки.
+    
+    Счётчик диапазона — не меньше всех его ID, в каком бы шарде они теперь ни лежали, и не меньше прежнего
+    счётчика. Счётчики убранных шардов сохраняются в meta нулевого: если шард вернётся, его ID не повторятся.
+    """
+    seqs = defaultdict(int)
+    for index in range(file_count):
+        conn = sqlite3.connect(shard_path(index))
+        for key, value in conn.execute("SELECT key, value FROM meta WHERE key LIKE 'expense_seq%'"):
+            owner = index if key == 'expense_seq' else int(key.rsplit('_', 1)[1])
+            seqs[owner] = max(seqs[owner], int(value))
+        for ids_index in range(file_count):
+            low, high = expense_id_range(ids_index)
+            top = conn.execute('SELECT MAX(id) FROM expenses WHERE id >= ? AND id < ?', (low, high)).fetchone()[0]
+            seqs[ids_index] = max(seqs[ids_index], top or 0)
+        conn.close()
+    
+    for index in range(new_count):
+        conn = sqlite3.connect(shard_path(index))
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('expense_seq', ?)",
+                     (max(seqs[index], expense_id_range(index)[0]),))
+        conn.commit()
+        conn.close()
+    conn = sqlite3.connect(shard_path(0))
+    for index in range(new_count, file_count):
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (f'expense_seq_{index}', seqs[index]))
+    conn.commit()
+    conn.close()
+
+def reshard(new_count, batch_keys=500):
+    """Перераспределить пользователей и бюджеты на new_count шардов (бот должен быть остановлен)"""
+    global SHARD_COUNT
+    # Без отметки в meta — БД ещё с тех времён, когда шард был один
+    old_count = _stored_shard_count() or 1
+    started = time.perf_counter()
+    moved = 0
+    
+    # Все шарды, старые и новые, со схемой
+    for index in range(max(old_count, new_count)):
+        conn = sqlite3.connect(shard_path(index))
+        _init_shard_schema(conn, index)
+        # Перенос идёт транзакциями на два файла, а атомарны они только с обычным журналом; WAL вернёт init_db
+        conn.execute('PRAGMA journal_mode = DELETE')
+        conn.close()
+    
+    for index in range(old_count):
+        conn = sqlite3.connect(shard_path(index), isolation_level=None, timeout=30)
+        cursor = conn.cursor()
+        # Ключи пользователей и бюджетов не пересекаются (у общих бюджетов ID отрицательные),
+        # а личный бюджет переезжает вместе с пользователем
+        cursor.execute(' UNION '.join(f'SELECT {key} FROM {table}' for table, key in SHARDED_TABLES.items()))
+        targets = defaultdict(list)
+        for (key,) in cursor.fetchall():
+            target = shard_index(key, new_count)
+            if key is not None and target != index:
+                targets[target].append((key,))
         
-        cursor.execute('''
-            SELECT category, SUM(amount) as sum_amount, COUNT(*) as count
-            FROM expenses
-            WHERE user_id = ?
-            GROUP BY category
-            ORDER BY sum_amount DESC
-        ''', (user_id,))
+        cursor.execute('CREATE TEMP TABLE IF NOT EXISTS reshard_keys (key INTEGER PRIMARY KEY)')
+        # Колонки перечисляем явно: в старых файлах колонки, добавленные миграциями, стоят в другом порядке
+        columns = {table: ', '.join(row[1] for row in cursor.execute(f'PRAGMA main.table_info({table})'))
+                   for table in SHARDED_TABLES}
+        for target, keys in targets.items():
+            cursor.execute('ATTACH DATABASE ? AS dst', (shard_path(target),))
+            try:
+                for i in range(0, len(keys), batch_keys):
+                    cursor.execute('BEGIN IMMEDIATE')
+                    try:
+                        cursor.execute('DELETE FROM temp.reshard_keys')
+                        cursor.executemany('INSERT INTO temp.reshard_keys (key) VALUES (?)', keys[i:i + batch_keys])
+                        in_batch = {table: f'{key} IN (SELECT key FROM temp.reshard_keys)'
+                                    for table, key in SHARDED_TABLES.items()}
+                        cursor.execute(f"INSERT OR IGNORE INTO dst.users ({columns['users']}) "
+                                       f"SELECT {columns['users']} FROM main.users WHERE {in_batch['users']}")
+                        cursor.execute(f"INSERT INTO dst.expenses ({columns['expenses']}) "
+                                       f"SELECT {columns['expenses']} FROM main.expenses WHERE {in_batch['expenses']}")
+                        # Журнал бюджета продолжается в новом шарде с новыми номерами (в диапазоне этого шарда)
+                        # и в прежнем порядке; потребитель получит перенесённые записи ещё раз
+                        cursor.execute(f"""
+                            INSERT INTO dst.expense_changes
+                                (op, expense_id, ledger_id, user_id, amount, category, description, timestamp, changed_at)
+                            SELECT op, expense_id, ledger_id, user_id, amount, category, description, timestamp, changed_at
+                            FROM main.expense_changes WHERE {in_batch['expense_changes']} ORDER BY seq
+                        """)
+                        cursor.execute(f"""
+                            INSERT OR IGNORE INTO dst.ledger_categories (ledger_id, category, usage_count, created_at)
+                            SELECT ledger_id, category, usage_count, created_at FROM main.ledger_categories
+                            WHERE {in_batch['ledger_categories']}
+                        """)
+                        cursor.execute(f"""
+                            INSERT INTO dst.expense_rollups (ledger_id, year, month, category, total, count)
+                            SELECT ledger_id, year, month, category, total, count FROM main.expense_rollups
+                            WHERE {in_batch['expense_rollups']}
+                            ON CONFLICT(ledger_id, year, month, category) DO UPDATE SET
+                                total = total + excluded.total,
+                                count = count + excluded.count
+                        """)
+                        for table in ('ledgers', 'ledger_members', 'user_insights', 'category_baselines',
+                                      'processed_updates'):
+                            cursor.execute(f'INSERT OR REPLACE INTO dst.{table} ({columns[table]}) '
+                                           f'SELECT {columns[table]} FROM main.{table} WHERE {in_batch[table]}')
+                        for table in SHARDED_TABLES:
+                            cursor.execute(f'DELETE FROM main.{table} WHERE {in_batch[table]}')
+                        cursor.execute('COMMIT')
+                    except Exception:
+                        cursor.execute('ROLLBACK')
+                        raise
+                    moved += len(keys[i:i + batch_keys])
+            finally:
+                cursor.execute('DETACH DATABASE dst')
+        conn.close()
+        logger.info(f"🔀 Шард {index}: перенесено пользователей и бюджетов {sum(len(k) for k in targets.values())}")
+    
+    _reseed_expense_ids(max(old_count, new_count), new_count)
+    
+    conn = sqlite3.connect(shard_path(0))
+    conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('shard_count', ?)", (str(new_count),))
+    conn.commit()
+    conn.close()
+    
+    # Лишние шарды теперь пусты (вместе с файлами WAL, если они остались)
+    for index in range(new_count, old_count):
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(shard_path(index) + suffix):
+                os.remove(shard_path(index) + suffix)
+    
+    SHARD_COUNT = new_count
+    logger.info(f"✅ Перебалансировка {old_count} → {new_count} шардов: {moved} ключей за {time.perf_counter() - started:.1f}с")
+    return moved
+
+# ===== ОБЩИЕ БЮДЖЕТЫ =====
+# Личный бюджет есть у каждого, его ID равен user_id. Общий получает случайный отрицательный ID
+# (не пересекается с ID пользователей) и живёт со всеми расходами в шарде своего ID
+LEDGER_ID_BITS = 40
+LEDGER_NAME_MAX = 40
+
+def ledger_invite(ledger_id, invite_code):
+    """Код приглашения: по нему находится шард бюджета"""
+    return f"{-ledger_id}-{invite_code}"
+
+def _switch_ledger(user_id, ledger_id):
+    storage.set_active_ledger(user_id, ledger_id)
+    _active_ledgers[user_id] = ledger_id
+
+def create_ledger(user_id, first_name, name):
+    """Создать общий бюджет и переключить на него создателя; вернуть ID или None"""
+    try:
+        for _ in range(3):
+            ledger_id = -secrets.randbelow(1 << LEDGER_ID_BITS) - 1
+            # Отметка апдейта ляжет в последнюю запись — переключение на бюджет
+            with defer_update_mark():
+                created = storage.create_ledger(ledger_id, name[:LEDGER_NAME_MAX], user_id, first_name,
+                                                secrets.token_hex(4))
+                if created:
+                    storage.add_categories(ledger_id, DEFAULT_CATEGORIES)
+            if created:
+                _switch_ledger(user_id, ledger_id)
+                return ledger_id
+        return None
+    except Exception as e:
+        logger.error(f"❌ Ошибка создания бюджета: {e}")
+        return None
+
+def join_ledger(user_id, first_name, code):
+    """Вступить в общий бюджет по коду приглашения и переключиться на него; вернуть название или None"""
+    ledger_ref, _, invite_code = code.strip().partition('-')
+    if not ledger_ref.isdigit():
+        return None
+    ledger_id = -int(ledger_ref)
+    try:
+        ledger = storage.get_ledger(ledger_id)
+        if ledger is None or not secrets.compare_digest(ledger[2], invite_code):
+            return None
+        with defer_update_mark():
+            storage.add_ledger_member(ledger_id, user_id, first_name)
+        _switch_ledger(user_id, ledger_id)
+        return ledger[0]
+    except Exception as e:
+        logger.error(f"❌ Ошибка вступления в бюджет: {e}")
+        return None
+
+def leave_ledger(user_id):
+    """Выйти из текущего общего бюджета и вернуться в личный (расходы остаются в бюджете)"""
+    ledger_id = active_ledger(user_id)
+    if ledger_id == user_id:
+        return False
+    try:
+        with defer_update_mark():
+            storage.remove_ledger_member(ledger_id, user_id)
+        _switch_ledger(user_id, user_id)
+        return True
+    except Exception as e:
+        logger.error(f"❌ Ошибка выхода из бюджета: {e}")
+        return False
+
+def switch_ledger(user_id, ledger_id):
+    """Переключиться на личный бюджет или общий, где пользователь участник"""
+    try:
+        if ledger_id != user_id and user_id not in {m[0] for m in storage.get_ledger_members(ledger_id)}:
+            return False
+        _switch_ledger(user_id, ledger_id)
+        return True
+    except Exception as e:
+        logger.error(f"❌ Ошибка переключения бюджета: {e}")
+        return False
+
+def get_user_ledgers(user_id):
+    """Бюджеты пользователя [(ledger_id, название, роль)]: личный первым"""
+    try:
+        return [(user_id, 'Личный', 'owner')] + storage.get_user_ledgers(user_id)
+    except Exception as e:
+        logger.error(f"❌ Ошибка получения бюджетов: {e}")
+        return [(user_id, 'Личный', 'owner')]
+
+def get_current_ledger(user_id):
+    """(ledger_id, название, код приглашения) текущего бюджета; у личного кода нет"""
+    ledger_id = active_ledger(user_id)
+    if ledger_id != user_id:
+        try:
+            ledger = storage.get_ledger(ledger_id)
+            if ledger:
+                return ledger_id, ledger[0], ledger_invite(ledger_id, ledger[2])
+        except Exception as e:
+            logger.error(f"❌ Ошибка получения бюджета: {e}")
+    return ledger_id, 'Личный', None
+
+def ledger_member_names(user_id):
+    """{user_id: имя} участников текущего общего бюджета; для личного — пусто"""
+    ledger_id = active_ledger(user_id)
+    if ledger_id == user_id:
+        return {}
+    try:
+        return {member_id: name for member_id, name, _ in storage.get_ledger_members(ledger_id)}
+    except Exception as e:
+        logger.error(f"❌ Ошибка получения участников: {e}")
+        return {}
+
+# ===== ПОДСКАЗКА КАТЕГОРИЙ =====
+# Индекс токен описания -> категория строится по последним SUGGEST_HISTORY расходам бюджета (всех участников)
+SUGGEST_HISTORY = int(os.getenv('SUGGEST_HISTORY', '2000'))
+SUGGEST_MAX_USERS = int(os.getenv('SUGGEST_MAX_USERS', '5000'))
+SUGGEST_IDLE_SECONDS = int(os.getenv('SUGGEST_IDLE_SECONDS', '3600'))
+SUGGEST_MAX_TOKENS = int(os.getenv('SUGGEST_MAX_TOKENS', '500'))
+# Автовыбор, только если категория набрала такую долю голосов и встречалась хотя бы SUGGEST_MIN_HITS раз
+SUGGEST_MIN_SHARE = float(os.getenv('SUGGEST_MIN_SHARE', '0.75'))
+SUGGEST_MIN_HITS = int(os.getenv('SUGGEST_MIN_HITS', '2'))
+# Русские слова сильно склоняются: «продукты»/«продуктов» сводим к общему префиксу
+SUGGEST_PREFIX = 6
+
+_TOKEN_RE = re.compile(r'[^\W\d_]{2,}')
+
+def description_tokens(text):
+    """Токены описания: слова без цифр, в нижнем регистре, обрезанные до префикса"""
+    return {word[:SUGGEST_PREFIX] for word in _TOKEN_RE.findall((text or '').lower())}
+
+class UserTokenIndex:
+    """Частоты токен -> категория одного пользователя.
+    
+    Категории хранятся один раз в списке, в индексе — их номера: {токен: {номер: счётчик}}.
+    """
+    __slots__ = ('categories', 'category_ids', 'tokens', 'last_used')
+
+    def __init__(self):
+        self.categories = []
+        self.category_ids = {}
+        self.tokens = {}
+        self.last_used = time.monotonic()
+
+    def learn(self, description, category):
+        category_id = self.category_ids.get(category)
+        if category_id is None:
+            category_id = self.category_ids[category] = len(self.categories)
+            self.categories.append(category)
+        for token in description_tokens(description):
+            counts = self.tokens.setdefault(token, {})
+            counts[category_id] = counts.get(category_id, 0) + 1
+        if len(self.tokens) > SUGGEST_MAX_TOKENS:
+            # Выкидываем самые редкие токены, пока не влезем с запасом
+            by_weight = sorted(self.tokens, key=lambda t: sum(self.tokens[t].values()))
+            for token in by_weight[:len(self.tokens) - SUGGEST_MAX_TOKENS * 3 // 4]:
+                del self.tokens[token]
+
+    def rank(self, text):
+        """[(категория, доля голосов, число совпадений)] по убыванию доли"""
+        scores = defaultdict(float)
+        hits = defaultdict(int)
+        for token in description_tokens(text):
+            counts = self.tokens.get(token)
+            if not counts:
+                continue
+            # Каждый токен голосует единицей, распределённой по его категориям
+            total = sum(counts.values())
+            for category_id, count in counts.items():
+                scores[category_id] += count / total
+                hits[category_id] += count
+        votes = sum(scores.values())
+        ranked = sorted(scores, key=lambda c: -scores[c])
+        return [(self.categories[c], scores[c] / votes, hits[c]) for c in ranked]
+
+class CategorySuggester:
+    """Индексы подсказок для активных бюджетов с вытеснением неактивных (LRU + простой)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ledgers = OrderedDict()
+
+    def _evict(self):
+        deadline = time.monotonic() - SUGGEST_IDLE_SECONDS
+        while self._ledgers:
+            ledger_id, index = next(iter(self._ledgers.items()))
+            if len(self._ledgers) <= SUGGEST_MAX_USERS and index.last_used >= deadline:
+                break
+            del self._ledgers[ledger_id]
+
+    def _index(self, ledger_id):
+        with self._lock:
+            index = self._ledgers.get(ledger_id)
+            if index is not None:
+                index.last_used = time.monotonic()
+                self._ledgers.move_to_end(ledger_id)
+                return index
+
+        # Строим вне блокировки: чтение истории не должно тормозить другие бюджеты
+        index = UserTokenIndex()
+        for row in reversed(storage.get_expenses(ledger_id, SUGGEST_HISTORY)):
+            index.learn(row[3], row[2])
+
+        with self._lock:
+            # Пока строили, индекс мог появиться в другом потоке — берём тот, он свежее
+            index = self._ledgers.setdefault(ledger_id, index)
+            self._ledgers.move_to_end(ledger_id)
+            self._evict()
+            return index
+
+    def learn(self, ledger_id, description, category):
+        """Учесть новый расход (если индекс бюджета ещё не построен, он прочтёт его из БД)"""
+        with self._lock:
+            index = self._ledgers.get(ledger_id)
+            if index is not None:
+                index.learn(description, category)
+
+    def forget(self, ledger_id):
+        """Сбросить индекс после правки или удаления — перестроится при следующем запросе"""
+        with self._lock:
+            self._ledgers.pop(ledger_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._ledgers.clear()
+
+    def rank(self, ledger_id, text):
+        index = self._index(ledger_id)
+        with self._lock:
+            return index.rank(text)
+
+    def suggest(self, ledger_id, text):
+        """Категория для автовыбора или None, если уверенности мало"""
+        ranked = self.rank(ledger_id, text)
+        if ranked:
+            category, share, hits = ranked[0]
+            if share >= SUGGEST_MIN_SHARE and hits >= SUGGEST_MIN_HITS:
+                return category
+        return None
+
+    def stats(self):
+        with self._lock:
+            return {
+                'ledgers': len(self._ledgers),
+                'tokens': sum(len(index.tokens) for index in self._ledgers.values()),
+            }
+
+suggester = CategorySuggester()
+
+def suggest_categories(user_id, text, limit=3):
+    """Категории, которые подходят к описанию, лучшие первыми"""
+    try:
+        return [category for category, _, _ in suggester.rank(active_ledger(user_id), text)[:limit]]
+    except Exception as e:
+        logger.error(f"❌ Ошибка подсказки категорий: {e}")
+        return []
+
+def auto_category(user_id, text):
+    """Категория, которую можно выбрать без вопроса, или None"""
+    try:
+        return suggester.suggest(active_ledger(user_id), text)
+    except Exception as e:
+        logger.error(f"❌ Ошибка подсказки категорий: {e}")
+        return None
+
+# ===== КЭШ СВОДОК =====
+# Итоги бюджета за день и месяц по категориям для инлайн-режима: строятся один раз за день, дальше обновляются при записи
+AGGREGATE_MAX_USERS = int(os.getenv('AGGREGATE_MAX_USERS', '5000'))
+
+class AggregateCache:
+    """Сводки бюджетов (LRU) с инкрементальным обновлением при добавлении расхода.
+    
+    Сводка строится на пару (бюджет, участник): «сегодня» у участников из разных тайм-зон разное,
+    а новый расход обновляет сводки всех участников бюджета.
+    
+    Версия бюджета — отметка его последнего изменения (растущий счётчик). Сводка помнит версию, с которой
+    её начали собирать: сборку, во время которой бюджет изменился, не кэшируем, а add() прибавляет расход
+    только к сводкам, собранным до него.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()      # (ledger_id, user_id) -> сводка
+        self._members = defaultdict(set)   # ledger_id -> user_id, для которых сводка построена
+        self._building = defaultdict(int)  # ledger_id -> сколько сводок сейчас собирается
+        self._clock = 0                    # последняя выданная отметка изменения
+        # ledger_id -> отметка последнего изменения; нужна, только пока у бюджета есть сводки или сборки
+        self._versions = {}
+
+    def _bump(self, ledger_id):
+        self._clock += 1
+        if ledger_id in self._members or ledger_id in self._building:
+            self._versions[ledger_id] = self._clock
+        return self._clock
+
+    def _end_build(self, ledger_id):
+        self._building[ledger_id] -= 1
+        if not self._building[ledger_id]:
+            del self._building[ledger_id]
+
+    def _release(self, ledger_id):
+        if ledger_id not in self._members and ledger_id not in self._building:
+            self._versions.pop(ledger_id, None)
+
+    def _build(self, ledger_id, user_id):
+        tz = pytz.timezone(TIMEZONES.get(get_user_timezone(user_id), 'UTC'))
+        now = datetime.now(tz)
+        today_start = _today_bounds(user_id, now)[0]
+        today_total = 0
+        by_category = defaultdict(float)
+        for _, amount, category, _, timestamp, _ in storage.get_expenses_between(ledger_id, *_month_bounds(user_id, now)):
+            by_category[category] += amount
+            if timestamp >= today_start:
+                today_total += amount
+        return {
+            'tz': tz,
+            'day': now.date(),
+            'today': today_total,
+            'month': dict(by_category),
+            'categories': get_user_categories_sorted(user_id),
+        }
+
+    def _drop(self, key):
+        del self._entries[key]
+        members = self._members[key[0]]
+        members.discard(key[1])
+        if not members:
+            del self._members[key[0]]
+            self._release(key[0])
+
+    def get(self, user_id, attempts=3):
+        """Сводка бюджета пользователя; пересчитывается только при смене дня или после сброса"""
+        key = (active_ledger(user_id), user_id)
+        for _ in range(attempts):
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None and datetime.now(entry['tz']).date() == entry['day']:
+                    self._entries.move_to_end(key)
+                    return entry
+                # Неотслеживаемый бюджет получает текущую отметку: touch() до этого момента уже в прошлом
+                version = self._versions.setdefault(key[0], self._clock)
+                self._building[key[0]] += 1
+            
+            try:
+                entry = self._build(*key)
+            except BaseException:
+                with self._lock:
+                    self._end_build(key[0])
+                    self._release(key[0])
+                raise
+            with self._lock:
+                self._end_build(key[0])
+                # Расход, добавленный во время сборки, мог в неё не попасть — тогда собираем заново
+                if self._versions.get(key[0]) != version:
+                    self._release(key[0])
+                    continue
+                entry['version'] = version
+                self._entries[key] = entry
+                self._entries.move_to_end(key)
+                self._members[key[0]].add(key[1])
+                while len(self._entries) > AGGREGATE_MAX_USERS:
+                    self._drop(next(iter(self._entries)))
+            return entry
+        # Бюджет меняется быстрее, чем собирается сводка: отдаём последнюю без кэширования
+        return entry
+
+    def touch(self, ledger_id):
+        """Бюджет сейчас изменится: вызвать до записи, отметку передать в add()"""
+        with self._lock:
+            return self._bump(ledger_id)
+
+    def add(self, ledger_id, amount, category, version):
+        """Учесть только что добавленный в бюджет расход (version — отметка touch() до записи)"""
+        with self._lock:
+            for user_id in list(self._members.get(ledger_id, ())):
+                key = (ledger_id, user_id)
+                entry = self._entries[key]
+                # Сводка, собранная после touch(), могла уже увидеть этот расход
+                if entry['version'] >= version or datetime.now(entry['tz']).date() != entry['day']:
+                    self._drop(key)
+                    continue
+                entry['today'] += amount
+                entry['month'][category] = entry['month'].get(category, 0) + amount
+
+    def forget(self, ledger_id):
+        with self._lock:
+            self._bump(ledger_id)
+            for user_id in list(self._members.get(ledger_id, ())):
+                self._drop((ledger_id, user_id))
+
+    def clear(self):
+        with self._lock:
+            self._clock += 1
+            # Идущие сборки должны увидеть сброс, остальные версии больше не нужны
+            self._versions = {ledger_id: self._clock for ledger_id in self._building}
+            self._entries.clear()
+            self._members.clear()
+
+aggregates = AggregateCache()
+
+# ===== АРХИВ =====
+
+def _archive_path(year):
+    """Путь к годовому архиву"""
+    return os.path.join(ARCHIVE_DIR, f'expenses_{year}.db')
+
+def _init_archive_schema(cursor, schema):
+    """Таблица расходов годового архива (старые архивы доводятся до схемы с бюджетами)"""
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS {schema}.expenses (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER,
+            amount REAL,
+            category TEXT,
+            description TEXT,
+            timestamp TIMESTAMP,
+            ledger_id INTEGER
+        )
+    ''')
+    if 'ledger_id' not in _columns(cursor, 'expenses', schema):
+        cursor.execute(f'ALTER TABLE {schema}.expenses ADD COLUMN ledger_id INTEGER')
+        cursor.execute(f'UPDATE {schema}.expenses SET ledger_id = user_id')
+    cursor.execute(f'DROP INDEX IF EXISTS {schema}.idx_expenses_user_time')
+    cursor.execute(f'CREATE INDEX IF NOT EXISTS {schema}.idx_expenses_ledger_time ON expenses(ledger_id, timestamp)')
+
+def _migrate_archives():
+    """Довести схему всех годовых архивов до текущей"""
+    for name in _archive_files():
+        conn = sqlite3.connect(os.path.join(ARCHIVE_DIR, name))
+        _init_archive_schema(conn.cursor(), 'main')
+        conn.commit()
+        conn.close()
+
+def _read_archive(conn, ledger_id, limit, offset, extra_where='', extra_params=()):
+    """Дочитать расходы бюджета из годовых архивов, подключая только нужные годы"""
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT year, SUM(count)
+        FROM expense_rollups
+        WHERE ledger_id = ?
+        GROUP BY year
+        ORDER BY year DESC
+    ''', (ledger_id,))
+
+    rows = []
+    for year, count in cursor.fetchall():
+        if len(rows) >= limit:
+            break
+        # Целый год можно пропустить по сводке, не открывая файл
+        if not extra_where and offset >= count:
+            offset -= count
+            continue
+        path = _archive_path(year)
+        if not os.path.exists(path):
+            continue
+
+        cursor.execute('ATTACH DATABASE ? AS cold', (path,))
+        try:
+            cursor.execute(f'''
+                SELECT id, amount, category, description, timestamp, user_id
+                FROM cold.expenses
+                WHERE ledger_id = ? {extra_where}
+                ORDER BY timestamp DESC
+                LIMIT ? OFFSET ?
+            ''', (ledger_id, *extra_params, limit - len(rows), offset))
+            rows += cursor.fetchall()
+        finally:
+            cursor.execute('DETACH DATABASE cold')
+        offset = 0
+
+    return rows
+
+# Архивация и снимок не идут одновременно: иначе перенесённый между копированием шарда
+# и архива расход попал бы в снимок дважды или не попал бы вовсе
+_archive_lock = threading.Lock()
+
+def archive_old_expenses(max_age_days=None, batch_size=None):
+    """Перенести расходы старше max_age_days в годовые архивы, оставив сводки"""
+    # Текущий и прошлый месяц всегда остаются в горячей БД
+    max_age_days = max(62, max_age_days or ARCHIVE_AFTER_DAYS)
+    batch_size = batch_size or ARCHIVE_BATCH_SIZE
+    cutoff = (datetime.utcnow() - timedelta(days=max_age_days)).strftime('%Y-%m-%d %H:%M:%S')
+    # Годовые архивы общие для всех шардов (ID расходов уникальны), поэтому шарды по очереди
+    with _archive_lock:
+        return sum(_archive_shard(shard, cutoff, batch_size) for shard in SHARDS)
+
+def vacuum_shards():
+    """Включить auto_vacuum = INCREMENTAL и сжать файлы шардов полным VACUUM (бот должен быть остановлен)"""
+    for index in range(_stored_shard_count() or 1):
+        path = shard_path(index)
+        started = time.perf_counter()
+        size = os.path.getsize(path)
+        conn = sqlite3.connect(path, isolation_level=None, timeout=30)
+        try:
+            conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            conn.execute('VACUUM')
+        finally:
+            conn.close()
+        logger.info(f"🗜️ Шард {index}: {size / 2**20:.1f} → {os.path.getsize(path) / 2**20:.1f} МБ "
+                    f"за {time.perf_counter() - started:.1f}с")
+
+def _archive_files():
+    """Имена файлов годовых архивов"""
+    if not os.path.isdir(ARCHIVE_DIR):
+        return []
+    return sorted(name for name in os.listdir(ARCHIVE_DIR) if name.startswith('expenses_') and name.endswith('.db'))
+
+def _archive_shard(shard, cutoff, batch_size):
+    """Архивация одного шарда"""
+    started = time.perf_counter()
+    moved = 0
+
+    try:
+        os.makedirs(ARCHIVE_DIR, exist_ok=True)
+        # Транзакции управляем сами: ATTACH нельзя делать внутри транзакции
+        conn = sqlite3.connect(shard.path, isolation_level=None, timeout=30)
+        cursor = conn.cursor()
+        cursor.execute('CREATE TEMP TABLE IF NOT EXISTS archive_batch (id INTEGER PRIMARY KEY)')
+
+        while True:
+            cursor.execute('''
+                SELECT id, substr(timestamp, 1, 4)
+                FROM expenses
+                WHERE timestamp < ?
+                ORDER BY timestamp
+                LIMIT ?
+            ''', (cutoff, batch_size))
+            batch = cursor.fetchall()
+            if not batch:
+                break
+
+            for year in sorted({year for _, year in batch}):
+                ids = [(expense_id,) for expense_id, y in batch if y == year]
+                cursor.execute('ATTACH DATABASE ? AS cold', (_archive_path(year),))
+                try:
+                    _init_archive_schema(cursor, 'cold')
+                    cursor.execute('DELETE FROM temp.archive_batch')
+                    cursor.executemany('INSERT INTO temp.archive_batch (id) VALUES (?)', ids)
+                    # При WAL транзакция на два файла не атомарна: сначала фиксируем копию в архиве, потом
+                    # удаляем из шарда. Упав между ними, строки останутся и там и там — следующий запуск
+                    # перезапишет копию и доведёт перенос. Писатели бота тем временем строки не меняют
+                    with shard.exclusive():
+                        cursor.execute('BEGIN IMMEDIATE')
+                        try:
+                            cursor.execute('''
+                                INSERT OR REPLACE INTO cold.expenses (id, ledger_id, user_id, amount, category, description, timestamp)
+                                SELECT id, ledger_id, user_id, amount, category, description, timestamp
+                                FROM main.expenses
+                                WHERE id IN (SELECT id FROM temp.archive_batch)
+                            ''')
+                            cursor.execute('COMMIT')
+                        except Exception:
+                            cursor.execute('ROLLBACK')
+                            raise
+
+                        cursor.execute('BEGIN IMMEDIATE')
+                        try:
+                            cursor.execute('''
+                                INSERT INTO main.expense_rollups (ledger_id, year, month, category, total, count)
+                                SELECT ledger_id, substr(timestamp, 1, 4), substr(timestamp, 6, 2), category, SUM(amount), COUNT(*)
+                                FROM main.expenses
+                                WHERE id IN (SELECT id FROM temp.archive_batch)
+                                GROUP BY ledger_id, substr(timestamp, 1, 4), substr(timestamp, 6, 2), category
+                                ON CONFLICT(ledger_id, year, month, category) DO UPDATE SET
+                                    total = total + excluded.total,
+                                    count = count + excluded.count
+                            ''')
+                            cursor.execute('DELETE FROM main.expenses WHERE id IN (SELECT id FROM temp.archive_batch)')
+                            cursor.execute('COMMIT')
+                        except Exception:
+                            cursor.execute('ROLLBACK')
+                            raise
+                finally:
+                    cursor.execute('DETACH DATABASE cold')
+                moved += len(ids)
+
+            # Пауза между пачками, чтобы не держать писателей бота
+            time.sleep(0.05)
+
+        cursor.execute('PRAGMA incremental_vacuum')
+        conn.close()
+        logger.info(f"🗄️ Шард {shard.index}: в архив перенесено {moved} расходов за {time.perf_counter() - started:.1f}с")
+    except Exception as e:
+        logger.error(f"❌ Ошибка архивации: {e}")
+    return moved
+
+def run_periodically(func, interval, first_run=60):
+    """Запускать func раз в interval секунд в фоновом потоке"""
+    def run():
+        try:
+            func()
+        except Exception as e:
+            logger.error(f"❌ Ошибка фоновой задачи {func.__name__}: {e}")
+        schedule(interval)
+
+    def schedule(delay):
+        timer = threading.Timer(delay, run)
+        timer.daemon = True
+        timer.start()
+
+    schedule(first_run)
+
+# ===== ЖУРНАЛ ИЗМЕНЕНИЙ =====
+# Выгрузка в хранилище аналитики читает только изменения после своего курсора, а не таблицу целиком.
+# Сжатие оставляет по расходу последнюю запись (надгробия тоже — они короткие), поэтому любой курсор
+# остаётся верным, а чтение с начала даёт текущий снимок (с архивными расходами — их журнал один раз
+# дописывает при старте). Архивация и перебалансировка расходы не меняют и в журнал не пишут;
+# восстановление из снимка дописывает разницу между прежними и восстановленными расходами
+CHANGES_BATCH = int(os.getenv('CHANGES_BATCH', '1000'))
+
+CHANGE_FIELDS = ('seq', 'op', 'id', 'ledger_id', 'user_id', 'amount', 'category', 'description', 'timestamp',
+                 'changed_at')
+EXPENSE_COLUMNS = 'id, ledger_id, user_id, amount, category, description, timestamp'
+
+def _backfill_archived_changes():
+    """Один раз на шард дописать в журнал расходы его бюджетов из годовых архивов.
+    
+    Журнал заполнялся только горячими расходами; архивные не меняются, поэтому порядок для них не важен.
+    """
+    for shard in SHARDS:
+        conn = sqlite3.connect(shard.path)
+        if not conn.execute("SELECT 1 FROM meta WHERE key = 'changes_archive_backfill'").fetchone():
+            conn.create_function('shard_index', 1, shard_index)
+            added = 0
+            for name in _archive_files():
+                conn.execute('ATTACH DATABASE ? AS cold', (os.path.join(ARCHIVE_DIR, name),))
+                added += conn.execute(f'''
+                    INSERT INTO expense_changes (op, expense_id, ledger_id, user_id, amount, category, description, timestamp)
+                    SELECT 'upsert', {EXPENSE_COLUMNS} FROM cold.expenses
+                    WHERE shard_index(ledger_id) = ? ORDER BY id
+                ''', (shard.index,)).rowcount
+                conn.commit()
+                conn.execute('DETACH DATABASE cold')
+            conn.execute("INSERT INTO meta (key, value) VALUES ('changes_archive_backfill', '1')")
+            conn.commit()
+            if added:
+                logger.info(f"📜 Шард {shard.index}: в журнал изменений добавлено архивных расходов {added}")
+        conn.close()
+
+def _collect_expenses(path, side, files):
+    """Сложить расходы (горячие и архивные) из files в таблицу side файла path — для сверки при восстановлении"""
+    conn = sqlite3.connect(path)
+    conn.execute(f'CREATE TABLE IF NOT EXISTS {side} '
+                 f'(id INTEGER PRIMARY KEY, ledger_id, user_id, amount, category, description, timestamp)')
+    for f in files:
+        conn.execute('ATTACH DATABASE ? AS src', (f,))
+        conn.execute(f'INSERT OR IGNORE INTO {side} SELECT {EXPENSE_COLUMNS} FROM src.expenses')
+        conn.commit()
+        conn.execute('DETACH DATABASE src')
+    conn.close()
+
+def _changes_heads():
+    """Последний выданный seq журнала каждого шарда"""
+    heads = {}
+    for shard in SHARDS:
+        conn = sqlite3.connect(shard.path)
+        heads[shard.index] = max(
+            conn.execute('SELECT COALESCE(MAX(seq), 0) FROM expense_changes').fetchone()[0],
+            conn.execute("SELECT COALESCE(MAX(seq), 0) FROM sqlite_sequence WHERE name = 'expense_changes'").fetchone()[0])
+        conn.close()
+    return heads
+
+def _log_restore_changes(diff_path, heads):
+    """После восстановления продолжить журнал с прежних номеров и дописать разницу расходов.
+    
+    Снимок откатывает и журнал: без этого новые изменения получили бы уже выданные потребителям seq.
+    diff_path — таблицы live (до восстановления) и snap (снимок), heads — результат _changes_heads().
+    """
+    for shard in SHARDS:
+        conn = sqlite3.connect(shard.path, timeout=30)
+        conn.create_function('shard_index', 1, shard_index)
+        conn.execute('ATTACH DATABASE ? AS diff', (diff_path,))
+        conn.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'expense_changes'", (heads[shard.index],))
+        conn.execute('''
+            INSERT INTO sqlite_sequence (name, seq)
+            SELECT 'expense_changes', ? WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = 'expense_changes')
+        ''', (heads[shard.index],))
+        conn.execute(f'''
+            INSERT INTO expense_changes (op, expense_id, ledger_id, user_id, amount, category, description, timestamp)
+            SELECT 'upsert', s.id, s.ledger_id, s.user_id, s.amount, s.category, s.description, s.timestamp
+            FROM diff.snap s LEFT JOIN diff.live l ON l.id = s.id
+            WHERE shard_index(s.ledger_id) = ?
+              AND (l.id IS NULL OR l.ledger_id IS NOT s.ledger_id OR l.user_id IS NOT s.user_id
+                   OR l.amount IS NOT s.amount OR l.category IS NOT s.category
+                   OR l.description IS NOT s.description OR l.timestamp IS NOT s.timestamp)
+            ORDER BY s.id
+        ''', (shard.index,))
+        conn.execute('''
+            INSERT INTO expense_changes (op, expense_id, ledger_id)
+            SELECT 'delete', id, ledger_id FROM diff.live
+            WHERE shard_index(ledger_id) = ? AND id NOT IN (SELECT id FROM diff.snap)
+            ORDER BY id
+        ''', (shard.index,))
+        conn.commit()
+        conn.execute('DETACH DATABASE diff')
+        conn.close()
+
+def pull_changes(cursor=(), limit=None):
+    """Следующая пачка изменений после курсора: (записи, новый курсор).
+
+    Курсор — список последних прочитанных seq, по одному на шард; пустой — читать журнал с начала.
+    """
+    changes = storage.get_changes(list(cursor), limit or CHANGES_BATCH)
+    after = {seq >> SHARD_ID_BITS: seq for seq in cursor}
+    for change in changes:
+        after[change[0] >> SHARD_ID_BITS] = max(after.get(change[0] >> SHARD_ID_BITS, 0), change[0])
+    return changes, sorted(after.values())
+
+def stream_changes(cursor=(), out=sys.stdout, limit=None):
+    """Выгрузить все изменения после курсора строками JSON, вернуть курсор для следующего запуска"""
+    cursor = list(cursor)
+    total = 0
+    while True:
+        changes, cursor = pull_changes(cursor, limit)
+        if not changes:
+            break
+        for change in changes:
+            out.write(json.dumps(dict(zip(CHANGE_FIELDS, change)), ensure_ascii=False) + '\n')
+        out.flush()
+        total += len(changes)
+    logger.info(f"📤 Выгружено изменений: {total}, курсор: {','.join(map(str, cursor)) or '—'}")
+    return cursor
+
+def compact_changes():
+    """Сжать журнал: по расходу остаётся последняя запись"""
+    removed = storage.compact_changes()
+    logger.info(f"🧹 Из журнала изменений удалено записей: {removed}")
+    return removed
+
+# ===== РЕЗЕРВНЫЕ КОПИИ =====
+BACKUP_DIR = 'data/backups'
+BACKUP_INTERVAL_HOURS = float(os.getenv('BACKUP_INTERVAL_HOURS', '24'))
+BACKUP_KEEP = int(os.getenv('BACKUP_KEEP', '7'))
+BACKUP_STEP_PAGES = int(os.getenv('BACKUP_STEP_PAGES', '256'))
+BACKUP_STEP_SLEEP = float(os.getenv('BACKUP_STEP_SLEEP', '0.02'))
+BACKUP_MAX_RESTARTS = int(os.getenv('BACKUP_MAX_RESTARTS', '5'))
+
+# Метрики последней копии (показываются в /backup status)
+backup_metrics = {
+    'running': False,
+    'pages_done': 0,
+    'pages_total': 0,
+    'restarts': 0,
+    'busy_retries': 0,
+    'last_file': None,
+    'last_finished': None,
+    'last_duration_s': None,
+    'last_size_bytes': None,
+    'last_ok': None,
+    'total_runs': 0,
+    'total_failures': 0,
+}
+_backup_lock = threading.Lock()
+
+class _BackupRestarted(Exception):
+    pass
+
+def _backup_progress(status, remaining, total):
+    """Прогресс backup(): обновляем метрики и даём писателям захватить БД"""
+    if status in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED):
+        # БД занята писателем: backup() сам повторит шаг после паузы
+        backup_metrics['busy_retries'] += 1
+        if backup_metrics['busy_retries'] >= 240:
+            raise RuntimeError('БД слишком долго занята')
+        return
+    # Запись из другого соединения перезапускает копирование с начала
+    if total - remaining < backup_metrics['pages_done']:
+        backup_metrics['restarts'] += 1
+        if backup_metrics['restarts'] >= BACKUP_MAX_RESTARTS:
+            raise _BackupRestarted()
+    backup_metrics['pages_done'] = total - remaining
+    backup_metrics['pages_total'] = total
+    time.sleep(BACKUP_STEP_SLEEP)
+
+def _integrity_ok(path):
+    """PRAGMA integrity_check для файла БД"""
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute('PRAGMA integrity_check').fetchone()[0] == 'ok'
+    finally:
+        conn.close()
+
+def list_backups():
+    """Имена снимков (каталоги с файлами всех шардов и годовых архивов в archive/), новые первыми"""
+    if not os.path.isdir(BACKUP_DIR):
+        return []
+    return sorted((d for d in os.listdir(BACKUP_DIR) if os.path.isdir(os.path.join(BACKUP_DIR, d))), reverse=True)
+
+def _backup_file(src_path, dst_path):
+    """Скопировать один файл БД по шагам и проверить копию"""
+    backup_metrics.update(pages_done=0, pages_total=0, restarts=0)
+    src = sqlite3.connect(src_path)
+    dst = sqlite3.connect(dst_path)
+    try:
+        # Копируем порциями страниц: между шагами блокировка чтения отпускается
+        src.backup(dst, pages=BACKUP_STEP_PAGES, progress=_backup_progress)
+    except _BackupRestarted:
+        # Писатели не дают закончить по шагам — копируем за один проход
+        logger.warning(f"⚠️ Копирование перезапускалось {BACKUP_MAX_RESTARTS} раз, копирую за один шаг")
+        src.backup(dst)
+    finally:
+        dst.close()
+        src.close()
+
+    if not _integrity_ok(dst_path):
+        raise RuntimeError(f'integrity_check не прошёл для {os.path.basename(src_path)}')
+
+    with open(dst_path, 'rb') as f_in, gzip.open(dst_path + '.gz', 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(dst_path)
+    return os.path.getsize(dst_path + '.gz')
+
+def create_backup(tag=None, keep=None):
+    """Онлайн-снимок всех шардов через backup API, сжатый gzip, с проверкой целостности (keep — снимок,
+    который ротация не трогает)"""
+    if STORAGE_BACKEND != 'sqlite':
+        logger.warning("⚠️ Резервное копирование доступно только для SQLite")
+        return None
+    if not _backup_lock.acquire(blocking=False):
+        logger.warning("⚠️ Резервное копирование уже идёт")
+        return None
+
+    started = time.perf_counter()
+    name = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}{'_' + tag if tag else ''}"
+    snapshot_dir = os.path.join(BACKUP_DIR, name)
+    backup_metrics.update(running=True, busy_retries=0)
+    backup_metrics['total_runs'] += 1
+    try:
+        os.makedirs(os.path.join(snapshot_dir, 'archive'), exist_ok=True)
+        size = 0
+        # Архивированные расходы удалены из шардов — без годовых архивов снимок их потеряет
+        with _archive_lock:
+            for shard in SHARDS:
+                size += _backup_file(shard.path, os.path.join(snapshot_dir, os.path.basename(shard.path)))
+            for f in _archive_files():
+                size += _backup_file(os.path.join(ARCHIVE_DIR, f), os.path.join(snapshot_dir, 'archive', f))
+
+        # Ротация: храним последние BACKUP_KEEP снимков
+        for old in [backup for backup in list_backups() if backup != keep][BACKUP_KEEP:]:
+            shutil.rmtree(os.path.join(BACKUP_DIR, old), ignore_errors=True)
+
+        duration = time.perf_counter() - started
+        backup_metrics.update(
+            last_file=name,
+            last_finished=datetime.now().isoformat(timespec='seconds'),
+            last_duration_s=round(duration, 2),
+            last_size_bytes=size,
+            last_ok=True,
+        )
+        logger.info(f"💾 Резервная копия {name} создана за {duration:.1f}с")
+        return name
+    except Exception as e:
+        backup_metrics.update(last_ok=False, last_finished=datetime.now().isoformat(timespec='seconds'))
+        backup_metrics['total_failures'] += 1
+        logger.error(f"❌ Ошибка резервного копирования: {e}")
+        shutil.rmtree(snapshot_dir, ignore_errors=True)
+        return None
+    finally:
+        backup_metrics['running'] = False
+        _backup_lock.release()
+
+def restore_backup(name):
+    """Восстановить все шарды и годовые архивы из снимка (перед этим снимается текущее состояние)"""
+    snapshot_dir = os.path.join(BACKUP_DIR, os.path.basename(name))
+    files = {os.path.basename(shard.path): shard.path for shard in SHARDS}
+    snapshot_files = set(os.listdir(snapshot_dir)) if os.path.isdir(snapshot_dir) else set()
+    if snapshot_files - {'archive'} != {f + '.gz' for f in files}:
+        logger.error(f"❌ Снимок {name} не найден или сделан при другом числе шардов")
+        return False
+    # Снимки без archive/ сделаны до того, как архивы стали в них попадать: архивы тогда не трогаем
+    archive_dir = os.path.join(snapshot_dir, 'archive')
+    archives = None
+    if os.path.isdir(archive_dir):
+        archives = {f[:-len('.gz')]: os.path.join(ARCHIVE_DIR, f[:-len('.gz')]) for f in os.listdir(archive_dir)}
+    else:
+        logger.warning(f"⚠️ В снимке {name} нет годовых архивов, восстанавливаю только шарды")
+    sources = {path: os.path.join(snapshot_dir, f) for f, path in files.items()}
+    sources.update({path: os.path.join(archive_dir, f) for f, path in (archives or {}).items()})
+
+    # Распаковываем рядом с БД, но не в BACKUP_DIR: ротация снимков не должна задеть рабочие файлы
+    tmp_dir = tempfile.mkdtemp(prefix='restore_', dir=os.path.dirname(os.path.abspath(DB_PATH)))
+    unpacked = {path: os.path.join(tmp_dir, os.path.relpath(src_path, snapshot_dir))
+                for path, src_path in sources.items()}
+    restored = list(unpacked.values())
+    diff_path = os.path.join(tmp_dir, 'changes_diff.db')
+    try:
+        # Сначала распаковываем и проверяем всё, чтобы не восстановить половину
+        os.makedirs(os.path.join(tmp_dir, 'archive'))
+        for path, src_path in sources.items():
+            with gzip.open(src_path + '.gz', 'rb') as f_in, open(unpacked[path], 'wb') as f_out:
+                shutil.copyfileobj(f_in, f_out)
+            if not _integrity_ok(unpacked[path]):
+                raise RuntimeError(f'integrity_check снимка не прошёл для {os.path.basename(path)}')
+
+        # Без страховочного снимка не восстанавливаем; восстанавливаемый снимок ротация не удалит
+        if create_backup(tag='pre_restore', keep=os.path.basename(snapshot_dir)) is None:
+            raise RuntimeError('не удалось снять текущее состояние перед восстановлением')
+
+        with _archive_lock:
+            # Расходы до и после восстановления — чтобы журнал изменений перевёл потребителей к снимку
+            heads = _changes_heads()
+            live = [shard.path for shard in SHARDS] + [os.path.join(ARCHIVE_DIR, f) for f in _archive_files()]
+            _collect_expenses(diff_path, 'live', live)
+            _collect_expenses(diff_path, 'snap', restored + (live[len(SHARDS):] if archives is None else []))
+            if archives is not None:
+                # Архивов, которых не было на момент снимка, быть не должно: их строки снова в шардах
+                os.makedirs(ARCHIVE_DIR, exist_ok=True)
+                for f in set(_archive_files()) - set(archives):
+                    os.remove(os.path.join(ARCHIVE_DIR, f))
+            for path, tmp_path in unpacked.items():
+                src = sqlite3.connect(tmp_path)
+                dst = sqlite3.connect(path, timeout=30)
+                try:
+                    src.backup(dst)
+                finally:
+                    dst.close()
+                    src.close()
+            # Снимок мог быть сделан до последних миграций схемы
+            for shard in SHARDS:
+                conn = sqlite3.connect(shard.path, timeout=30)
+                _init_shard_schema(conn, shard.index)
+                conn.close()
+            _log_restore_changes(diff_path, heads)
+        # Кэши могли разойтись с восстановленными данными
+        _saved_users.clear()
+        _active_ledgers.clear()
+        suggester.clear()
+        aggregates.clear()
+        logger.info(f"♻️ БД восстановлена из {name}")
+        return True
+    except Exception as e:
+        logger.error(f"❌ Ошибка восстановления: {e}")
+        return False
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+# ===== АНАЛИТИКА =====
+# Ночной пакетный расчёт прогнозов и аномалий сразу для всех бюджетов шарда (массивы NumPy).
+# Окно короче минимального возраста архивации (62 дня) — все строки окна лежат в горячей БД
+INSIGHTS_WINDOW_DAYS = min(int(os.getenv('INSIGHTS_WINDOW_DAYS', '56')), 61)
+INSIGHTS_INTERVAL_HOURS = float(os.getenv('INSIGHTS_INTERVAL_HOURS', '24'))
+INSIGHTS_HOUR = int(os.getenv('INSIGHTS_HOUR', '3'))
+# Покупка считается аномальной, если она в ANOMALY_RATIO раз больше медианы категории и robust z >= ANOMALY_Z
+ANOMALY_RATIO = float(os.getenv('ANOMALY_RATIO', '3'))
+ANOMALY_Z = float(os.getenv('ANOMALY_Z', '3.5'))
+ANOMALY_MIN_COUNT = int(os.getenv('ANOMALY_MIN_COUNT', '5'))
+
+insights_metrics = {
+    'running': False,
+    'last_finished': None,
+    'last_duration_s': None,
+    'last_users': None,
+    'last_rows': None,
+    'last_arrays_mb': None,
+    'peak_rss_mb': None,
+    'last_ok': None,
+    'total_runs': 0,
+    'total_failures': 0,
+}
+_insights_lock = threading.Lock()
+
+def _group_medians(values, starts, counts):
+    """Медианы групп в отсортированном по (группа, значение) массиве"""
+    lo = starts + (counts - 1) // 2
+    hi = starts + counts // 2
+    return (values[lo] + values[hi]) / 2
+
+def compute_daily_insights(daily_rows, as_of):
+    """Прогноз на месяц, скользящие средние и robust z дня as_of по дневным суммам пользователей.
+    
+    daily_rows — [(ledger_id, день, сумма)], as_of — последний полный день (date).
+    Возвращает (строки user_insights, байт в массивах).
+    """
+    if not daily_rows:
+        return [], 0
+    window = INSIGHTS_WINDOW_DAYS
+    last_day = as_of.toordinal()
+    rows = np.array(daily_rows, dtype=np.float64)
+    users, user_idx = np.unique(rows[:, 0].astype(np.int64), return_inverse=True)
+    col = rows[:, 1].astype(np.int64) - (last_day - window + 1)
+    keep = (col >= 0) & (col < window)
+    
+    # Матрица пользователи × дни, пустые дни — нули
+    matrix = np.zeros((len(users), window))
+    np.add.at(matrix, (user_idx[keep], col[keep]), rows[keep, 2])
+    
+    mean_7d = matrix[:, -7:].mean(axis=1)
+    mean_30d = matrix[:, -30:].mean(axis=1)
+    
+    # Темп месяца: потрачено с 1-го числа, дальше — смесь темпа месяца и среднего за 30 дней
+    elapsed = as_of.day
+    days_in_month = ((as_of.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1)).day
+    month_spent = matrix[:, -elapsed:].sum(axis=1)
+    weight = elapsed / days_in_month
+    rate = weight * (month_spent / elapsed) + (1 - weight) * mean_30d
+    projected = month_spent + rate * (days_in_month - elapsed)
+    
+    # Robust z дня: (x - медиана) / (1.4826 · MAD); при нулевом MAD — через среднее отклонение
+    median = np.median(matrix, axis=1)
+    deviation = np.abs(matrix - median[:, None])
+    scale = 1.4826 * np.median(deviation, axis=1)
+    scale = np.where(scale > 0, scale, 1.2533 * deviation.mean(axis=1))
+    day_total = matrix[:, -1]
+    day_z = np.divide(day_total - median, scale, out=np.zeros_like(day_total), where=scale > 0)
+    
+    month = as_of.strftime('%Y-%m')
+    insights = list(zip(
+        users.tolist(), [as_of.isoformat()] * len(users), [month] * len(users),
+        np.round(month_spent, 2).tolist(), np.round(projected, 2).tolist(),
+        np.round(mean_7d, 2).tolist(), np.round(mean_30d, 2).tolist(),
+        np.round(day_total, 2).tolist(), np.round(day_z, 2).tolist(),
+    ))
+    return insights, matrix.nbytes * 3 + rows.nbytes
+
+def compute_category_baselines(purchase_rows):
+    """Медиана и MAD суммы покупки для каждой пары (бюджет, категория).
+    
+    purchase_rows — [(ledger_id, категория, сумма)]. Возвращает (строки category_baselines, байт в массивах).
+    """
+    if not purchase_rows:
+        return [], 0
+    user_ids, categories, amounts = zip(*purchase_rows)
+    amounts = np.array(amounts, dtype=np.float64)
+    _, user_idx = np.unique(np.array(user_ids, dtype=np.int64), return_inverse=True)
+    category_names, category_idx = np.unique(np.array(categories, dtype=object).astype(str), return_inverse=True)
+    key = user_idx.astype(np.int64) * len(category_names) + category_idx
+    
+    # Сортировка по (группа, сумма): группы идут подряд, внутри — по возрастанию
+    order = np.lexsort((amounts, key))
+    key, amounts = key[order], amounts[order]
+    starts = np.flatnonzero(np.r_[True, key[1:] != key[:-1]])
+    counts = np.diff(np.r_[starts, len(key)])
+    median = _group_medians(amounts, starts, counts)
+    
+    group = np.repeat(np.arange(len(starts)), counts)
+    deviation = np.abs(amounts - median[group])
+    deviation = deviation[np.lexsort((deviation, group))]
+    mad = _group_medians(deviation, starts, counts)
+    
+    first = order[starts]
+    user_ids = np.array(user_ids, dtype=np.int64)[first]
+    names = category_names[category_idx[first]]
+    enough = counts >= ANOMALY_MIN_COUNT
+    baselines = list(zip(
+        user_ids[enough].tolist(), names[enough].tolist(),
+        np.round(median[enough], 2).tolist(), np.round(mad[enough], 2).tolist(), counts[enough].tolist(),
+    ))
+    return baselines, amounts.nbytes * 3 + key.nbytes * 3
+
+def compute_insights():
+    """Пересчитать прогнозы и базовые уровни по всем частям хранилища (по очереди)"""
+    if not _insights_lock.acquire(blocking=False):
+        logger.warning("⚠️ Аналитика уже считается")
+        return None
+    
+    started = time.perf_counter()
+    insights_metrics['running'] = True
+    insights_metrics['total_runs'] += 1
+    try:
+        as_of = (datetime.utcnow() - timedelta(days=1)).date()
+        since = (as_of - timedelta(days=INSIGHTS_WINDOW_DAYS - 1)).strftime('%Y-%m-%d 00:00:00')
+        users = rows = arrays = 0
+        for partition in storage.analytics_partitions():
+            daily, purchases = storage.load_analytics_rows(partition, since)
+            # Сегодняшние строки в дневную матрицу не попадают: as_of — вчера
+            insights, daily_bytes = compute_daily_insights(daily, as_of)
+            baselines, purchase_bytes = compute_category_baselines(purchases)
+            storage.save_analytics(partition, insights, baselines)
+            users += len(insights)
+            rows += len(purchases)
+            arrays = max(arrays, daily_bytes + purchase_bytes)
         
-        categories = cursor.fetchall()
-        conn.close()
-        return total, month_total, categories
+        duration = time.perf_counter() - started
+        insights_metrics.update(
+            last_finished=datetime.now().isoformat(timespec='seconds'),
+            last_duration_s=round(duration, 2),
+            last_users=users,
+            last_rows=rows,
+            last_arrays_mb=round(arrays / 1024 / 1024, 1),
+            peak_rss_mb=round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            last_ok=True,
+        )
+        logger.info(f"📈 Аналитика: {users} бюджетов, {rows} расходов за {duration:.1f}с, "
+                    f"массивы до {insights_metrics['last_arrays_mb']} МБ")
+        return users
     except Exception as e:
-        logger.error(f"❌ Ошибка получения статистики: {e}")
-        return 0, 0, []
+        insights_metrics.update(last_ok=False, last_finished=datetime.now().isoformat(timespec='seconds'))
+        insights_metrics['total_failures'] += 1
+        logger.error(f"❌ Ошибка расчёта аналитики: {e}")
+        return None
+    finally:
+        insights_metrics['running'] = False
+        _insights_lock.release()
 
-def get_stats_by_category(user_id, category):
-    """Получить статистику по категории"""
+def get_insight(user_id):
+    """Прогноз бюджета пользователя из последнего расчёта"""
     try:
-        category = category.lower().capitalize()
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT SUM(amount), COUNT(*), AVG(amount)
-            FROM expenses
-            WHERE user_id = ? AND category = ?
-        ''', (user_id, category))
-        
-        result = cursor.fetchone()
-        conn.close()
-        
-        return {
-            'total': result[0] or 0,
-            'count': result[1] or 0,
-            'avg': result[2] or 0
-        }
+        return storage.get_insight(active_ledger(user_id))
     except Exception as e:
-        logger.error(f"❌ Ошибка получения статистики: {e}")
-        return {'total': 0, 'count': 0, 'avg': 0}
+        logger.error(f"❌ Ошибка получения прогноза: {e}")
+        return None
+
+def expense_alert(user_id, amount, category):
+    """Предупреждение, если покупка намного больше обычной для категории, иначе пустая строка"""
+    try:
+        baseline = storage.get_category_baseline(active_ledger(user_id), category.lower().capitalize())
+    except Exception as e:
+        logger.error(f"❌ Ошибка получения базового уровня: {e}")
+        return ''
+    if not baseline or baseline[0] <= 0:
+        return ''
+    median, mad, _ = baseline
+    ratio = amount / median
+    z = (amount - median) / (1.4826 * mad) if mad > 0 else float('inf')
+    if ratio >= ANOMALY_RATIO and z >= ANOMALY_Z:
+        return f"⚠️ Это в {ratio:.1f} раза больше обычного для {category} (обычно ~{median:.0f}₽)"
+    return ''
 
 # ===== ХРАНЕНИЕ СОСТОЯНИЯ ПОЛЬЗОВАТЕЛЯ =====
 user_state = {}
@@ -467,15 +3036,228 @@ def clear_state(user_id):
     if user_id in user_state:
         del user_state[user_id]
 
+# Расход до последней правки или удаления и его бюджет — для кнопки «Отменить»
+UNDO_SECONDS = int(os.getenv('UNDO_SECONDS', '600'))
+undo_buffer = {}
+_undo_lock = threading.Lock()  # буфер общий для всех потоков-обработчиков
+
+def remember_for_undo(user_id, expense):
+    """Запомнить строку расхода до изменения вместе с активным сейчас бюджетом"""
+    ledger_id = active_ledger(user_id)
+    now = time.monotonic()
+    with _undo_lock:
+        for key in [k for k, (_, _, saved_at) in undo_buffer.items() if now - saved_at > UNDO_SECONDS]:
+            del undo_buffer[key]
+        undo_buffer[(user_id, expense[0])] = (expense, ledger_id, now)
+
+def pop_undo(user_id, expense_id):
+    """Забрать сохранённую строку и её бюджет, если они ещё не устарели"""
+    with _undo_lock:
+        saved = undo_buffer.pop((user_id, expense_id), None)
+    if saved and time.monotonic() - saved[2] <= UNDO_SECONDS:
+        return saved[:2]
+    return None
+
+def has_undo(user_id, expense_id):
+    with _undo_lock:
+        saved = undo_buffer.get((user_id, expense_id))
+    return bool(saved) and time.monotonic() - saved[2] <= UNDO_SECONDS
+
+# ===== ПРОФИЛИРОВАНИЕ =====
+_handler_ctx = threading.local()
+_active_handler_threads = set()
+PROFILE_TOP_MAX = 50  # больше строк в отчёте не влезает в сообщение Telegram
+
+_profiling = None
+_profiling_lock = threading.Lock()
+
+class ProfilingSession:
+    """Сессия профилирования обработчиков: cProfile или сэмплирование стеков"""
+
+    def __init__(self, mode, seconds, top, chat_id, interval=0.005):
+        self.mode = mode
+        self.seconds = seconds
+        self.top = top
+        self.chat_id = chat_id
+        self.interval = interval
+        self.started = time.perf_counter()
+        self._lock = threading.Lock()
+        self._profiles = []
+        self._samples_self = defaultdict(int)
+        self._samples_total = defaultdict(int)
+        self._sample_count = 0
+        self._stop = threading.Event()
+        self._sampler = None
+        self.timer = None
+
+    def start(self):
+        if self.mode == 'sample':
+            self._sampler = threading.Thread(target=self._sample_loop, daemon=True)
+            self._sampler.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._sampler:
+            self._sampler.join()
+
+    def new_profile(self):
+        """Профайлер для текущего потока обработчика (cProfile работает per-thread)"""
+        profile = cProfile.Profile()
+        with self._lock:
+            self._profiles.append(profile)
+        return profile
+
+    def _sample_loop(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own or not getattr(frame, 'f_code', None):
+                    continue
+                # Сэмплируем только потоки, которые сейчас в обработчике
+                if thread_id not in _active_handler_threads:
+                    continue
+                self._sample_count += 1
+                key = f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})"
+                self._samples_self[key] += 1
+                seen = set()
+                while frame is not None:
+                    func = f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)})"
+                    if func not in seen:
+                        self._samples_total[func] += 1
+                        seen.add(func)
+                    frame = frame.f_back
+
+    def report(self):
+        """Текстовый отчёт и (для cProfile) дамп .pstats"""
+        elapsed = time.perf_counter() - self.started
+        if self.mode == 'sample':
+            if not self._sample_count:
+                return f"🔬 Сэмплов нет за {elapsed:.1f}с — обработчики не выполнялись", None
+            lines = [f"🔬 Сэмплирование {elapsed:.1f}с, сэмплов: {self._sample_count}", "", "Собственное время:"]
+            for func, count in sorted(self._samples_self.items(), key=lambda x: -x[1])[:self.top]:
+                lines.append(f"{count * 100 / self._sample_count:5.1f}% {func}")
+            lines += ["", "Включая вызовы:"]
+            for func, count in sorted(self._samples_total.items(), key=lambda x: -x[1])[:self.top]:
+                lines.append(f"{count * 100 / self._sample_count:5.1f}% {func}")
+            return "\n".join(lines), None
+
+        with self._lock:
+            profiles = list(self._profiles)
+        if not profiles:
+            return f"🔬 За {elapsed:.1f}с обработчики не выполнялись", None
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        out = io.StringIO()
+        stats.stream = out
+        stats.sort_stats('cumulative').print_stats(self.top)
+        text = f"🔬 cProfile {elapsed:.1f}с, вызовов обработчиков: {len(profiles)}\n\n{out.getvalue()[-3500:]}"
+
+        # Тот же формат, что пишет Stats.dump_stats
+        dump = io.BytesIO(marshal.dumps(stats.stats))
+        dump.name = f"profile_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pstats"
+        return text, dump
+
+def start_profiling(mode, seconds, top, chat_id):
+    """Запустить профилирование на seconds секунд; отчёт уйдёт в chat_id"""
+    global _profiling
+    with _profiling_lock:
+        if _profiling is not None:
+            return False
+        session = _profiling = ProfilingSession(mode, seconds, top, chat_id)
+        session.start()
+    # Таймер останавливает только свою сессию: после /profile stop могла начаться новая
+    session.timer = threading.Timer(seconds, stop_profiling, args=(session,))
+    session.timer.daemon = True
+    session.timer.start()
+    logger.info(f"🔬 Профилирование ({mode}) запущено на {seconds}с")
+    return True
+
+def stop_profiling(session=None):
+    """Остановить профилирование (только session, если она указана) и отправить отчёт"""
+    global _profiling
+    with _profiling_lock:
+        if _profiling is None or (session is not None and _profiling is not session):
+            return False
+        session, _profiling = _profiling, None
+    if session.timer is not None:
+        session.timer.cancel()
+    session.stop()
+    text, dump = session.report()
+    try:
+        bot.send_message(session.chat_id, text)
+        if dump is not None:
+            bot.send_document(session.chat_id, dump)
+    except Exception as e:
+        logger.error(f"❌ Ошибка отправки отчёта профилирования: {e}")
+    logger.info("🔬 Профилирование остановлено")
+    return True
+
+def _timed_request_sender(method, url, **kwargs):
+    """Отправка запроса к Bot API с учётом времени в разбивке обработчика"""
+    started = time.perf_counter()
+    try:
+        return telebot.apihelper._get_req_session().request(method, url, **kwargs)
+    finally:
+        if getattr(_handler_ctx, 'depth', 0):
+            _handler_ctx.api_time += time.perf_counter() - started
+            _handler_ctx.api_calls += 1
+
+telebot.apihelper.CUSTOM_REQUEST_SENDER = _timed_request_sender
+
+def timed_handler(func):
+    """Замер времени обработчика: профилирование и лог медленных апдейтов"""
+    @functools.wraps(func)
+    def wrapper(message, *args, **kwargs):
+        # Вложенные вызовы (handle_message -> spend_command) меряем один раз
+        if getattr(_handler_ctx, 'depth', 0):
+            _handler_ctx.depth += 1
+            try:
+                return func(message, *args, **kwargs)
+            finally:
+                _handler_ctx.depth -= 1
+
+        _handler_ctx.depth = 1
+        _handler_ctx.api_time = 0.0
+        _handler_ctx.api_calls = 0
+        thread_id = threading.get_ident()
+        _active_handler_threads.add(thread_id)
+        session = _profiling
+        profile = session.new_profile() if session is not None and session.mode == 'cprofile' else None
+        started = time.perf_counter()
+        try:
+            if profile is not None:
+                return profile.runcall(func, message, *args, **kwargs)
+            return func(message, *args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - started
+            _handler_ctx.depth = 0
+            _active_handler_threads.discard(thread_id)
+            if elapsed * 1000 >= SLOW_HANDLER_MS:
+                slow_logger.warning(json.dumps({
+                    'time': datetime.now().isoformat(),
+                    'handler': func.__name__,
+                    'total_ms': round(elapsed * 1000, 1),
+                    'telegram_api_ms': round(_handler_ctx.api_time * 1000, 1),
+                    'telegram_api_calls': _handler_ctx.api_calls,
+                    'local_ms': round((elapsed - _handler_ctx.api_time) * 1000, 1),
+                    'update': getattr(message, 'json', None),
+                }, ensure_ascii=False, default=str))
+    return wrapper
+
 # ===== КНОПКИ =====
 
-def get_category_buttons(user_id):
-    """Получить кнопки с категориями"""
-    top = get_top_categories(user_id, 5)
-    common = get_common_categories(user_id)
+def get_category_buttons(user_id, suggested=None):
+    """Получить кнопки с категориями (подсказанные — первой строкой)"""
+    suggested = suggested or []
+    top = [cat for cat in get_top_categories(user_id, 5 + len(suggested)) if cat not in suggested][:5]
+    common = [cat for cat in get_common_categories(user_id) if cat not in suggested and cat not in top]
     
     markup = telebot.types.ReplyKeyboardMarkup(resize_keyboard=True)
     
+    if suggested:
+        markup.add(*[telebot.types.KeyboardButton(f"🏷️ {cat}") for cat in suggested])
+    
     # Топ 5 категорий
     row1 = [telebot.types.KeyboardButton(f"🏷️ {cat}") for cat in top[:2]]
     row2 = [telebot.types.KeyboardButton(f"🏷️ {cat}") for cat in top[2:4]]
@@ -510,12 +3292,86 @@ def get_timezone_buttons():
     for i in range(0, len(zones), 3):
         row = [telebot.types.KeyboardButton(zones[j]) for j in range(i, min(i+3, len(zones)))]
         markup.add(*row)
-    
+
+    return markup
+
+# Инлайн-кнопки расходов: callback_data вида exp:<действие>:<ID>[:<аргумент>] (Telegram — до 64 байт)
+def _inline(text, *data):
+    return telebot.types.InlineKeyboardButton(text, callback_data=':'.join(['exp', *map(str, data)]))
+
+def _author_suffix(names, author):
+    """« | 👤 Имя» для строки расхода в общем бюджете"""
+    return f" | 👤 {names.get(author, author)}" if names else ''
+
+def expense_list_view(user_id, page):
+    """Текст и кнопки страницы /list: по кнопке на каждый расход"""
+    expenses = get_all_expenses(user_id, 20, (page - 1) * 20)
+
+    if not expenses:
+        return "📋 Расходов нет", None
+
+    title = "Последние расходы" if page == 1 else f"Расходы, страница {page}"
+    names = ledger_member_names(user_id)
+    msg = f"📋 {title} ({len(expenses)}):\n\n"
+    for exp_id, amount, category, desc, timestamp, author in expenses:
+        time = datetime.fromisoformat(timestamp).strftime('%d.%m.%y %H:%M')
+        msg += f"#{exp_id}: {amount}₽ | {category} | {desc} | {time}{_author_suffix(names, author)}\n"
+    msg += "\nНажми на ID, чтобы изменить или удалить расход"
+
+    markup = telebot.types.InlineKeyboardMarkup(row_width=4)
+    markup.add(*[_inline(f"#{expense[0]}", 'show', expense[0], page) for expense in expenses])
+    nav = []
+    if page > 1:
+        nav.append(_inline("⬅️", 'list', 0, page - 1))
+    if len(expenses) == 20:
+        nav.append(_inline("➡️", 'list', 0, page + 1))
+    if nav:
+        markup.row(*nav)
+    return msg, markup
+
+def expense_card_view(user_id, expense, page=1, note=None):
+    """Текст и кнопки карточки расхода"""
+    exp_id, amount, category, description, timestamp, author = expense
+    time = datetime.fromisoformat(timestamp).strftime('%d.%m %H:%M')
+
+    msg = f"""📝 Расход #{exp_id}:
+
+💰 Сумма: {amount}₽
+🏷️ Категория: {category}
+📝 Описание: {description}
+⏰ Время: {time}"""
+    names = ledger_member_names(user_id)
+    if names:
+        msg += f"\n👤 Добавил: {names.get(author, author)}"
+    if note:
+        msg += f"\n\n{note}"
+
+    markup = telebot.types.InlineKeyboardMarkup()
+    markup.row(_inline("💰 Сумма", 'amount', exp_id, page), _inline("🏷️ Категория", 'cat', exp_id, page),
+               _inline("📝 Описание", 'desc', exp_id, page))
+    row = [_inline("🗑️ Удалить", 'del', exp_id, page)]
+    if has_undo(user_id, exp_id):
+        row.append(_inline("↩️ Отменить", 'undo', exp_id, page))
+    markup.row(*row)
+    markup.row(_inline("⬅️ К списку", 'list', 0, page))
+    return msg, markup
+
+def expense_category_markup(user_id, exp_id, page=1):
+    """Инлайн-выбор новой категории для расхода"""
+    markup = telebot.types.InlineKeyboardMarkup(row_width=2)
+    buttons = []
+    for category in get_user_categories_sorted(user_id):
+        button = _inline(f"🏷️ {category}", 'setcat', exp_id, page, category)
+        if len(button.callback_data.encode()) <= 64:
+            buttons.append(button)
+    markup.add(*buttons)
+    markup.row(_inline("➕ Другая", 'newcat', exp_id, page), _inline("⬅️ Назад", 'show', exp_id, page))
     return markup
 
 # ===== КОМАНДЫ БОТА =====
 
 @bot.message_handler(commands=['start'])
+@timed_handler
 def start(message):
     """Команда /start"""
     user = message.from_user
@@ -527,6 +3383,7 @@ def start(message):
     logger.info(f"✅ Пользователь {user.id} начал выбор тайм-зоны")
 
 @bot.message_handler(commands=['help'])
+@timed_handler
 def help_command(message):
     """Команда /help"""
     msg = """
@@ -535,10 +3392,14 @@ def help_command(message):
 💰 **/spend** — добавить расход через интерфейс кнопок
 📊 **/stats** [категория] — статистика расходов
 📋 **/today** [категория] — расходы за сегодня
-📝 **/list** — все расходы с ID для редактирования
+📝 **/list** [страница] — все расходы с ID для редактирования
+⚡ **350 такси домой** — быстрый расход, категория подберётся по описанию
+🔎 **@бот 350 еда**, **@бот today** — то же из любого чата (инлайн-режим)
+🔍 **/search** [текст] — поиск по описанию и категории
 ✏️ **/edit [ID]** — редактировать расход
 🗑️ **/delete [ID]** — удалить расход
 🏷️ **/categories** — список твоих категорий
+👥 **/ledger** — общий бюджет с семьёй: /ledger new, /ledger invite, /join
 🌍 **/timezone** — изменить часовой пояс
 🔄 **/start** — начать заново
 ❓ **/help** — эта помощь
@@ -546,6 +3407,7 @@ def help_command(message):
     bot.send_message(message.chat.id, msg, parse_mode='Markdown')
 
 @bot.message_handler(commands=['spend'])
+@timed_handler
 def spend_command(message):
     """Команда /spend"""
     user = message.from_user
@@ -558,29 +3420,45 @@ def spend_command(message):
     bot.send_message(message.chat.id, msg, reply_markup=markup)
 
 @bot.message_handler(commands=['list'])
+@timed_handler
 def list_command(message):
-    """Команда /list"""
+    """Команда /list [страница]"""
+    user = message.from_user
+    save_user(user.id, user.username, user.first_name)
+    
+    parts = message.text.split()
+    page = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() and int(parts[1]) > 0 else 1
+    
+    msg, markup = expense_list_view(user.id, page)
+    bot.send_message(message.chat.id, msg, reply_markup=markup)
+
+@bot.message_handler(commands=['search'])
+@timed_handler
+def search_command(message):
+    """Команда /search"""
     user = message.from_user
     save_user(user.id, user.username, user.first_name)
     
-    expenses = get_all_expenses(user.id, 20)
+    parts = message.text.split(maxsplit=1)
+    
+    if len(parts) < 2:
+        bot.send_message(message.chat.id, "❌ Укажи что искать!\nПример: /search такси")
+        return
+    
+    expenses = search_expenses(user.id, parts[1], 20)
     
     if not expenses:
-        msg = "📋 Расходов нет"
-        bot.send_message(message.chat.id, msg)
+        msg = f"🔍 По запросу '{parts[1]}' ничего не найдено"
     else:
-        msg = f"📋 Последние расходы ({len(expenses)}):\n\n"
-        for exp_id, amount, category, desc, timestamp in expenses:
-            time = datetime.fromisoformat(timestamp).strftime('%d.%m %H:%M')
+        msg = f"🔍 Найдено ({len(expenses)}):\n\n"
+        for exp_id, amount, category, desc, timestamp, _ in expenses:
+            time = datetime.fromisoformat(timestamp).strftime('%d.%m.%y %H:%M')
             msg += f"#{exp_id}: {amount}₽ | {category} | {desc} | {time}\n"
-        
-        bot.send_message(message.chat.id, msg)
-        
-        # Предлагаем редактирование
-        edit_msg = "Нажми на ID для редактирования или используй /edit [ID] или /delete [ID]"
-        bot.send_message(message.chat.id, edit_msg)
+    
+    bot.send_message(message.chat.id, msg)
 
 @bot.message_handler(commands=['today'])
+@timed_handler
 def today_command(message):
     """Команда /today"""
     user = message.from_user
@@ -600,14 +3478,22 @@ def today_command(message):
         msg = f"📋 Расходов {title} нет"
     else:
         total = sum(exp[1] for exp in expenses)
+        names = ledger_member_names(user.id)
         msg = f"📋 **Расходы {title}** ({len(expenses)}, Итого: {total}₽)\n\n"
-        for exp_id, amount, cat, desc, timestamp in expenses:
+        for exp_id, amount, cat, desc, timestamp, author in expenses:
             time = datetime.fromisoformat(timestamp).strftime('%H:%M')
-            msg += f"#{exp_id}: {amount}₽ | {cat} | {desc} | {time}\n"
+            msg += f"#{exp_id}: {amount}₽ | {cat} | {desc} | {time}{_author_suffix(names, author)}\n"
+        if names:
+            by_member = defaultdict(float)
+            for exp in expenses:
+                by_member[exp[5]] += exp[1]
+            msg += "\n👥 " + ", ".join(f"{names.get(member, member)}: {amount}₽"
+                                       for member, amount in sorted(by_member.items(), key=lambda x: -x[1]))
     
     bot.send_message(message.chat.id, msg, parse_mode='Markdown')
 
 @bot.message_handler(commands=['stats'])
+@timed_handler
 def stats_command(message):
     """Команда /stats"""
     user = message.from_user
@@ -644,10 +3530,26 @@ def stats_command(message):
                 msg += f"\n  • {category}: {amount}₽ ({count} расходов, ср: {avg:.0f}₽)"
         else:
             msg += "\n  (Нет данных)"
+        
+        # В общем бюджете — кто сколько потратил за месяц (один запрос по диапазону бюджета)
+        names = ledger_member_names(user.id)
+        if names:
+            msg += "\n\n👥 **По участникам за месяц:**"
+            for member, amount, count in get_month_member_totals(user.id):
+                msg += f"\n  • {names.get(member, member)}: {amount}₽ ({count} расходов)"
+        
+        # Прогноз из ночного расчёта (только за текущий месяц)
+        insight = get_insight(user.id)
+        if insight and insight[1] == get_user_local_time(user.id).strftime('%Y-%m'):
+            as_of, _, _, projected, mean_7d, _, day_total, day_z = insight
+            msg += f"\n\n📈 В таком темпе за месяц выйдет ~{projected:.0f}₽ (среднее за неделю: {mean_7d:.0f}₽/день)"
+            if day_z >= ANOMALY_Z:
+                msg += f"\n⚠️ {datetime.fromisoformat(as_of).strftime('%d.%m')} потрачено {day_total:.0f}₽ — заметно больше обычного"
     
     bot.send_message(message.chat.id, msg, parse_mode='Markdown')
 
 @bot.message_handler(commands=['categories'])
+@timed_handler
 def categories_command(message):
     """Команда /categories"""
     user = message.from_user
@@ -664,6 +3566,7 @@ def categories_command(message):
     bot.send_message(message.chat.id, msg, parse_mode='Markdown')
 
 @bot.message_handler(commands=['timezone'])
+@timed_handler
 def timezone_command(message):
     """Команда /timezone"""
     user = message.from_user
@@ -674,7 +3577,96 @@ def timezone_command(message):
     bot.send_message(message.chat.id, msg, reply_markup=markup)
     set_state(user.id, 'choosing_timezone')
 
+@bot.message_handler(commands=['ledger'])
+@timed_handler
+def ledger_command(message):
+    """Команда /ledger [new <название>|use <номер>|invite|members|leave] — общие бюджеты"""
+    user = message.from_user
+    save_user(user.id, user.username, user.first_name)
+    
+    parts = message.text.split(maxsplit=2)
+    action = parts[1] if len(parts) > 1 else ''
+    
+    if action == 'new':
+        if len(parts) < 3:
+            bot.send_message(message.chat.id, "❌ Укажи название!\nПример: /ledger new Семья")
+            return
+        if create_ledger(user.id, user.first_name, parts[2]) is None:
+            bot.send_message(message.chat.id, "❌ Ошибка создания бюджета!")
+            return
+        _, name, invite = get_current_ledger(user.id)
+        bot.send_message(message.chat.id, f"✅ Общий бюджет «{name}» создан, новые расходы пишутся в него\n\n"
+                                          f"📨 Пригласи участников: /join {invite}")
+    elif action == 'use':
+        ledgers = get_user_ledgers(user.id)
+        number = parts[2] if len(parts) > 2 else ''
+        if not number.isdigit() or not 1 <= int(number) <= len(ledgers):
+            bot.send_message(message.chat.id, "❌ Укажи номер бюджета из /ledger")
+            return
+        ledger_id, name, _ = ledgers[int(number) - 1]
+        if switch_ledger(user.id, ledger_id):
+            bot.send_message(message.chat.id, f"✅ Теперь расходы пишутся в бюджет «{name}»")
+        else:
+            bot.send_message(message.chat.id, "❌ Ошибка переключения бюджета!")
+    elif action == 'invite':
+        _, name, invite = get_current_ledger(user.id)
+        if invite is None:
+            bot.send_message(message.chat.id, "❌ Личный бюджет общим не сделать. Создай общий: /ledger new Семья")
+            return
+        bot.send_message(message.chat.id, f"📨 Чтобы вступить в «{name}», отправь боту:\n\n/join {invite}")
+    elif action == 'members':
+        names = ledger_member_names(user.id)
+        if not names:
+            bot.send_message(message.chat.id, "👤 Это личный бюджет, в нём только ты")
+            return
+        spent = {member: (amount, count) for member, amount, count in get_month_member_totals(user.id)}
+        msg = f"👥 Участники «{get_current_ledger(user.id)[1]}» и траты за месяц:\n"
+        for member, name in names.items():
+            amount, count = spent.get(member, (0, 0))
+            msg += f"\n  • {name}: {amount}₽ ({count} расходов)"
+        bot.send_message(message.chat.id, msg)
+    elif action == 'leave':
+        _, name, _ = get_current_ledger(user.id)
+        if leave_ledger(user.id):
+            bot.send_message(message.chat.id, f"✅ Выход из «{name}» выполнен, расходы снова пишутся в личный бюджет")
+        else:
+            bot.send_message(message.chat.id, "❌ Из личного бюджета выйти нельзя")
+    else:
+        current = active_ledger(user.id)
+        msg = "💼 Твои бюджеты:\n"
+        for i, (ledger_id, name, role) in enumerate(get_user_ledgers(user.id), 1):
+            mark = " ✅" if ledger_id == current else ""
+            owner = " (владелец)" if role == 'owner' and ledger_id != user.id else ""
+            msg += f"\n{i}. {name}{owner}{mark}"
+        msg += ("\n\n/ledger new Семья — создать общий бюджет"
+                "\n/ledger use 2 — переключиться"
+                "\n/ledger invite — код приглашения"
+                "\n/ledger members — участники"
+                "\n/ledger leave — выйти из общего бюджета")
+        bot.send_message(message.chat.id, msg)
+
+@bot.message_handler(commands=['join'])
+@timed_handler
+def join_command(message):
+    """Команда /join <код> — вступить в общий бюджет"""
+    user = message.from_user
+    save_user(user.id, user.username, user.first_name)
+    
+    parts = message.text.split()
+    if len(parts) < 2:
+        bot.send_message(message.chat.id, "❌ Укажи код приглашения!\nПример: /join 123456789-a1b2c3d4")
+        return
+    
+    name = join_ledger(user.id, user.first_name, parts[1])
+    if name is None:
+        bot.send_message(message.chat.id, "❌ Код приглашения не подошёл")
+        return
+    bot.send_message(message.chat.id, f"✅ Ты в бюджете «{name}», новые расходы пишутся в него.\n"
+                                      f"Вернуться в личный: /ledger use 1")
+    logger.info(f"✅ Пользователь {user.id} вступил в бюджет {name!r}")
+
 @bot.message_handler(commands=['edit', 'delete'])
+@timed_handler
 def edit_delete_handler(message):
     """Команды /edit и /delete"""
     user = message.from_user
@@ -701,33 +3693,327 @@ def edit_delete_handler(message):
     command = message.text.split()[0][1:]
     
     if command == 'delete':
-        if delete_expense(expense_id):
-            bot.send_message(message.chat.id, f"✅ Расход #{expense_id} удалён!")
+        msg, _ = expense_card_view(user.id, expense, note="🗑️ Удалить этот расход?")
+        markup = telebot.types.InlineKeyboardMarkup()
+        markup.row(_inline("✅ Да, удалить", 'delok', expense_id, 1), _inline("❌ Отмена", 'show', expense_id, 1))
+    else:
+        msg, markup = expense_card_view(user.id, expense, note="Что редактировать?")
+    
+    bot.send_message(message.chat.id, msg, reply_markup=markup)
+
+def edit_card(chat_id, message_id, msg, markup=None):
+    """Обновить сообщение с карточкой на месте (если не вышло — прислать новое)"""
+    try:
+        bot.edit_message_text(msg, chat_id, message_id, reply_markup=markup)
+    except telebot.apihelper.ApiTelegramException as e:
+        # «message is not modified» — текст тот же, больше ничего делать не нужно
+        if 'not modified' not in str(e):
+            bot.send_message(chat_id, msg, reply_markup=markup)
+
+@bot.callback_query_handler(func=lambda call: call.data and call.data.startswith('exp:'))
+@timed_handler
+def expense_callback(call):
+    """Инлайн-кнопки расходов: карточка, правка, удаление с подтверждением и отмена"""
+    user_id = call.from_user.id
+    chat_id = call.message.chat.id
+    message_id = call.message.message_id
+    _, action, expense_id, arg = (call.data.split(':', 3) + [''])[:4]
+    expense_id = int(expense_id)
+    page = int(arg) if arg.isdigit() else 1
+
+    if action == 'list':
+        msg, markup = expense_list_view(user_id, page)
+        edit_card(chat_id, message_id, msg, markup)
+        bot.answer_callback_query(call.id)
+        return
+
+    if action == 'undo':
+        saved = pop_undo(user_id, expense_id)
+        if saved is None:
+            bot.answer_callback_query(call.id, "⌛ Отменять уже нечего")
+            return
+        # Возвращаем в тот бюджет, где расход меняли, даже если пользователь уже переключился
+        previous, ledger_id = saved
+        if get_expense(expense_id, user_id, ledger_id):
+            _, amount, category, description, _, _ = previous
+            edit_expense(user_id, expense_id, amount=amount, category=category, description=description,
+                         ledger_id=ledger_id)
+        else:
+            restore_expense(user_id, previous, ledger_id)
+        msg, markup = expense_card_view(user_id, previous, page, note="↩️ Изменение отменено")
+        edit_card(chat_id, message_id, msg, markup)
+        bot.answer_callback_query(call.id)
+        return
+
+    # Проверка доступа: один поиск по первичному ключу с условием на бюджет пользователя
+    expense = get_expense(expense_id, user_id)
+    if not expense:
+        bot.answer_callback_query(call.id, "❌ Расход не найден!", show_alert=True)
+        return
+
+    if action == 'show':
+        clear_state(user_id)
+        msg, markup = expense_card_view(user_id, expense, page)
+        edit_card(chat_id, message_id, msg, markup)
+    elif action == 'amount':
+        set_state(user_id, f'editing_amount_{expense_id}_{message_id}_{page}')
+        msg, _ = expense_card_view(user_id, expense, page, note="💰 Введи новую сумму:")
+        edit_card(chat_id, message_id, msg)
+    elif action == 'desc':
+        set_state(user_id, f'editing_description_{expense_id}_{message_id}_{page}')
+        msg, _ = expense_card_view(user_id, expense, page, note="📝 Введи новое описание:")
+        edit_card(chat_id, message_id, msg)
+    elif action == 'cat':
+        msg, _ = expense_card_view(user_id, expense, page, note="🏷️ Выбери новую категорию:")
+        edit_card(chat_id, message_id, msg, expense_category_markup(user_id, expense_id, page))
+    elif action == 'newcat':
+        set_state(user_id, f'editing_category_{expense_id}_{message_id}_{page}')
+        msg, _ = expense_card_view(user_id, expense, page, note="🏷️ Введи новую категорию:")
+        edit_card(chat_id, message_id, msg)
+    elif action == 'setcat':
+        # exp:setcat:<id>:<страница>:<категория>; в старых кнопках страницы нет
+        page_arg, _, category = arg.partition(':')
+        if page_arg.isdigit() and category:
+            page = int(page_arg)
+        else:
+            category = arg
+        remember_for_undo(user_id, expense)
+        edit_expense(user_id, expense_id, category=category)
+        msg, markup = expense_card_view(user_id, get_expense(expense_id, user_id), page, note="✅ Категория обновлена")
+        edit_card(chat_id, message_id, msg, markup)
+    elif action == 'del':
+        msg, _ = expense_card_view(user_id, expense, page, note="🗑️ Удалить этот расход?")
+        markup = telebot.types.InlineKeyboardMarkup()
+        markup.row(_inline("✅ Да, удалить", 'delok', expense_id, page), _inline("❌ Отмена", 'show', expense_id, page))
+        edit_card(chat_id, message_id, msg, markup)
+    elif action == 'delok':
+        if delete_expense(user_id, expense_id):
+            remember_for_undo(user_id, expense)
+            markup = telebot.types.InlineKeyboardMarkup()
+            markup.row(_inline("↩️ Вернуть", 'undo', expense_id, page), _inline("⬅️ К списку", 'list', 0, page))
+            edit_card(chat_id, message_id, f"🗑️ Расход #{expense_id} удалён", markup)
+        else:
+            bot.answer_callback_query(call.id, "❌ Ошибка удаления!", show_alert=True)
+            return
+
+    bot.answer_callback_query(call.id)
+
+@bot.message_handler(commands=['profile'], func=lambda message: message.from_user.id in ADMIN_IDS)
+@timed_handler
+def profile_command(message):
+    """Команда /profile [cprofile|sample] [секунды] [топ] или /profile stop (только для админов)"""
+    parts = message.text.split()[1:]
+    
+    if parts and parts[0] == 'stop':
+        if not stop_profiling():
+            bot.send_message(message.chat.id, "❌ Профилирование не запущено")
+        return
+    
+    mode = 'cprofile'
+    if parts and parts[0] in ('cprofile', 'sample'):
+        mode = parts.pop(0)
+    try:
+        seconds = int(parts[0]) if parts else 30
+        top = int(parts[1]) if len(parts) > 1 else 20
+    except ValueError:
+        bot.send_message(message.chat.id, "❌ Пример: /profile sample 60 25")
+        return
+    seconds = max(1, min(seconds, 600))
+    top = max(1, min(top, PROFILE_TOP_MAX))
+    
+    if start_profiling(mode, seconds, top, message.chat.id):
+        bot.send_message(message.chat.id, f"🔬 Профилирование ({mode}) на {seconds}с запущено. /profile stop — остановить досрочно")
+    else:
+        bot.send_message(message.chat.id, "❌ Профилирование уже идёт")
+
+@bot.message_handler(commands=['archive'], func=lambda message: message.from_user.id in ADMIN_IDS)
+@timed_handler
+def archive_command(message):
+    """Команда /archive [дни] — запустить архивацию вручную (только для админов)"""
+    parts = message.text.split()
+    max_age_days = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else None
+    
+    def run():
+        moved = archive_old_expenses(max_age_days)
+        bot.send_message(message.chat.id, f"🗄️ Архивация завершена, перенесено расходов: {moved}")
+    
+    threading.Thread(target=run, daemon=True).start()
+    bot.send_message(message.chat.id, "🗄️ Архивация запущена")
+
+@bot.message_handler(commands=['dbstats'], func=lambda message: message.from_user.id in ADMIN_IDS)
+@timed_handler
+def dbstats_command(message):
+    """Команда /dbstats — сводка по всем шардам (только для админов)"""
+    merged, per_shard = get_global_stats()
+    
+    if merged is None:
+        bot.send_message(message.chat.id, "❌ Ошибка получения статистики!")
+        return
+    
+    msg = f"""🗃️ Всего по {len(per_shard)} шардам:
+
+👤 Пользователей: {merged['users']} (общих бюджетов: {merged['ledgers']})
+🧾 Расходов: {merged['expenses']} (+{merged['archived']} в архиве)
+💰 Сумма: {merged['total']:.0f}₽
+💽 Размер: {merged['size_mb']:.1f} МБ
+"""
+    index = suggester.stats()
+    msg += f"🧠 Подсказки категорий: {index['ledgers']} бюдж., {index['tokens']} токенов\n"
+    if len(per_shard) > 1:
+        msg += "\n" + "\n".join(
+            f"#{s['shard']}: {s['users']} польз., {s['expenses']} расх., {s['size_mb']:.1f} МБ" for s in per_shard)
+    
+    bot.send_message(message.chat.id, msg)
+
+@bot.message_handler(commands=['backup'], func=lambda message: message.from_user.id in ADMIN_IDS)
+@timed_handler
+def backup_command(message):
+    """Команда /backup [status|list] (только для админов)"""
+    parts = message.text.split()
+    action = parts[1] if len(parts) > 1 else 'now'
+
+    if action == 'status':
+        msg = "💾 **Резервные копии:**\n\n" + "\n".join(f"{k}: {v}" for k, v in backup_metrics.items())
+        bot.send_message(message.chat.id, msg)
+    elif action == 'list':
+        backups = list_backups()
+        msg = "💾 Снимки:\n\n" + "\n".join(backups) if backups else "💾 Снимков нет"
+        bot.send_message(message.chat.id, msg)
+    else:
+        def run():
+            name = create_backup()
+            if name:
+                bot.send_message(message.chat.id, f"✅ Снимок {name} создан за {backup_metrics['last_duration_s']}с")
+            else:
+                bot.send_message(message.chat.id, "❌ Ошибка резервного копирования!")
+
+        threading.Thread(target=run, daemon=True).start()
+        bot.send_message(message.chat.id, "💾 Резервное копирование запущено")
+
+@bot.message_handler(commands=['insights'], func=lambda message: message.from_user.id in ADMIN_IDS)
+@timed_handler
+def insights_command(message):
+    """Команда /insights [status] — пересчитать аналитику или показать метрики (только для админов)"""
+    parts = message.text.split()
+    
+    if len(parts) > 1 and parts[1] == 'status':
+        msg = "📈 **Аналитика:**\n\n" + "\n".join(f"{k}: {v}" for k, v in insights_metrics.items())
+        bot.send_message(message.chat.id, msg)
+        return
+    
+    def run():
+        users = compute_insights()
+        if users is None:
+            bot.send_message(message.chat.id, "❌ Ошибка расчёта аналитики!")
         else:
-            bot.send_message(message.chat.id, "❌ Ошибка удаления!")
+            bot.send_message(message.chat.id, f"✅ Аналитика: {users} бюджетов за {insights_metrics['last_duration_s']}с, "
+                                              f"массивы {insights_metrics['last_arrays_mb']} МБ, RSS {insights_metrics['peak_rss_mb']} МБ")
+    
+    threading.Thread(target=run, daemon=True).start()
+    bot.send_message(message.chat.id, "📈 Расчёт аналитики запущен")
+
+@bot.message_handler(commands=['restore'], func=lambda message: message.from_user.id in ADMIN_IDS)
+@timed_handler
+def restore_command(message):
+    """Команда /restore [снимок] (только для админов)"""
+    parts = message.text.split()
+
+    if len(parts) < 2:
+        bot.send_message(message.chat.id, "❌ Укажи снимок из /backup list")
+        return
+
+    if restore_backup(parts[1]):
+        bot.send_message(message.chat.id, f"✅ БД восстановлена из {parts[1]}")
     else:
-        exp_id, amount, category, description, timestamp = expense
-        time = datetime.fromisoformat(timestamp).strftime('%d.%m %H:%M')
-        
-        msg = f"""
-📝 **Расход #{exp_id}:**
+        bot.send_message(message.chat.id, "❌ Ошибка восстановления!")
 
-💰 Сумма: {amount}₽
-🏷️ Категория: {category}
-📝 Описание: {description}
-⏰ Время: {time}
+# Инлайн-режим: отвечаем только из кэша сводок, без походов в БД на каждый символ
+INLINE_CACHE_TIME = int(os.getenv('INLINE_CACHE_TIME', '10'))
 
-Что редактировать?
-        """
-        
-        markup = telebot.types.ReplyKeyboardMarkup(resize_keyboard=True)
-        markup.add('💰 Сумма', '🏷️ Категория')
-        markup.add('📝 Описание', '⬅️ Отмена')
-        
-        bot.send_message(message.chat.id, msg, reply_markup=markup)
-        set_state(user.id, f'editing_{expense_id}')
+def parse_inline_expense(user_id, text, summary, limit=3):
+    """«350 такси» -> (сумма, описание, кандидаты категории) или None.
+    
+    Кандидаты: совпадение первого слова с категорией, подсказка по описанию, популярные.
+    """
+    match = QUICK_EXPENSE_RE.match(text.strip())
+    if not match:
+        return None
+    amount = float(match.group(1).replace(',', '.'))
+    description = match.group(2).strip()
+    
+    first_word, _, rest = description.partition(' ')
+    named = [c for c in summary['categories'] if c.lower().startswith(first_word.lower())]
+    candidates = named + suggest_categories(user_id, description) + summary['categories']
+    if named:
+        # «350 еда» — первое слово это категория, а не описание
+        description = rest.strip() or 'Без описания'
+    return amount, description, list(dict.fromkeys(candidates))[:limit]
+
+def _article(result_id, title, text, description=None):
+    return telebot.types.InlineQueryResultArticle(
+        result_id, title, telebot.types.InputTextMessageContent(text), description=description)
+
+@bot.inline_handler(func=lambda query: True)
+@timed_handler
+def inline_query(query):
+    """Инлайн-запросы: «350 еда» — быстрый расход, «today» — итог дня, «еда» — итог месяца по категории"""
+    user_id = query.from_user.id
+    text = query.query.strip()
+    summary = aggregates.get(user_id)
+    results = []
+    
+    parsed = parse_inline_expense(user_id, text, summary)
+    if parsed:
+        amount, description, categories = parsed
+        for category in categories:
+            results.append(_article(
+                f"add:{zlib.crc32(category.encode())}",
+                f"➕ {amount}₽ → {category}",
+                f"💰 {amount}₽ | {category} | {description}",
+                description,
+            ))
+    else:
+        needle = text.lower()
+        if needle not in ('', 'today', 'сегодня'):
+            for category in [c for c in summary['categories'] if c.lower().startswith(needle)][:5]:
+                total = summary['month'].get(category, 0)
+                results.append(_article(
+                    f"month:{zlib.crc32(category.encode())}",
+                    f"🏷️ {category} за месяц: {total:.0f}₽",
+                    f"🏷️ {category} за месяц: {total:.0f}₽",
+                ))
+        if not results:
+            results.append(_article(
+                'today',
+                f"📋 Сегодня: {summary['today']:.0f}₽",
+                f"📋 Расходы за сегодня: {summary['today']:.0f}₽",
+                f"За месяц: {sum(summary['month'].values()):.0f}₽",
+            ))
+    
+    bot.answer_inline_query(query.id, results, cache_time=INLINE_CACHE_TIME, is_personal=True)
+
+@bot.chosen_inline_handler(func=lambda result: result.result_id.startswith('add:'))
+@timed_handler
+def inline_chosen(result):
+    """Выбран быстрый расход из инлайн-режима (нужен /setinlinefeedback у BotFather)"""
+    user_id = result.from_user.id
+    parsed = parse_inline_expense(user_id, result.query, aggregates.get(user_id))
+    if not parsed:
+        return
+    amount, description, _ = parsed
+    
+    # Кандидаты могли смениться после показа результатов — ищем среди всех категорий
+    crc = int(result.result_id.split(':', 1)[1])
+    category = next((c for c in aggregates.get(user_id)['categories'] if zlib.crc32(c.encode()) == crc), None)
+    if category is None:
+        logger.warning(f"⚠️ Инлайн-расход {result.query!r} пользователя {user_id}: категория не найдена")
+        return
+    
+    if add_expense(user_id, amount, category, description):
+        logger.info(f"✅ Инлайн-расход {amount}₽ добавлен пользователем {user_id}")
 
 @bot.message_handler(func=lambda message: True)
+@timed_handler
 def handle_message(message):
     """Обработка текстовых сообщений"""
     user = message.from_user
@@ -876,6 +4162,9 @@ def handle_message(message):
 📝 Описание: {description}
 ID: {expense_id}
             """
+            alert = expense_alert(user.id, amount, category)
+            if alert:
+                msg += f"\n{alert}"
             bot.send_message(message.chat.id, msg, reply_markup=markup, parse_mode='Markdown')
             clear_state(user.id)
             logger.info(f"✅ Расход {amount}₽ добавлен пользователем {user.id}")
@@ -883,69 +4172,278 @@ ID: {expense_id}
             bot.send_message(message.chat.id, "❌ Ошибка при добавлении расхода!")
         return
     
-    # Редактирование расхода
-    if state and state.startswith('editing_'):
-        expense_id = int(state.replace('editing_', ''))
+    # Новое значение для расхода: применяем и обновляем карточку на месте
+    if state and state.startswith(('editing_amount_', 'editing_category_', 'editing_description_')):
+        field, expense_id, card_id, *page = state.replace('editing_', '').split('_')
+        expense_id, card_id = int(expense_id), int(card_id)
+        page = int(page[0]) if page else 1
+        expense = get_expense(expense_id, user.id)
+        if not expense:
+            bot.send_message(message.chat.id, "❌ Расход не найден!")
+            clear_state(user.id)
+            return
         
-        if text == '💰 Сумма':
-            set_state(user.id, f'editing_amount_{expense_id}')
-            bot.send_message(message.chat.id, "Введи новую сумму:")
-        elif text == '🏷️ Категория':
-            set_state(user.id, f'editing_category_{expense_id}')
-            bot.send_message(message.chat.id, "Введи новую категорию:")
-        elif text == '📝 Описание':
-            set_state(user.id, f'editing_description_{expense_id}')
-            bot.send_message(message.chat.id, "Введи новое описание:")
+        if field == 'amount':
+            try:
+                changes = {'amount': float(text.replace(',', '.'))}
+            except ValueError:
+                bot.send_message(message.chat.id, "❌ Введи число!")
+                return
+        elif field == 'category':
+            add_category(user.id, text)
+            changes = {'category': text}
         else:
-            bot.send_message(message.chat.id, "❌ Выбери что редактировать")
-        return
-    
-    # Редактирование суммы
-    if state and state.startswith('editing_amount_'):
-        expense_id = int(state.replace('editing_amount_', ''))
-        try:
-            amount = float(text)
-            if edit_expense(expense_id, amount=amount):
-                bot.send_message(message.chat.id, f"✅ Сумма обновлена на {amount}₽!")
-                clear_state(user.id)
-            else:
-                bot.send_message(message.chat.id, "❌ Ошибка обновления!")
-        except ValueError:
-            bot.send_message(message.chat.id, "❌ Введи число!")
-        return
-    
-    # Редактирование категории
-    if state and state.startswith('editing_category_'):
-        expense_id = int(state.replace('editing_category_', ''))
-        if edit_expense(expense_id, category=text):
-            bot.send_message(message.chat.id, f"✅ Категория обновлена на '{text}'!")
+            changes = {'description': text}
+        
+        remember_for_undo(user.id, expense)
+        if edit_expense(user.id, expense_id, **changes):
             clear_state(user.id)
+            msg, markup = expense_card_view(user.id, get_expense(expense_id, user.id), page, note="✅ Расход обновлён")
+            edit_card(message.chat.id, card_id, msg, markup)
         else:
             bot.send_message(message.chat.id, "❌ Ошибка обновления!")
         return
     
-    # Редактирование описания
-    if state and state.startswith('editing_description_'):
-        expense_id = int(state.replace('editing_description_', ''))
-        if edit_expense(expense_id, description=text):
-            bot.send_message(message.chat.id, f"✅ Описание обновлено на '{text}'!")
-            clear_state(user.id)
+    # Выбор категории для быстрого расхода (новый быстрый расход отменяет незаконченный)
+    if state and state.startswith('quick_') and QUICK_EXPENSE_RE.match(text):
+        clear_state(user.id)
+        state = None
+    if state and state.startswith('quick_'):
+        _, amount, description = state.split('_', 2)
+        if text == '➕ Новая категория':
+            bot.send_message(message.chat.id, "📝 Введи название новой категории:")
+            return
+        if text.startswith('🏷️ '):
+            category = text.replace('🏷️ ', '')
+        elif add_category(user.id, text):
+            category = text
         else:
-            bot.send_message(message.chat.id, "❌ Ошибка обновления!")
+            bot.send_message(message.chat.id, "❌ Ошибка добавления категории!")
+            return
+        send_quick_expense(message, float(amount), category, description)
+        return
+    
+    # Быстрый расход: «350 такси домой»
+    match = QUICK_EXPENSE_RE.match(text) if state is None else None
+    if match:
+        amount = float(match.group(1).replace(',', '.'))
+        description = match.group(2).strip()
+        category = auto_category(user.id, description)
+        if category:
+            send_quick_expense(message, amount, category, description)
+        else:
+            set_state(user.id, f'quick_{amount}_{description}')
+            markup = get_category_buttons(user.id, suggest_categories(user.id, description))
+            bot.send_message(message.chat.id, "💰 Выбери категорию или введи новую:", reply_markup=markup)
         return
     
     bot.send_message(message.chat.id, "❓ Команда не понята. Нажми /help для справки")
 
+QUICK_EXPENSE_RE = re.compile(r'^(\d+(?:[.,]\d+)?)\s+(\S.*)$', re.S)
+
+def send_quick_expense(message, amount, category, description):
+    """Добавить быстрый расход и ответить одним сообщением"""
+    user = message.from_user
+    expense_id = add_expense(user.id, amount, category, description)
+    
+    if expense_id:
+        markup = telebot.types.ReplyKeyboardMarkup(resize_keyboard=True)
+        markup.add('💰 Добавить расход', '📊 Статистика')
+        markup.add('📋 Сегодня', '📝 Все расходы')
+        markup.add('❓ Помощь')
+        
+        msg = f"""
+✅ **Расход добавлен!**
+
+💰 Сумма: {amount}₽
+🏷️ Категория: {category}
+📝 Описание: {description}
+ID: {expense_id}
+
+Не та категория? /edit {expense_id}
+            """
+        alert = expense_alert(user.id, amount, category)
+        if alert:
+            msg += f"\n{alert}"
+        bot.send_message(message.chat.id, msg, reply_markup=markup, parse_mode='Markdown')
+        clear_state(user.id)
+        logger.info(f"✅ Быстрый расход {amount}₽ добавлен пользователем {user.id}")
+    else:
+        bot.send_message(message.chat.id, "❌ Ошибка при добавлении расхода!")
+
+# ===== ОБРАБОТКА АПДЕЙТОВ =====
+# Каждый апдейт обрабатывается ровно один раз: отметка update_id фиксируется вместе с основной записью обработчика,
+# а повтор (перезапуск, ретрай вебхука, второй экземпляр) становится no-op. Запись коммитится сразу,
+# поэтому упавший после неё обработчик (например, на send_message) данные не теряет. Повторяемые записи
+# перед основной идут под defer_update_mark, отметки апдейтов без записей пишутся пакетом после обработки
+UPDATE_WORKERS = int(os.getenv('UPDATE_WORKERS', '8'))
+UPDATE_BATCH = 100
+POLL_TIMEOUT = int(os.getenv('POLL_TIMEOUT', '25'))
+DEDUP_MEMORY = int(os.getenv('DEDUP_MEMORY', '10000'))
+DEDUP_KEEP_HOURS = int(os.getenv('DEDUP_KEEP_HOURS', '48'))
+ALLOWED_UPDATES = ['message', 'callback_query', 'inline_query', 'chosen_inline_result']
+
+# Последние обработанные update_id — чтобы не ходить в БД за повторами
+_recent_updates = OrderedDict()
+_recent_lock = threading.Lock()
+# Апдейты одного пользователя обрабатываются по очереди (блокировки по остатку от user_id)
+_user_locks = [threading.Lock() for _ in range(256)]
+
+def update_user_id(update):
+    """ID пользователя, от которого пришёл апдейт (0, если не определить)"""
+    for kind in ('message', 'edited_message', 'callback_query', 'inline_query', 'chosen_inline_result'):
+        obj = getattr(update, kind, None)
+        if obj is not None and obj.from_user is not None:
+            return obj.from_user.id
+    return 0
+
+def _remember_update(update_id):
+    with _recent_lock:
+        _recent_updates[update_id] = True
+        while len(_recent_updates) > DEDUP_MEMORY:
+            _recent_updates.popitem(last=False)
+
+def process_update(update, processed=None):
+    """Обработать апдейт, если он ещё не обработан; вернуть True, если обработчик запускался.
+    
+    processed — уже известные обработанные update_id (пакетная проверка, отметки запишет process_batch),
+    иначе спросим хранилище и запишем отложенную отметку сразу.
+    """
+    if processed is None:
+        try:
+            return _process_update(update, None)
+        finally:
+            storage.flush_update_marks()
+    return _process_update(update, processed)
+
+def _process_update(update, processed):
+    with _recent_lock:
+        if update.update_id in _recent_updates:
+            return False
+    user_id = update_user_id(update)
+    
+    with _user_locks[user_id % len(_user_locks)]:
+        if processed is None:
+            processed = storage.processed_updates([update.update_id])
+        if update.update_id in processed:
+            _remember_update(update.update_id)
+            return False
+        try:
+            with storage.update_transaction(user_id, update.update_id):
+                bot.process_new_updates([update])
+        except DuplicateUpdate:
+            logger.info(f"⏭️ Апдейт {update.update_id} уже обработан")
+            _remember_update(update.update_id)
+            return False
+        _remember_update(update.update_id)
+        return True
+
+def process_batch(updates, pool):
+    """Обработать пачку: одна проверка отметок на всю пачку, пользователи — параллельно, каждый по порядку"""
+    processed = storage.processed_updates([u.update_id for u in updates])
+    by_user = defaultdict(list)
+    for update in updates:
+        by_user[update_user_id(update)].append(update)
+    
+    def run(user_updates):
+        for update in user_updates:
+            try:
+                process_update(update, processed)
+            except Exception as e:
+                logger.error(f"❌ Ошибка обработки апдейта {update.update_id}: {e}")
+    
+    for future in [pool.submit(run, user_updates) for user_updates in by_user.values()]:
+        future.result()
+    # Отметки апдейтов без записей — одной транзакцией на шард, до сохранения смещения
+    try:
+        storage.flush_update_marks()
+    except Exception as e:
+        logger.error(f"❌ Ошибка записи отметок апдейтов: {e}")
+
+def prune_processed_updates():
+    """Удалить старые отметки обработанных апдейтов (Telegram хранит апдейты не дольше суток)"""
+    before = (datetime.utcnow() - timedelta(hours=DEDUP_KEEP_HOURS)).strftime('%Y-%m-%d %H:%M:%S')
+    removed = storage.prune_processed_updates(before)
+    logger.info(f"🧹 Удалено отметок обработанных апдейтов: {removed}")
+    return removed
+
+def run_polling(until_caught_up=False):
+    """Long polling с догоняющей обработкой очереди пачками при старте (until_caught_up — выйти, разобрав очередь)"""
+    last = storage.load_update_offset()
+    offset = last + 1 if last is not None else None
+    pool = ThreadPoolExecutor(max_workers=UPDATE_WORKERS)
+    catching_up = True
+    caught_up = 0
+    started = time.perf_counter()
+    
+    while True:
+        try:
+            # Пока догоняем — не ждём на сервере, забираем очередь пачками по UPDATE_BATCH
+            updates = bot.get_updates(offset=offset, limit=UPDATE_BATCH, timeout=POLL_TIMEOUT + 10,
+                                      allowed_updates=ALLOWED_UPDATES,
+                                      long_polling_timeout=0 if catching_up else POLL_TIMEOUT)
+        except Exception as e:
+            logger.error(f"❌ Ошибка получения апдейтов: {e}")
+            time.sleep(3)
+            continue
+        
+        if not updates:
+            if catching_up:
+                catching_up = False
+                logger.info(f"✅ Очередь разобрана: {caught_up} апдейтов за {time.perf_counter() - started:.1f}с")
+                if until_caught_up:
+                    pool.shutdown()
+                    return caught_up
+            continue
+        
+        process_batch(updates, pool)
+        if catching_up:
+            caught_up += len(updates)
+        # Смещение двигаем только после всей пачки: всё, что ниже, обработано
+        offset = updates[-1].update_id + 1
+        try:
+            storage.save_update_offset(updates[-1].update_id)
+        except Exception as e:
+            logger.error(f"❌ Ошибка сохранения смещения: {e}")
+
 # ===== ЗАПУСК БОТА =====
 
 if __name__ == '__main__':
+    # python expense_bot.py reshard N — перераспределить пользователей на N шардов (бот остановлен)
+    if len(sys.argv) == 3 and sys.argv[1] == 'reshard':
+        reshard(int(sys.argv[2]))
+        sys.exit(0)
+    # python expense_bot.py changes [SEQ,SEQ...] — изменения после курсора строками JSON в stdout,
+    # новый курсор — последней строкой лога
+    if len(sys.argv) in (2, 3) and sys.argv[1] == 'changes':
+        init_db()
+        stream_changes([int(seq) for seq in sys.argv[2].split(',') if seq] if len(sys.argv) == 3 else [])
+        sys.exit(0)
+    # python expense_bot.py vacuum — включить инкрементальный VACUUM и сжать шарды (бот остановлен)
+    if len(sys.argv) == 2 and sys.argv[1] == 'vacuum':
+        vacuum_shards()
+        sys.exit(0)
+
     logger.info("==================================================")
     logger.info("💰 Бот отслеживания расходов запущен!")
     logger.info("==================================================")
     
     init_db()
+    # Архив и бэкапы работают только с файлами SQLite
+    if STORAGE_BACKEND == 'sqlite':
+        run_periodically(archive_old_expenses, 24 * 3600)
+        run_periodically(create_backup, BACKUP_INTERVAL_HOURS * 3600)
+    # Аналитика — ночью, когда нагрузка минимальна
+    first_insights = datetime.now().replace(hour=INSIGHTS_HOUR, minute=0, second=0, microsecond=0)
+    if first_insights <= datetime.now():
+        first_insights += timedelta(days=1)
+    run_periodically(compute_insights, INSIGHTS_INTERVAL_HOURS * 3600,
+                     first_run=(first_insights - datetime.now()).total_seconds())
+    
+    run_periodically(prune_processed_updates, 3600)
+    run_periodically(compact_changes, 24 * 3600)
     
     try:
-        bot.infinity_polling()
+        run_polling()
     except Exception as e:
         logger.error(f"❌ Ошибка при запуске бота: {e}")